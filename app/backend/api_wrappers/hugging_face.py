@@ -1,5 +1,15 @@
 import inspect
-from typing import AsyncIterable, Dict, Iterable, List, Optional, Union
+from typing import (
+    Any,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Union,
+)
 
 from huggingface_hub import AsyncInferenceClient  # type: ignore
 from huggingface_hub.inference._generated.types import (  # type: ignore
@@ -15,8 +25,17 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
+from core.admission import AdmissionController, call_admitted
+from core.circuitbreaker import CircuitBreaker, call_protected
+
 
 class HuggingFaceClient:
+    # Limits the concurrent calls of the worker to the Inference API, shared by the chat models and the classifiers
+    admission_controller: Optional[AdmissionController] = None
+    # Limits the concurrent streamed chat completions, which are generated after their call returned
+    stream_admission_controller: Optional[AdmissionController] = None
+    # Stops calling the service while it is failing
+    circuit_breaker: Optional[CircuitBreaker] = None
 
     def __init__(
         self,
@@ -55,32 +74,44 @@ class HuggingFaceClient:
         top_logprobs: Optional[int] = None,
         top_p: Optional[float] = None,
     ) -> Union[ChatCompletionOutput, AsyncIterable[ChatCompletionStreamOutput]]:
-        return await self.client.chat_completion(
-            messages=messages,
-            model=model,
+        return await self._call_upstream(
+            lambda: self.client.chat_completion(
+                messages=messages,
+                model=model,
+                stream=stream,
+                frequency_penalty=frequency_penalty,
+                logit_bias=logit_bias,
+                logprobs=logprobs,
+                max_tokens=max_tokens,
+                n=n,
+                presence_penalty=presence_penalty,
+                seed=seed,
+                stop=stop,
+                temperature=temperature,
+                tool_choice=tool_choice,
+                tool_prompt=tool_prompt,
+                tools=tools,
+                top_logprobs=top_logprobs,
+                top_p=top_p,
+            ),
             stream=stream,
-            frequency_penalty=frequency_penalty,
-            logit_bias=logit_bias,
-            logprobs=logprobs,
-            max_tokens=max_tokens,
-            n=n,
-            presence_penalty=presence_penalty,
-            seed=seed,
-            stop=stop,
-            temperature=temperature,
-            tool_choice=tool_choice,
-            tool_prompt=tool_prompt,
-            tools=tools,
-            top_logprobs=top_logprobs,
-            top_p=top_p,
         )
 
     async def text_classification(self, text: str, model: str) -> List[TextClassificationOutputElement]:
-        return await self.client.text_classification(text=text, model=model)
+        return await self._call_upstream(lambda: self.client.text_classification(text=text, model=model))
 
     async def create_embeddings(self, *args, **kwargs) -> CreateEmbeddingResponse:
         raise NotImplementedError
 
+    async def _call_upstream(self, call: Callable[[], Awaitable[Any]], stream: bool = False) -> Any:
+        """Make a call to the service once it is admitted, through the circuit breaker of the service."""
+        return await call_admitted(
+            self.admission_controller,
+            lambda: call_protected(self.circuit_breaker, call),
+            stream=stream,
+            stream_controller=self.stream_admission_controller,
+        )
+
     def _extract_content_as_string(
         self,
         content: Union[str, Iterable[Union[ChatCompletionContentPartTextParam, ChatCompletionContentPartImageParam]]],
@@ -1,13 +1,22 @@
 import inspect
 from abc import ABC
-from typing import List
+from typing import Any, Awaitable, Callable, List, Optional
 
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from openai.types import CreateEmbeddingResponse
 from openai.types.chat import ChatCompletion
 
+from core.admission import AdmissionController, call_admitted
+from core.circuitbreaker import CircuitBreaker, call_protected
+
 
 class OpenAIClient(ABC):
+    # Limits the concurrent calls of the worker to the service, shared by the chat completions and the embeddings
+    admission_controller: Optional[AdmissionController] = None
+    # Limits the concurrent streamed chat completions, which are generated after their call returned
+    stream_admission_controller: Optional[AdmissionController] = None
+    # Stops calling the service while it is failing
+    circuit_breaker: Optional[CircuitBreaker] = None
 
     def __init__(self):
         self._client = None
@@ -28,14 +37,26 @@ class OpenAIClient(ABC):
         self._client = value
 
     async def chat_completion(self, *args, **kwargs) -> ChatCompletion:
-        return await self.client.chat.completions.create(*args, **kwargs)
+        return await self._call_upstream(
+            lambda: self.client.chat.completions.create(*args, **kwargs),
+            stream=bool(kwargs.get("stream")),
+        )
 
     async def create_embeddings(self, *args, **kwargs) -> CreateEmbeddingResponse:
-        return await self.client.embeddings.create(*args, **kwargs)
+        return await self._call_upstream(lambda: self.client.embeddings.create(*args, **kwargs))
 
     async def text_classification(self, *args, **kwargs):
         raise NotImplementedError
 
+    async def _call_upstream(self, call: Callable[[], Awaitable[Any]], stream: bool = False) -> Any:
+        """Make a call to the service once it is admitted, through the circuit breaker of the service."""
+        return await call_admitted(
+            self.admission_controller,
+            lambda: call_protected(self.circuit_breaker, call),
+            stream=stream,
+            stream_controller=self.stream_admission_controller,
+        )
+
 
 class LocalOpenAIClient(OpenAIClient):
 
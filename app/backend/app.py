@@ -1,5 +1,4 @@
 import asyncio
-import dataclasses
 import io
 import json
 import logging
@@ -8,7 +7,7 @@ import os
 import sys
 import time
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, List, Union, cast
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union, cast
 
 from azure.cognitiveservices.speech import (
     ResultReason,
@@ -58,6 +57,8 @@ from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionAppr
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from config import (
+    CONFIG_ADMISSION_CONTROLLERS,
+    CONFIG_ANSWER_CACHE,
     CONFIG_ASK_APPROACH,
     CONFIG_ASK_VISION_APPROACH,
     CONFIG_AUTH_CLIENT,
@@ -65,13 +66,20 @@ from config import (
     CONFIG_BLOB_CONTAINER_CLIENT,
     CONFIG_CHAT_APPROACH,
     CONFIG_CHAT_VISION_APPROACH,
+    CONFIG_CIRCUIT_BREAKERS,
     CONFIG_CREDENTIAL,
     CONFIG_CURRENT_MODEL,
+    CONFIG_DELTA_COALESCER,
+    CONFIG_EMBEDDING_CACHE,
     CONFIG_GPT4V_DEPLOYED,
+    CONFIG_HTTP_SESSIONS,
+    CONFIG_IMAGE_CACHE,
     CONFIG_INGESTER,
     CONFIG_LLM_CLIENTS,
     CONFIG_PROMPT_PROTECTION,
+    CONFIG_PROMPT_TEMPLATES,
     CONFIG_SEARCH_CLIENT,
+    CONFIG_SEMANTIC_CACHE,
     CONFIG_SEMANTIC_RANKER_DEPLOYED,
     CONFIG_SPEECH_INPUT_ENABLED,
     CONFIG_SPEECH_OUTPUT_AZURE_ENABLED,
@@ -80,12 +88,31 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_STREAM_TRACKER,
+    CONFIG_TOKEN_COUNT_CACHE,
+    CONFIG_TOKENIZER_REGISTRY,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
+from core.aclgroups import KnownAclGroups
+from core.admission import AdmissionController
+from core.answercache import AnswerCache
 from core.authentication import AuthenticationHelper
+from core.circuitbreaker import CircuitBreaker
+from core.claimscache import ClaimsCache
+from core.deltacoalescer import DeltaCoalescer
+from core.embeddingcache import EmbeddingCache
+from core.groupcache import GroupCache, SqliteGroupStore
+from core.httpsessions import HttpSessionPool, HttpSessionSettings
+from core.imagecache import ImageCache
+from core.jsonserializer import JSONProvider, JSONSerializer
+from core.pathauthcache import PathAuthCache
 from core.promptprotection import PromptProtection
+from core.semanticcache import SemanticAnswerCache
+from core.streamtracker import StreamTracker
+from core.tokencountcache import TokenCountCache
+from core.tokenizers import TokenizerRegistry
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from prepdocs import (
@@ -96,6 +123,7 @@ from prepdocs import (
 )
 from prepdocslib.filestrategy import UploadUserFileStrategy
 from prepdocslib.listfilestrategy import File
+from templates.prompt_registry import PromptTemplateRegistry
 from templates.supported_models import get_supported_models
 
 PYRIT_COMPATIBLE = sys.version_info >= (3, 10) and sys.version_info < (3, 12)
@@ -190,6 +218,16 @@ async def content_file(path: str, auth_claims: Dict[str, Any]):
     return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
 
 
+def get_answer_cache_key(
+    approach: Approach, messages: list, context: dict[str, Any]
+) -> tuple[Optional[AnswerCache], Optional[str]]:
+    """Get the answer cache and the key of a request. The key is None if the answer cannot be cached."""
+    answer_cache: Optional[AnswerCache] = current_app.config[CONFIG_ANSWER_CACHE]
+    if answer_cache is None:
+        return None, None
+    return answer_cache, answer_cache.make_key(approach, messages, context)
+
+
 @bp.route("/ask", methods=["POST"])
 @authenticated
 async def ask(auth_claims: Dict[str, Any]):
@@ -205,28 +243,37 @@ async def ask(auth_claims: Dict[str, Any]):
             approach = cast(Approach, current_app.config[CONFIG_ASK_VISION_APPROACH])
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
+        answer_cache, cache_key = get_answer_cache_key(approach, request_json["messages"], context)
+        if answer_cache is not None and cache_key:
+            if cached_answer := answer_cache.get_answer(cache_key, request_json.get("session_state")):
+                return jsonify(cached_answer)
         r = await approach.run(
             request_json["messages"], context=context, session_state=request_json.get("session_state")
         )
+        if answer_cache is not None and cache_key:
+            answer_cache.set_answer(cache_key, r)
         return jsonify(r)
     except Exception as error:
         return error_response(error, "/ask")
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o) and not isinstance(o, type):
-            return dataclasses.asdict(o)
-        return super().default(o)
+# The events of the streams are written as they come, without sorting their keys
+stream_serializer = JSONSerializer()
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], serializer: JSONSerializer = stream_serializer
+) -> AsyncGenerator[bytes, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            yield serializer.dumps_line(event)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps(error_dict(error))
+        yield serializer.dumps(error_dict(error))
+    finally:
+        # When the client disconnects, Quart closes the body of the response, and closing the events of the approach
+        # cancels the searches in progress and closes the stream of the answer
+        await r.aclose()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -245,11 +292,17 @@ async def chat(auth_claims: Dict[str, Any]):
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
 
+        answer_cache, cache_key = get_answer_cache_key(approach, request_json["messages"], context)
+        if answer_cache is not None and cache_key:
+            if cached_answer := answer_cache.get_answer(cache_key, request_json.get("session_state")):
+                return jsonify(cached_answer)
         result = await approach.run(
             request_json["messages"],
             context=context,
             session_state=request_json.get("session_state"),
         )
+        if answer_cache is not None and cache_key:
+            answer_cache.set_answer(cache_key, result)
         return jsonify(result)
     except Exception as error:
         return error_response(error, "/chat")
@@ -271,11 +324,20 @@ async def chat_stream(auth_claims: Dict[str, Any]):
         else:
             approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
 
-        result = await approach.run_stream(
-            request_json["messages"],
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
+        answer_cache, cache_key = get_answer_cache_key(approach, request_json["messages"], context)
+        cached_answer = None
+        if answer_cache is not None and cache_key:
+            cached_answer = answer_cache.get_answer(cache_key, request_json.get("session_state"))
+        if cached_answer:
+            result = AnswerCache.replay_stream(cached_answer)
+        else:
+            result = await approach.run_stream(
+                request_json["messages"],
+                context=context,
+                session_state=request_json.get("session_state"),
+            )
+            if answer_cache is not None and cache_key:
+                result = answer_cache.cache_stream(cache_key, result)
         response = await make_response(format_as_ndjson(result))
         response.timeout = None  # type: ignore
         response.mimetype = "application/json-lines"
@@ -564,6 +626,28 @@ async def setup_clients():
     AZURE_SERVER_APP_SECRET = os.getenv("AZURE_SERVER_APP_SECRET")
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_AUTH_TENANT_ID = os.getenv("AZURE_AUTH_TENANT_ID", AZURE_TENANT_ID)
+    # Number of seconds the keys used to validate access tokens are cached
+    JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", 24 * 60 * 60))
+    # Maximum number of access tokens whose claims are cached, 0 to disable the cache
+    AUTH_CLAIMS_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CLAIMS_CACHE_MAX_ENTRIES", 1000))
+    # Maximum number of seconds the claims of a token are reused, which bounds how stale the groups of a user can be
+    AUTH_CLAIMS_CACHE_TTL = float(os.getenv("AUTH_CLAIMS_CACHE_TTL", 5 * 60))
+    # Maximum number of on-behalf-of token exchanges running at the same time
+    AUTH_OBO_MAX_WORKERS = int(os.getenv("AUTH_OBO_MAX_WORKERS", 4))
+    # Number of seconds the groups listed from Microsoft Graph for users with a groups overage claim are cached,
+    # 0 to disable the cache, and optional SQLite file to share them between the workers
+    AUTH_GROUP_CACHE_TTL = float(os.getenv("AUTH_GROUP_CACHE_TTL", 5 * 60))
+    AUTH_GROUP_CACHE_PATH = os.getenv("AUTH_GROUP_CACHE_PATH")
+    # Index of the groups referenced by the documents, registered by prepdocs and manageacl, used to keep the
+    # security filters of users with many groups short
+    AZURE_SEARCH_ACL_GROUPS_INDEX = os.getenv("AZURE_SEARCH_ACL_GROUPS_INDEX")
+    AZURE_SEARCH_ACL_GROUPS_TTL = float(os.getenv("AZURE_SEARCH_ACL_GROUPS_TTL", 5 * 60))
+    # Minimum number of seconds between the reloads of the known ACL groups when a group of a user is missing from them
+    AZURE_SEARCH_ACL_GROUPS_RELOAD_INTERVAL = float(os.getenv("AZURE_SEARCH_ACL_GROUPS_RELOAD_INTERVAL", 30))
+    AZURE_SEARCH_ACL_GROUPS_MAX = int(os.getenv("AZURE_SEARCH_ACL_GROUPS_MAX", 100_000))
+    # Number of seconds the decisions of the access checks of the /content route are cached, 0 to disable the cache
+    PATH_AUTH_CACHE_TTL = float(os.getenv("PATH_AUTH_CACHE_TTL", 60))
+    PATH_AUTH_CACHE_MAX_ENTRIES = int(os.getenv("PATH_AUTH_CACHE_MAX_ENTRIES", 10000))
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -581,6 +665,56 @@ async def setup_clients():
 
     USE_INJECTION_PROTECTION = os.getenv("USE_INJECTION_PROTECTION", "").lower() == "true"
 
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 2048))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 24 * 60 * 60))
+    TOKEN_COUNT_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_COUNT_CACHE_MAX_ENTRIES", 10000))
+    USE_ANSWER_CACHE = os.getenv("USE_ANSWER_CACHE", "").lower() == "true"
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 60 * 60))
+    USE_SEMANTIC_CACHE = os.getenv("USE_SEMANTIC_CACHE", "").lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 1000))
+    SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 60 * 60))
+    USE_SPECULATIVE_RETRIEVAL = os.getenv("USE_SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    STREAM_COALESCE_WINDOW_MS = float(os.getenv("STREAM_COALESCE_WINDOW_MS", 0))
+    STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", 0))
+    IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    # Maximum number of concurrent calls of the worker to each upstream service, 0 to disable the limit
+    ADMISSION_MAX_CONCURRENCY = {
+        "openai": int(os.getenv("ADMISSION_OPENAI_MAX_CONCURRENCY", 32)),
+        "hf": int(os.getenv("ADMISSION_HF_MAX_CONCURRENCY", 16)),
+        "search": int(os.getenv("ADMISSION_SEARCH_MAX_CONCURRENCY", 32)),
+        "vision": int(os.getenv("ADMISSION_VISION_MAX_CONCURRENCY", 16)),
+        # The streamed chat completions hold a slot of their own until the answer is read by the client
+        "openai_streams": int(os.getenv("ADMISSION_OPENAI_MAX_STREAMS", 64)),
+        "hf_streams": int(os.getenv("ADMISSION_HF_MAX_STREAMS", 32)),
+    }
+    ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 64))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 10))
+    # Maximum number of seconds a stream holds its slot, in case it is never consumed or closed
+    ADMISSION_STREAM_MAX_SECONDS = float(os.getenv("ADMISSION_STREAM_MAX_SECONDS", 300))
+    # Rate of failed or slow calls to an upstream service that opens its circuit, 0 to disable the circuit breakers
+    CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", 0.5))
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", 30))
+    CIRCUIT_BREAKER_WINDOW_SIZE = int(os.getenv("CIRCUIT_BREAKER_WINDOW_SIZE", 20))
+    CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", 10))
+    CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", 30))
+    # The model answering the requests while the circuit of the client of the requested model is open
+    CIRCUIT_BREAKER_FALLBACK_MODEL = os.getenv("CIRCUIT_BREAKER_FALLBACK_MODEL")
+    # The injection protection fails closed with a 503 while the classifier is unavailable, unless operators opt in
+    # to answering the requests without the check
+    SKIP_INJECTION_PROTECTION_WHEN_UNAVAILABLE = (
+        os.getenv("SKIP_INJECTION_PROTECTION_WHEN_UNAVAILABLE", "false").lower() == "true"
+    )
+    http_session_settings = HttpSessionSettings(
+        limit=int(os.getenv("HTTP_POOL_LIMIT", 100)),
+        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20)),
+        keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60)),
+        dns_cache_ttl=int(os.getenv("HTTP_DNS_CACHE_TTL", 300)),
+        total_timeout=float(os.getenv("HTTP_TIMEOUT", 60)),
+        connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", 10)),
+    )
+
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
     USE_USER_UPLOAD = os.getenv("USE_USER_UPLOAD", "").lower() == "true"
     USE_SPEECH_INPUT_BROWSER = os.getenv("USE_SPEECH_INPUT_BROWSER", "").lower() == "true"
@@ -593,6 +727,10 @@ async def setup_clients():
     # If you encounter a blocking error during a DefaultAzureCredential resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
     azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
 
+    # Share the connections to the services called with aiohttp between the requests
+    http_sessions = HttpSessionPool(http_session_settings)
+    current_app.config[CONFIG_HTTP_SESSIONS] = http_sessions
+
     # Set up clients for AI Search and Storage
     search_client = SearchClient(
         endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
@@ -613,6 +751,28 @@ async def setup_clients():
         )
         search_index = await search_index_client.get_index(AZURE_SEARCH_INDEX)
         await search_index_client.close()
+    claims_cache: Optional[ClaimsCache] = None
+    if AZURE_USE_AUTHENTICATION and AUTH_CLAIMS_CACHE_MAX_ENTRIES > 0:
+        claims_cache = ClaimsCache(max_entries=AUTH_CLAIMS_CACHE_MAX_ENTRIES, ttl=AUTH_CLAIMS_CACHE_TTL)
+    group_cache: Optional[GroupCache] = None
+    if AZURE_USE_AUTHENTICATION and AUTH_GROUP_CACHE_TTL > 0:
+        group_store = SqliteGroupStore(AUTH_GROUP_CACHE_PATH) if AUTH_GROUP_CACHE_PATH else None
+        group_cache = GroupCache(ttl=AUTH_GROUP_CACHE_TTL, store=group_store)
+    known_acl_groups: Optional[KnownAclGroups] = None
+    if AZURE_USE_AUTHENTICATION and AZURE_SEARCH_ACL_GROUPS_INDEX:
+        known_acl_groups = KnownAclGroups(
+            SearchClient(
+                endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+                index_name=AZURE_SEARCH_ACL_GROUPS_INDEX,
+                credential=azure_credential,
+            ),
+            ttl=AZURE_SEARCH_ACL_GROUPS_TTL,
+            reload_interval=AZURE_SEARCH_ACL_GROUPS_RELOAD_INTERVAL,
+            max_groups=AZURE_SEARCH_ACL_GROUPS_MAX,
+        )
+    path_auth_cache: Optional[PathAuthCache] = None
+    if AZURE_USE_AUTHENTICATION and PATH_AUTH_CACHE_TTL > 0:
+        path_auth_cache = PathAuthCache(max_entries=PATH_AUTH_CACHE_MAX_ENTRIES, ttl=PATH_AUTH_CACHE_TTL)
     auth_helper = AuthenticationHelper(
         search_index=search_index,
         use_authentication=AZURE_USE_AUTHENTICATION,
@@ -623,8 +783,83 @@ async def setup_clients():
         require_access_control=AZURE_ENFORCE_ACCESS_CONTROL,
         enable_global_documents=AZURE_ENABLE_GLOBAL_DOCUMENT_ACCESS,
         enable_unauthenticated_access=AZURE_ENABLE_UNAUTHENTICATED_ACCESS,
+        http_session=http_sessions.get("auth"),
+        jwks_cache_ttl=JWKS_CACHE_TTL,
+        claims_cache=claims_cache,
+        obo_max_workers=AUTH_OBO_MAX_WORKERS,
+        group_cache=group_cache,
+        known_acl_groups=known_acl_groups,
+        path_auth_cache=path_auth_cache,
     )
 
+    answer_cache: Optional[AnswerCache] = None
+    if USE_ANSWER_CACHE:
+        current_app.logger.info("USE_ANSWER_CACHE is true, caching the answers of single-turn questions")
+        answer_cache = AnswerCache(max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl=ANSWER_CACHE_TTL)
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+
+    semantic_cache: Optional[SemanticAnswerCache] = None
+    if USE_SEMANTIC_CACHE:
+        current_app.logger.info("USE_SEMANTIC_CACHE is true, reusing the answers of similar questions")
+        semantic_cache = SemanticAnswerCache(
+            threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL
+        )
+    current_app.config[CONFIG_SEMANTIC_CACHE] = semantic_cache
+
+    # Merge the deltas of the streamed answers into fewer frames, disabled when both settings are 0
+    delta_coalescer: Optional[DeltaCoalescer] = None
+    if STREAM_COALESCE_WINDOW_MS > 0 or STREAM_COALESCE_MAX_CHARS > 0:
+        current_app.logger.info(
+            "Coalescing streamed deltas for %s ms or %s characters",
+            STREAM_COALESCE_WINDOW_MS,
+            STREAM_COALESCE_MAX_CHARS,
+        )
+        delta_coalescer = DeltaCoalescer(window=STREAM_COALESCE_WINDOW_MS / 1000, max_chars=STREAM_COALESCE_MAX_CHARS)
+    current_app.config[CONFIG_DELTA_COALESCER] = delta_coalescer
+
+    # Count the tokens of the streamed answers, and the tokens saved by cancelling the answers on disconnect
+    stream_tracker = StreamTracker()
+    current_app.config[CONFIG_STREAM_TRACKER] = stream_tracker
+
+    # Load the tokenizer of each model once, for the truncation of the chat history
+    tokenizer_registry = TokenizerRegistry()
+    current_app.config[CONFIG_TOKENIZER_REGISTRY] = tokenizer_registry
+    # Cache the token counts of the messages, set TOKEN_COUNT_CACHE_MAX_ENTRIES to 0 to disable it
+    token_count_cache = (
+        TokenCountCache(max_entries=TOKEN_COUNT_CACHE_MAX_ENTRIES) if TOKEN_COUNT_CACHE_MAX_ENTRIES > 0 else None
+    )
+    current_app.config[CONFIG_TOKEN_COUNT_CACHE] = token_count_cache
+
+    # Limit the concurrent calls to each upstream service, so that bursts wait in a bounded queue or fail fast
+    admission_controllers: dict[str, AdmissionController] = {
+        upstream: AdmissionController(
+            upstream,
+            max_concurrency,
+            max_queue=ADMISSION_QUEUE_SIZE,
+            queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+            max_hold_time=ADMISSION_STREAM_MAX_SECONDS,
+        )
+        for upstream, max_concurrency in ADMISSION_MAX_CONCURRENCY.items()
+        if max_concurrency > 0
+    }
+    current_app.config[CONFIG_ADMISSION_CONTROLLERS] = admission_controllers
+
+    # Stop calling the upstream services that are failing or too slow, so that the requests fail fast or use a fallback
+    circuit_breakers: dict[str, CircuitBreaker] = {}
+    if CIRCUIT_BREAKER_FAILURE_RATE > 0:
+        circuit_breakers = {
+            upstream: CircuitBreaker(
+                upstream,
+                failure_rate_threshold=CIRCUIT_BREAKER_FAILURE_RATE,
+                slow_call_duration=CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+                window_size=CIRCUIT_BREAKER_WINDOW_SIZE,
+                min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+                open_duration=CIRCUIT_BREAKER_OPEN_SECONDS,
+            )
+            for upstream in ("openai", "hf", "search", "vision")
+        }
+    current_app.config[CONFIG_CIRCUIT_BREAKERS] = circuit_breakers
+
     if USE_USER_UPLOAD:
         current_app.logger.info("USE_USER_UPLOAD is true, setting up user upload feature")
         if not AZURE_USERSTORAGE_ACCOUNT or not AZURE_USERSTORAGE_CONTAINER:
@@ -664,6 +899,12 @@ async def setup_clients():
         ingester = UploadUserFileStrategy(
             search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
         )
+        if answer_cache is not None:
+            ingester.add_index_change_listener(answer_cache.invalidate)
+        if semantic_cache is not None:
+            ingester.add_index_change_listener(semantic_cache.invalidate)
+        if path_auth_cache is not None:
+            ingester.add_index_change_listener(path_auth_cache.clear)
         current_app.config[CONFIG_INGESTER] = ingester
 
     # Used by the OpenAI SDK
@@ -711,6 +952,9 @@ async def setup_clients():
             organization=OPENAI_ORGANIZATION,
         )
 
+    openai_client.admission_controller = admission_controllers.get("openai")
+    openai_client.stream_admission_controller = admission_controllers.get("openai_streams")
+    openai_client.circuit_breaker = circuit_breakers.get("openai")
     emb_client = openai_client
     current_model: str
 
@@ -728,22 +972,44 @@ async def setup_clients():
             f"DEFAULT_MODEL must be set to a supported model from\
                          {available_models.keys()}.\nCurrent model is set to {current_model}"
         )
+    if CIRCUIT_BREAKER_FALLBACK_MODEL and CIRCUIT_BREAKER_FALLBACK_MODEL not in available_models:
+        raise ValueError(
+            f"CIRCUIT_BREAKER_FALLBACK_MODEL must be set to a supported model from {available_models.keys()}"
+        )
+
+    # Parse the Prompty templates once, they are shared by all the requests
+    prompt_templates = PromptTemplateRegistry(available_models)
+
+    # Cache the embeddings of the search queries, set EMBEDDING_CACHE_MAX_ENTRIES to 0 to disable it
+    embedding_cache = (
+        EmbeddingCache(max_entries=EMBEDDING_CACHE_MAX_ENTRIES, ttl=EMBEDDING_CACHE_TTL)
+        if EMBEDDING_CACHE_MAX_ENTRIES > 0
+        else None
+    )
 
     if not HUGGINGFACE_API_KEY:
         raise ValueError("HUGGINGFACE_API_KEY must be set if you want to use full capabilities.")
     else:
         login(token=HUGGINGFACE_API_KEY)
         hf_client = HuggingFaceClient(token=HUGGINGFACE_API_KEY)
+        hf_client.admission_controller = admission_controllers.get("hf")
+        hf_client.stream_admission_controller = admission_controllers.get("hf_streams")
+        hf_client.circuit_breaker = circuit_breakers.get("hf")
 
     llm_clients: dict[str, LLMClient] = {"openai": openai_client, "hf": hf_client}
 
-    prompt_protection = PromptProtection(injection_protection_enabled=USE_INJECTION_PROTECTION)
+    prompt_protection = PromptProtection(
+        injection_protection_enabled=USE_INJECTION_PROTECTION,
+        skip_injection_protection_when_unavailable=SKIP_INJECTION_PROTECTION_WHEN_UNAVAILABLE,
+    )
 
     current_app.config[CONFIG_LLM_CLIENTS] = llm_clients
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_CURRENT_MODEL] = current_model
     current_app.config[CONFIG_PROMPT_PROTECTION] = prompt_protection.protections
     current_app.config[CONFIG_AVAILABLE_MODELS] = available_models
+    current_app.config[CONFIG_PROMPT_TEMPLATES] = prompt_templates
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
@@ -763,10 +1029,16 @@ async def setup_clients():
         auth_helper=auth_helper,
         current_model=current_model,
         available_models=available_models,
+        prompt_templates=prompt_templates,
         prompt_protection=prompt_protection,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
         embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+        embedding_cache=embedding_cache,
+        semantic_cache=semantic_cache,
+        search_admission=admission_controllers.get("search"),
+        search_breaker=circuit_breakers.get("search"),
+        fallback_model=CIRCUIT_BREAKER_FALLBACK_MODEL,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
@@ -779,10 +1051,21 @@ async def setup_clients():
         auth_helper=auth_helper,
         current_model=current_model,
         available_models=available_models,
+        prompt_templates=prompt_templates,
         prompt_protection=prompt_protection,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
         embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+        embedding_cache=embedding_cache,
+        semantic_cache=semantic_cache,
+        speculative_retrieval=USE_SPECULATIVE_RETRIEVAL,
+        delta_coalescer=delta_coalescer,
+        stream_tracker=stream_tracker,
+        tokenizer_registry=tokenizer_registry,
+        token_count_cache=token_count_cache,
+        search_admission=admission_controllers.get("search"),
+        search_breaker=circuit_breakers.get("search"),
+        fallback_model=CIRCUIT_BREAKER_FALLBACK_MODEL,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
@@ -794,6 +1077,10 @@ async def setup_clients():
         if not AZURE_OPENAI_GPT4V_MODEL:
             raise ValueError("AZURE_OPENAI_GPT4V_MODEL must be set when USE_GPT4V is true")
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
+        http_session = http_sessions.get("vision")
+        # Cache the page images sent to GPT-4V, set IMAGE_CACHE_MAX_BYTES to 0 to disable it
+        image_cache = ImageCache(max_bytes=IMAGE_CACHE_MAX_BYTES) if IMAGE_CACHE_MAX_BYTES > 0 else None
+        current_app.config[CONFIG_IMAGE_CACHE] = image_cache
 
         current_app.config[CONFIG_ASK_VISION_APPROACH] = RetrieveThenReadVisionApproach(
             search_client=search_client,
@@ -803,6 +1090,12 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_session,
+            image_cache=image_cache,
+            search_admission=admission_controllers.get("search"),
+            vision_admission=admission_controllers.get("vision"),
+            search_breaker=circuit_breakers.get("search"),
+            vision_breaker=circuit_breakers.get("vision"),
             current_model=current_model,
             available_models=available_models,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
@@ -810,6 +1103,7 @@ async def setup_clients():
             embedding_model=OPENAI_EMB_MODEL,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+            embedding_cache=embedding_cache,
             sourcepage_field=KB_FIELDS_SOURCEPAGE,
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
@@ -824,17 +1118,29 @@ async def setup_clients():
             auth_helper=auth_helper,
             vision_endpoint=AZURE_VISION_ENDPOINT,
             vision_token_provider=token_provider,
+            http_session=http_session,
+            image_cache=image_cache,
+            search_admission=admission_controllers.get("search"),
+            vision_admission=admission_controllers.get("vision"),
+            search_breaker=circuit_breakers.get("search"),
+            vision_breaker=circuit_breakers.get("vision"),
             current_model=current_model,
             available_models=available_models,
+            prompt_templates=prompt_templates,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
             embedding_model=OPENAI_EMB_MODEL,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             embedding_dimensions=OPENAI_EMB_DIMENSIONS,
+            embedding_cache=embedding_cache,
             sourcepage_field=KB_FIELDS_SOURCEPAGE,
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            delta_coalescer=delta_coalescer,
+            stream_tracker=stream_tracker,
+            tokenizer_registry=tokenizer_registry,
+            token_count_cache=token_count_cache,
         )
 
 
@@ -844,10 +1150,15 @@ async def close_clients():
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_HTTP_SESSIONS):
+        await current_app.config[CONFIG_HTTP_SESSIONS].close()
+    if current_app.config.get(CONFIG_AUTH_CLIENT):
+        await current_app.config[CONFIG_AUTH_CLIENT].close()
 
 
 def create_app():
     app = Quart(__name__)
+    app.json = JSONProvider(app)
     app.register_blueprint(bp)
 
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
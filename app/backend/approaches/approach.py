@@ -1,3 +1,5 @@
+import asyncio
+import logging
 import os
 from abc import ABC
 from dataclasses import dataclass
@@ -9,6 +11,7 @@ from typing import (
     List,
     Optional,
     TypedDict,
+    TypeVar,
     cast,
 )
 from urllib.parse import urljoin
@@ -24,9 +27,17 @@ from azure.search.documents.models import (
 from openai.types.chat import ChatCompletionMessageParam
 
 from api_wrappers import LLMClient
+from core.admission import AdmissionController, admit
 from core.authentication import AuthenticationHelper
+from core.circuitbreaker import CircuitBreaker, protect
+from core.embeddingcache import EmbeddingCache
+from core.promptprotection import PromptProtection
+from error import CircuitOpenError, PromptProtectionError
+from templates.supported_models import ModelConfig
 from text import nonewlines
 
+T = TypeVar("T")
+
 
 @dataclass
 class Document:
@@ -90,7 +101,50 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+@dataclass(frozen=True)
+class ExecutionContext:
+    """The model and the prompt protection settings of a request, resolved once when the request starts.
+
+    The approaches are shared by the concurrent requests of a worker, so the settings sent with a request are kept
+    in its context instead of being assigned to the approach, and requests for different models do not interfere.
+
+    Attributes:
+        model_name (str): The name of the model, e.g. "GPT 3.5 Turbo".
+        model_config (ModelConfig): The configuration of the model, used to get its templates.
+        llm_client (LLMClient): The client of the API serving the model.
+        prompt_protection (Optional[PromptProtection]): The protection mechanisms to check the user message with.
+    """
+
+    model_name: str
+    model_config: ModelConfig
+    llm_client: LLMClient
+    prompt_protection: Optional[PromptProtection] = None
+
+
+def is_circuit_open(llm_client: LLMClient) -> bool:
+    return llm_client.circuit_breaker is not None and llm_client.circuit_breaker.is_open
+
+
 class Approach(ABC):
+    # Fields of the search index read by the approach. The vectors are large and only shown in the thought process,
+    # so they are only requested for debugging, and the access control fields only exist when they are enabled.
+    SEARCH_FIELDS = ["id", "content", "category", "sourcepage", "sourcefile"]
+    ACL_FIELDS = ["oids", "groups"]
+    VECTOR_FIELDS = ["embedding"]
+    # The default model of the approach, the models that the requests can select, and the prompt protection
+    current_model: str
+    available_models: dict[str, ModelConfig]
+    prompt_protection: Optional[PromptProtection] = None
+    # Limit the concurrent calls of the worker to Azure AI Search and Azure AI Vision
+    search_admission: Optional[AdmissionController] = None
+    vision_admission: Optional[AdmissionController] = None
+    # Stop calling Azure AI Search and Azure AI Vision while they are failing. Without Vision, the image vectors are
+    # dropped and the documents are retrieved with the text only
+    search_breaker: Optional[CircuitBreaker] = None
+    vision_breaker: Optional[CircuitBreaker] = None
+    # The model used instead of the requested model while the circuit of the client of the requested model is open
+    fallback_model: Optional[str] = None
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -102,9 +156,11 @@ class Approach(ABC):
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         embedding_dimensions: int,
+        embedding_cache: Optional[EmbeddingCache],
         openai_host: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession] = None,
     ):
         self.search_client = search_client
         self.llm_clients = llm_clients
@@ -115,9 +171,51 @@ class Approach(ABC):
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
         self.openai_host = openai_host
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
+
+    def get_execution_context(self, overrides: dict[str, Any]) -> ExecutionContext:
+        """Resolve the model and the prompt protection settings of a request.
+
+        The fallback model is used instead of the selected model while the circuit breaker of the client of the
+        selected model is open, if the circuit of the fallback model is not open too.
+
+        Args:
+            overrides (dict[str, Any]): The overrides sent with the request, which can select the model with
+                `set_model` and enable or disable protection mechanisms with `prompt_protection`.
+
+        Returns:
+            ExecutionContext: The context of the request.
+
+        Raises:
+            ValueError: If the model is not supported, or a protection mechanism is not registered.
+        """
+        model_name = overrides.get("set_model")
+        if model_name is None:
+            model_name = self.current_model
+        model_config = self.available_models.get(model_name)
+        if not model_config:
+            raise ValueError(f"Model {model_name} is not supported. Please create a template for this model.")
+        llm_client = self.llm_clients[model_config.type]
+        if self.fallback_model is not None and self.fallback_model != model_name and is_circuit_open(llm_client):
+            fallback_config = self.available_models[self.fallback_model]
+            fallback_client = self.llm_clients[fallback_config.type]
+            if not is_circuit_open(fallback_client):
+                logging.warning("The circuit of %s is open, using %s instead", model_name, self.fallback_model)
+                model_name, model_config, llm_client = self.fallback_model, fallback_config, fallback_client
+        return ExecutionContext(
+            model_name=model_name,
+            model_config=model_config,
+            llm_client=llm_client,
+            prompt_protection=(
+                self.prompt_protection.with_overrides(overrides.get("prompt_protection"))
+                if self.prompt_protection is not None
+                else None
+            ),
+        )
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
         exclude_category = overrides.get("exclude_category")
@@ -141,61 +239,84 @@ class Approach(ABC):
         use_semantic_captions: bool,
         minimum_search_score: Optional[float],
         minimum_reranker_score: Optional[float],
+        include_vectors: bool = False,
     ) -> List[Document]:
-        search_text = query_text if use_text_search else ""
+        # Without query vectors, e.g. while the circuit of Azure AI Vision is open, the text of the query is searched
+        search_text = query_text if use_text_search or (use_vector_search and not vectors) else ""
         search_vectors = vectors if use_vector_search else []
-        if use_semantic_ranker:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=search_vectors,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                semantic_query=query_text,
-            )
-        else:
-            results = await self.search_client.search(
-                search_text=search_text,
-                filter=filter,
-                top=top,
-                vector_queries=search_vectors,
-            )
+        select = self.get_search_fields(include_vectors)
+        # The slot is held while the pages of the results are read, as each page is a call to the service
+        async with admit(self.search_admission), protect(self.search_breaker):
+            if use_semantic_ranker:
+                results = await self.search_client.search(
+                    search_text=search_text,
+                    filter=filter,
+                    top=top,
+                    select=select,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=search_vectors,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    semantic_query=query_text,
+                )
+            else:
+                results = await self.search_client.search(
+                    search_text=search_text,
+                    filter=filter,
+                    top=top,
+                    select=select,
+                    vector_queries=search_vectors,
+                )
 
-        documents = []
-        async for page in results.by_page():
-            async for document in page:
-                documents.append(
-                    Document(
-                        id=document.get("id"),
-                        content=document.get("content"),
-                        embedding=document.get("embedding"),
-                        image_embedding=document.get("imageEmbedding"),
-                        category=document.get("category"),
-                        sourcepage=document.get("sourcepage"),
-                        sourcefile=document.get("sourcefile"),
-                        oids=document.get("oids"),
-                        groups=document.get("groups"),
-                        captions=cast(List[QueryCaptionResult], document.get("@search.captions")),
-                        score=document.get("@search.score"),
-                        reranker_score=document.get("@search.reranker_score"),
+            documents = []
+            async for page in results.by_page():
+                async for document in page:
+                    documents.append(
+                        Document(
+                            id=document.get("id"),
+                            content=document.get("content"),
+                            embedding=document.get("embedding"),
+                            image_embedding=document.get("imageEmbedding"),
+                            category=document.get("category"),
+                            sourcepage=document.get("sourcepage"),
+                            sourcefile=document.get("sourcefile"),
+                            oids=document.get("oids"),
+                            groups=document.get("groups"),
+                            captions=cast(List[QueryCaptionResult], document.get("@search.captions")),
+                            score=document.get("@search.score"),
+                            reranker_score=document.get("@search.reranker_score"),
+                        )
                     )
-                )
 
-            qualified_documents = [
-                doc
-                for doc in documents
-                if (
-                    (doc.score or 0) >= (minimum_search_score or 0)
-                    and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
-                )
-            ]
+        qualified_documents = [
+            doc
+            for doc in documents
+            if (
+                (doc.score or 0) >= (minimum_search_score or 0)
+                and (doc.reranker_score or 0) >= (minimum_reranker_score or 0)
+            )
+        ]
 
         return qualified_documents
 
+    def get_search_fields(self, include_vectors: bool = False) -> List[str]:
+        fields = list(self.SEARCH_FIELDS)
+        if self.auth_helper is not None and self.auth_helper.has_auth_fields:
+            fields += self.ACL_FIELDS
+        if include_vectors:
+            fields += self.VECTOR_FIELDS
+        return fields
+
+    def preauthorize_citations(self, results: List[Document], auth_claims: dict[str, Any]):
+        """Let the user open the sources of the results without another access check.
+
+        The results were retrieved with the security filter of the user, so the user can access their sources.
+        """
+        paths = [path for result in results for path in (result.sourcepage, result.sourcefile) if path]
+        self.auth_helper.preauthorize_paths(auth_claims, paths)
+
     def get_sources_content(
         self, results: List[Document], use_semantic_captions: bool, use_image_citation: bool
     ) -> list[str]:
@@ -237,13 +358,20 @@ class Approach(ABC):
         dimensions_args: ExtraArgs = (
             {"dimensions": self.embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[self.embedding_model] else {}
         )
-        embedding = await self.emb_client.create_embeddings(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-            **dimensions_args,
+        cache_key = EmbeddingCache.make_key(
+            self.embedding_model, self.embedding_deployment, dimensions_args.get("dimensions"), q
         )
-        query_vector = embedding.data[0].embedding
+        query_vector = self.embedding_cache.get_vector(cache_key) if self.embedding_cache is not None else None
+        if query_vector is None:
+            embedding = await self.emb_client.create_embeddings(
+                # Azure OpenAI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=q,
+                **dimensions_args,
+            )
+            query_vector = embedding.data[0].embedding
+            if self.embedding_cache is not None:
+                self.embedding_cache.set_vector(cache_key, query_vector)
         return VectorizedQuery(vector=query_vector, k_nearest_neighbors=50, fields="embedding")
 
     async def compute_image_embedding(self, q: str):
@@ -254,14 +382,86 @@ class Approach(ABC):
 
         headers["Authorization"] = "Bearer " + await self.vision_token_provider()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        if self.http_session is None:
+            raise ValueError("An HTTP session is required to compute image embeddings.")
+        async with admit(self.vision_admission), protect(self.vision_breaker), self.http_session.post(
+            url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+        ) as response:
+            json = await response.json()
+            image_query_vector = json["vector"]
         return VectorizedQuery(vector=image_query_vector, k_nearest_neighbors=50, fields="imageEmbedding")
 
+    async def compute_vectors(self, q: str, vector_fields: List[str]) -> List[VectorQuery]:
+        """Compute the query vectors of the given fields concurrently.
+
+        The text embedding comes from the embeddings model and the image embedding from Azure AI Vision,
+        so a failure of one of the services only drops the vector of its field. The error is raised
+        if no vector could be computed at all, unless the circuits of the services are open: the
+        documents are then retrieved with the text of the query only.
+
+        Args:
+            q (str): The query to vectorize.
+            vector_fields (List[str]): The vector fields to search, "embedding" and/or "imageEmbedding".
+
+        Returns:
+            List[VectorQuery]: The vectors that could be computed, in the order of the fields.
+        """
+        results = await asyncio.gather(
+            *(
+                self.compute_text_embedding(q) if field == "embedding" else self.compute_image_embedding(q)
+                for field in vector_fields
+            ),
+            return_exceptions=True,
+        )
+        vectors: List[VectorQuery] = []
+        errors: List[BaseException] = []
+        for field, result in zip(vector_fields, results):
+            if isinstance(result, BaseException):
+                logging.warning("Failed to compute the query vector for field %s: %s", field, result)
+                errors.append(result)
+            else:
+                vectors.append(result)
+        if errors and not vectors and not all(isinstance(error, CircuitOpenError) for error in errors):
+            raise errors[0]
+        return vectors
+
+    async def run_with_prompt_protection(
+        self, prompt_protection: Optional[PromptProtection], message: str, step: Awaitable[T]
+    ) -> T:
+        """Run a step of the request concurrently with the prompt protection checks of the user message.
+
+        The result of the step is only returned once all the checks succeeded, so the following steps,
+        such as retrieval and the answer generation, are gated on the verdict of the checks.
+
+        Args:
+            prompt_protection (Optional[PromptProtection]): The protection mechanisms to check the message with,
+                or None to only run the step.
+            message (str): The message of the user.
+            step (Awaitable[T]): The step to run while the message is being checked, e.g. the query rewrite.
+
+        Returns:
+            T: The result of the step.
+
+        Raises:
+            PromptProtectionError: If one of the protection mechanisms detected an exploit.
+                The step is cancelled if it is still running.
+        """
+        if prompt_protection is None:
+            return await step
+        step_task = asyncio.ensure_future(step)
+        try:
+            if not await prompt_protection.check_all_exploits(message=message, llm_client=self.llm_clients["hf"]):
+                raise PromptProtectionError(
+                    message="Prompt contains an exploit, the application has terminated.", code="content_filter"
+                )
+            return await step_task
+        finally:
+            if not step_task.done():
+                step_task.cancel()
+            elif not step_task.cancelled():
+                # Mark the error of a step that failed while the check was running as retrieved
+                step_task.exception()
+
     async def run(
         self,
         messages: list[ChatCompletionMessageParam],
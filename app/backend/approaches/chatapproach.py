@@ -1,14 +1,19 @@
+import asyncio
 import json
 import re
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Dict, Optional, Union, cast
+from typing import Any, AsyncGenerator, Coroutine, Dict, Optional, Union, cast
 
 from huggingface_hub.inference._generated.types import (  # type: ignore
     ChatCompletionOutput,
 )
 from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 
-from approaches.approach import Approach
+from approaches.approach import Approach, ThoughtStep
+from core.deltacoalescer import DeltaCoalescer
+from core.jsonserializer import to_jsonable
+from core.semanticcache import PartitionKey, SemanticAnswerCache, SemanticCacheHit
+from core.streamtracker import StreamTracker, close_stream
 
 
 class ChatApproach(Approach, ABC):
@@ -19,6 +24,10 @@ class ChatApproach(Approach, ABC):
         {"role": "assistant", "content": "Show available health plans"},
     ]
     NO_RESPONSE = "0"
+    # Merges the deltas of the streamed answers into fewer frames, if set
+    delta_coalescer: Optional[DeltaCoalescer] = None
+    # Counts the tokens of the streamed answers and the tokens saved by cancelling them, if set
+    stream_tracker: Optional[StreamTracker] = None
 
     follow_up_questions_prompt_content = """Generate 3 very brief follow-up questions that the user would likely ask next.
     Enclose the follow-up questions in double angle brackets. Example:
@@ -84,6 +93,84 @@ class ChatApproach(Approach, ABC):
                 return query_text
         return user_query
 
+    def get_cached_final_call(
+        self, hit: SemanticCacheHit, should_stream: bool
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Any]]:
+        """Build the result of `run_until_final_call` from an answer of the semantic cache.
+
+        The cached completion has the same shape as a dict-style chat completion, or stream of chunks,
+        so the follow-up questions are extracted the same way as for a live answer.
+        """
+        cached_extra_info = hit.entry.answer["extra_info"]
+        content = hit.entry.answer["content"]
+        extra_info = {
+            **cached_extra_info,
+            "thoughts": [
+                *cached_extra_info["thoughts"],
+                ThoughtStep(
+                    "Answer reused from the semantic cache",
+                    hit.entry.question,
+                    {"similarity": round(hit.similarity, 4)},
+                ),
+            ],
+        }
+
+        async def cached_stream():
+            yield {"choices": [{"delta": {"role": "assistant", "content": content}, "index": 0}]}
+
+        async def cached_completion():
+            if should_stream:
+                return cached_stream()
+            return {
+                "choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": "stop", "index": 0}]
+            }
+
+        return (extra_info, cached_completion())
+
+    def cache_final_call(
+        self,
+        semantic_cache: SemanticAnswerCache,
+        partition_key: PartitionKey,
+        vector: list[float],
+        question: str,
+        extra_info: dict[str, Any],
+        chat_coroutine: Coroutine[Any, Any, Any],
+        should_stream: bool,
+    ) -> Coroutine[Any, Any, Any]:
+        """Wrap the final chat completion call to store its answer in the semantic cache once it completed."""
+
+        def get_field(obj: Any, name: str) -> Any:
+            # OpenAI uses pydantic models, huggingface-hub uses dataclasses and the mocks use dicts
+            return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+        def store(content: str):
+            semantic_cache.set(partition_key, vector, question, {"content": content, "extra_info": extra_info})
+
+        async def cached_stream(stream):
+            content = []
+            try:
+                async for event in stream:
+                    yield event
+                    choices = get_field(event, "choices")
+                    if choices and (delta_content := get_field(get_field(choices[0], "delta"), "content")):
+                        content.append(delta_content)
+            except BaseException:
+                # The answer is not stored when it is cancelled, and the stream is closed with the wrapper
+                await close_stream(stream)
+                raise
+            store("".join(content))
+
+        async def cached_completion():
+            response = await chat_coroutine
+            if should_stream:
+                return cached_stream(response)
+            content = get_field(get_field(get_field(response, "choices")[0], "message"), "content")
+            if content is not None:
+                store(content)
+            return response
+
+        return cached_completion()
+
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
 
@@ -128,33 +215,65 @@ class ChatApproach(Approach, ABC):
         extra_info, chat_coroutine = await self.run_until_final_call(
             messages, overrides, auth_claims, should_stream=True
         )
-        yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
 
-        followup_questions_started = False
+        stream = None
+        tokens = 0
         followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            # Convert pydantic model to dict if needed
-            event = event_chunk.model_dump() if hasattr(event_chunk, "model_dump") else event_chunk
-            # OpenAI uses dict-style access, while huggingface-hub uses dataclasses since 0.25.0
-            if (hasattr(event, "choices") and event.choices) or event.get("choices"):
-                completion = {
-                    "delta": event.choices[0].delta if hasattr(event, "choices") else event["choices"][0]["delta"]
-                }
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = completion["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        completion["delta"]["content"] = earlier_content
+
+        async def answer_deltas() -> AsyncGenerator[dict, None]:
+            nonlocal stream, tokens, followup_content
+            followup_questions_started = False
+            stream = await chat_coroutine
+            async for event_chunk in stream:
+                # OpenAI uses pydantic models, huggingface-hub uses dataclasses that subclass dict and the caches use dicts
+                choices = event_chunk.choices if hasattr(event_chunk, "choices") else event_chunk["choices"]
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                if choices:
+                    delta = choices[0].delta if hasattr(choices[0], "delta") else choices[0]["delta"]
+                    # Only the delta is converted to a dict, with the encoder of its type compiled by the serializer
+                    completion = {"delta": delta if isinstance(delta, dict) else to_jsonable(delta)}
+                    # if event contains << and not >>, it is start of follow-up question, truncate
+                    content = completion["delta"].get("content")
+                    content = content or ""  # content may either not exist in delta, or explicitly be None
+                    if content:
+                        tokens += 1
+                    if overrides.get("suggest_followup_questions") and "<<" in content:
+                        followup_questions_started = True
+                        earlier_content = content[: content.index("<<")]
+                        if earlier_content:
+                            completion["delta"]["content"] = earlier_content
+                            yield completion
+                        followup_content += content[content.index("<<") :]
+                    elif followup_questions_started:
+                        followup_content += content
+                    else:
                         yield completion
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
+
+        # The follow-up questions are extracted from the deltas before they are coalesced
+        completions = answer_deltas()
+        if self.delta_coalescer is not None and overrides.get("coalesce_deltas", True):
+            completions = self.delta_coalescer.coalesce(completions)
+        completed = False
+        try:
+            yield {"delta": {"role": "assistant"}, "context": extra_info, "session_state": session_state}
+            async for completion in completions:
+                yield completion
+            completed = True
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client disconnected: the generator is closed, or the task of the request is cancelled
+            if self.stream_tracker is not None:
+                self.stream_tracker.record_cancelled(tokens)
+            raise
+        finally:
+            if not completed:
+                # Stop reading the answer, and close the stream so that the model stops generating it
+                await completions.aclose()
+                if stream is None:
+                    chat_coroutine.close()
                 else:
-                    yield completion
+                    await close_stream(stream)
+        if self.stream_tracker is not None:
+            self.stream_tracker.record_completed(tokens)
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {"delta": {"role": "assistant"}, "context": {"followup_questions": followup_questions}}
@@ -1,4 +1,6 @@
-import ast
+import asyncio
+import logging
+import re
 from typing import (
     Any,
     AsyncIterable,
@@ -21,17 +23,26 @@ from openai.types.chat import (
     ChatCompletionChunk,
     ChatCompletionMessageParam,
 )
-from promptflow.core import Prompty  # type: ignore
 
 from api_wrappers import LLMClient
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
+from core.circuitbreaker import CircuitBreaker
+from core.deltacoalescer import DeltaCoalescer
+from core.embeddingcache import EmbeddingCache
 from core.messageshelper import build_past_messages
 from core.promptprotection import PromptProtection
-from error import PromptProtectionError
+from core.semanticcache import SemanticAnswerCache
+from core.streamtracker import StreamTracker
+from core.tokencountcache import TokenCountCache
+from core.tokenizers import TokenizerRegistry
+from templates.prompt_registry import PromptTemplateRegistry
 from templates.supported_models import ModelConfig
 
+logger = logging.getLogger("chatreadretrieveread")
+
 
 class ChatReadRetrieveReadApproach(ChatApproach):
     """
@@ -40,6 +51,9 @@ class ChatReadRetrieveReadApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    # Minimum share of the words of the rewritten query found in the question to reuse the speculative search
+    SPECULATIVE_QUERY_MIN_OVERLAP = 0.8
+
     def __init__(
         self,
         *,
@@ -49,10 +63,21 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         emb_client: LLMClient,
         current_model: str,
         available_models: dict[str, ModelConfig],
+        prompt_templates: PromptTemplateRegistry,
         prompt_protection: PromptProtection,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         embedding_dimensions: int,
+        embedding_cache: Optional[EmbeddingCache],
+        semantic_cache: Optional[SemanticAnswerCache],
+        speculative_retrieval: bool = False,
+        delta_coalescer: Optional[DeltaCoalescer] = None,
+        stream_tracker: Optional[StreamTracker] = None,
+        tokenizer_registry: Optional[TokenizerRegistry] = None,
+        token_count_cache: Optional[TokenCountCache] = None,
+        search_admission: Optional[AdmissionController] = None,
+        search_breaker: Optional[CircuitBreaker] = None,
+        fallback_model: Optional[str] = None,
         sourcepage_field: str,
         content_field: str,
         query_language: str,
@@ -64,10 +89,21 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.auth_helper = auth_helper
         self.current_model = current_model
         self.available_models = available_models
+        self.prompt_templates = prompt_templates
         self.prompt_protection = prompt_protection
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
+        self.semantic_cache = semantic_cache
+        self.speculative_retrieval = speculative_retrieval
+        self.delta_coalescer = delta_coalescer
+        self.stream_tracker = stream_tracker
+        self.tokenizer_registry = tokenizer_registry or TokenizerRegistry()
+        self.token_count_cache = token_count_cache
+        self.search_admission = search_admission
+        self.search_breaker = search_breaker
+        self.fallback_model = fallback_model
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
@@ -83,6 +119,26 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         {injected_prompt}
         """
 
+    def is_similar_search_query(self, search_query: str, user_query: str) -> bool:
+        """Check whether the results of searching the user question can be used for the rewritten search query.
+
+        Rewritten first questions are usually the question without the stop words, so the queries are considered
+        similar when almost all the words of the rewritten query appear in the question.
+        """
+        search_words = set(re.findall(r"\w+", search_query.lower()))
+        if not search_words:
+            return False
+        user_words = set(re.findall(r"\w+", user_query.lower()))
+        return len(search_words & user_words) / len(search_words) >= self.SPECULATIVE_QUERY_MIN_OVERLAP
+
+    @staticmethod
+    def discard_speculative_retrieval(speculative_retrieval: "asyncio.Future[Any]"):
+        """Cancel a speculative retrieval whose results are not used, marking its error as retrieved if it failed."""
+        if not speculative_retrieval.done():
+            speculative_retrieval.cancel()
+        elif not speculative_retrieval.cancelled():
+            speculative_retrieval.exception()
+
     @overload
     async def run_until_final_call(
         self,
@@ -128,103 +184,133 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
+        # Vectors are only returned by the search for debugging, as they are only shown in the thought process
+        include_vectors = bool(overrides.get("include_vectors"))
         filter = self.build_filter(overrides, auth_claims)
 
-        model_change = overrides.get("set_model")
-        if model_change is not None:
-            self.current_model = model_change
-
-        model_config = self.available_models.get(self.current_model)
-        if not model_config:
-            raise ValueError(f"Model {self.current_model} is not supported. Please create a template for this model.")
-
-        current_api = self.llm_clients[model_config.type]
+        # The model and protection settings of the request, which are never assigned to the shared approach
+        context = self.get_execution_context(overrides)
+        model_config = context.model_config
+        current_api = context.llm_client
         original_user_query = messages[-1]["content"]
 
         if not isinstance(original_user_query, str):
             raise ValueError("The most recent message content must be a string.")
 
-        prompt_protection_overrides = overrides.get("prompt_protection")
-        if prompt_protection_overrides:
-            for protection_name, config in prompt_protection_overrides.items():
-                self.prompt_protection.set_protection_bool(protection_name, config.get("enabled", False))
-
-        if not await self.prompt_protection.check_all_exploits(
-            message=original_user_query, llm_client=self.llm_clients["hf"]
-        ):
-            raise PromptProtectionError(
-                message="Prompt contains an exploit, the application has terminated.", code="content_filter"
-            )
-
-        # Load the Prompty objects for AI Search query and chat answer generation.
-        prompty_path = model_config.template_path
-
-        chat_prompty = Prompty.load(source=prompty_path / "chat.prompty")
-        query_prompty = Prompty.load(source=prompty_path / "query.prompty")
+        # Get the Prompty templates for AI Search query and chat answer generation.
+        chat_template = self.prompt_templates.get(model_config, "chat")
+        query_template = self.prompt_templates.get(model_config, "query")
 
         # If the parameters are overridden via the API request, use that value.
         # Otherwise, use the default value from the model configuration.
-        chat_prompty._model.parameters.update(
-            {
-                param: overrides[param]
-                for param in current_api.allowed_chat_completion_params
-                if overrides.get(param) is not None
-            }
-        )
+        chat_params = chat_template.get_parameters(overrides, current_api.allowed_chat_completion_params)
         # Shorten the past messages if needed
-        question_token_limit = chat_prompty._model.configuration.get(
-            "messages_length_limit", 4000
-        ) - chat_prompty._model.parameters.get("max_tokens", 1024)
+        question_token_limit = chat_template.configuration.get("messages_length_limit", 4000) - chat_params.get(
+            "max_tokens", 1024
+        )
 
         past_messages = build_past_messages(
             model=model_config.model_name,
-            model_type=query_prompty._model.configuration["type"],
+            tokenizer=self.tokenizer_registry.get(model_config.model_name, query_template.configuration["type"]),
             system_message=self.query_prompt_template,
             max_tokens=question_token_limit,
-            tools=query_prompty._model.parameters.get("tools"),
+            tools=self.prompt_templates.get_tools(model_config),
             new_user_content=original_user_query,
             few_shots=self.query_prompt_few_shots,
             past_messages=messages[:-1],
+            token_counts=self.token_count_cache,
         )
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        query_messages = query_prompty.render(
+        query_messages = query_template.render_messages(
             system_message=self.query_prompt_template,
             question=original_user_query,
             few_shots=self.query_prompt_few_shots,
             past_messages=past_messages,
         )
-        query_messages = ast.literal_eval(query_messages)
 
         # If the temperature is not set in the config, use default value equal to 0.0
-        query_prompty._model.parameters.setdefault("temperature", 0.0)
-        chat_completion: Union[ChatCompletion, ChatCompletionOutput, AsyncIterable[ChatCompletionStreamOutput]] = (
-            await current_api.chat_completion(
-                messages=query_messages,  # type: ignore
-                model=(model_config.identifier),
-                **query_prompty._model.parameters,
-                n=1,
+        query_params = query_template.get_parameters()
+        query_params.setdefault("temperature", 0.0)
+
+        # If retrieval mode includes vectors, compute an embedding for the query
+        async def compute_vectors(query_text: str) -> list[VectorQuery]:
+            return [await self.compute_text_embedding(query_text)] if use_vector_search else []
+
+        async def search(query_text: str, vectors: list[VectorQuery]):
+            return await self.search(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_text_search,
+                use_vector_search,
+                use_semantic_ranker,
+                use_semantic_captions,
+                minimum_search_score,
+                minimum_reranker_score,
+                include_vectors,
             )
-        )
+
+        async def speculate():
+            vectors = await compute_vectors(original_user_query)
+            return vectors, await search(original_user_query, vectors)
+
+        # The first question is usually close to its rewritten search query, so it can be searched speculatively
+        # while the query is being rewritten. The results are only used once the prompt protection checks passed.
+        speculative_retrieval = None
+        if overrides.get("speculative_retrieval", self.speculative_retrieval) and len(messages) == 1:
+            speculative_retrieval = asyncio.ensure_future(speculate())
+
+        # The prompt protection checks run concurrently with the query rewrite, retrieval waits for both
+        try:
+            chat_completion: Union[ChatCompletion, ChatCompletionOutput, AsyncIterable[ChatCompletionStreamOutput]] = (
+                await self.run_with_prompt_protection(
+                    context.prompt_protection,
+                    original_user_query,
+                    current_api.chat_completion(
+                        messages=query_messages,  # type: ignore
+                        model=(model_config.identifier),
+                        **query_params,
+                        n=1,
+                    ),
+                )
+            )
+        except BaseException:
+            if speculative_retrieval is not None:
+                self.discard_speculative_retrieval(speculative_retrieval)
+            raise
         query_text = self.get_search_query(chat_completion, original_user_query)
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(query_text))
-
-        results = await self.search(
-            top,
-            query_text,
-            filter,
-            vectors,
-            use_text_search,
-            use_vector_search,
-            use_semantic_ranker,
-            use_semantic_captions,
-            minimum_search_score,
-            minimum_reranker_score,
-        )
+        speculation_hit = None
+        speculative_results = None
+        if speculative_retrieval is not None:
+            speculation_hit = self.is_similar_search_query(query_text, original_user_query)
+            if speculation_hit:
+                # Only the results are reused, the rewritten query is still the one shown in the thoughts
+                try:
+                    vectors, speculative_results = await speculative_retrieval
+                except Exception:
+                    # A search with the rewritten query can still answer the question
+                    logger.warning("Speculative retrieval failed, searching with the rewritten query", exc_info=True)
+                    self.discard_speculative_retrieval(speculative_retrieval)
+                    speculation_hit = False
+            else:
+                self.discard_speculative_retrieval(speculative_retrieval)
+        if speculative_results is None:
+            vectors = await compute_vectors(query_text)
+
+        # Reuse the answer of a similar first question, asked with the same settings by a user with the same access
+        semantic_cache_key = None
+        if self.semantic_cache is not None and len(messages) == 1 and vectors:
+            semantic_cache_key = self.semantic_cache.make_partition_key(
+                type(self).__name__, context.model_name, overrides, filter
+            )
+            if hit := self.semantic_cache.get(semantic_cache_key, vectors[0].vector):
+                return self.get_cached_final_call(hit, should_stream)
+
+        results = speculative_results if speculative_results is not None else await search(query_text, vectors)
+        self.preauthorize_citations(results, auth_claims)
 
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
 
@@ -236,13 +322,12 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
         )
 
-        chat_messages = chat_prompty.render(
+        chat_messages = chat_template.render_messages(
             system_message=system_message,
             sources=sources_content,
             past_messages=past_messages,
             question=original_user_query,
         )
-        chat_messages = ast.literal_eval(chat_messages)
 
         data_points = {"text": sources_content}
 
@@ -252,7 +337,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep(
                     "Prompt to generate search query",
                     [str(message) for message in query_messages],
-                    ({"model": self.current_model}),
+                    ({"model": context.model_name}),
                 ),
                 ThoughtStep(
                     "Search using generated search query",
@@ -264,6 +349,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                         "filter": filter,
                         "use_vector_search": use_vector_search,
                         "use_text_search": use_text_search,
+                        **({"speculative_retrieval_hit": speculation_hit} if speculation_hit is not None else {}),
                     },
                 ),
                 ThoughtStep(
@@ -273,7 +359,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep(
                     "Prompt to generate answer",
                     [str(message) for message in chat_messages],
-                    ({"model": self.current_model}),
+                    ({"model": context.model_name}),
                 ),
             ],
         }
@@ -281,8 +367,18 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         chat_coroutine = current_api.chat_completion(
             model=(model_config.identifier),
             messages=chat_messages,
-            **chat_prompty._model.parameters,
+            **chat_params,
             n=1,
             stream=should_stream,
         )
+        if self.semantic_cache is not None and semantic_cache_key is not None:
+            chat_coroutine = self.cache_final_call(
+                self.semantic_cache,
+                semantic_cache_key,
+                vectors[0].vector,
+                query_text,
+                extra_info,
+                chat_coroutine,
+                should_stream,
+            )
         return (extra_info, chat_coroutine)
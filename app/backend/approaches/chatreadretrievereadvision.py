@@ -1,6 +1,6 @@
-import ast
 from typing import Any, AsyncIterable, Awaitable, Callable, Coroutine, Optional, Union
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
 from huggingface_hub.inference._generated.types import (  # type: ignore
@@ -16,14 +16,22 @@ from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 from openai_messages_token_helper import get_token_limit
-from promptflow.core import Prompty  # type: ignore
 
 from api_wrappers import LLMClient
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.circuitbreaker import CircuitBreaker
+from core.deltacoalescer import DeltaCoalescer
+from core.embeddingcache import EmbeddingCache
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_images
 from core.messageshelper import build_past_messages
+from core.streamtracker import StreamTracker
+from core.tokencountcache import TokenCountCache
+from core.tokenizers import TokenizerRegistry
+from templates.prompt_registry import PromptTemplateRegistry
 from templates.supported_models import ModelConfig
 
 
@@ -34,6 +42,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
     original user question, and search results to OpenAI to generate a response.
     """
 
+    VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
     def __init__(
         self,
         *,
@@ -44,17 +54,29 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         auth_helper: AuthenticationHelper,
         current_model: str,
         available_models: dict[str, ModelConfig],
+        prompt_templates: PromptTemplateRegistry,
         gpt4v_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         gpt4v_model: str,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         embedding_dimensions: int,
+        embedding_cache: Optional[EmbeddingCache],
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession],
+        image_cache: Optional[ImageCache],
+        delta_coalescer: Optional[DeltaCoalescer] = None,
+        stream_tracker: Optional[StreamTracker] = None,
+        tokenizer_registry: Optional[TokenizerRegistry] = None,
+        token_count_cache: Optional[TokenCountCache] = None,
+        search_admission: Optional[AdmissionController] = None,
+        vision_admission: Optional[AdmissionController] = None,
+        search_breaker: Optional[CircuitBreaker] = None,
+        vision_breaker: Optional[CircuitBreaker] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -63,17 +85,29 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.auth_helper = auth_helper
         self.current_model = current_model
         self.available_models = available_models
+        self.prompt_templates = prompt_templates
         self.gpt4v_deployment = gpt4v_deployment
         self.gpt4v_model = gpt4v_model
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
+        self.image_cache = image_cache
+        self.delta_coalescer = delta_coalescer
+        self.stream_tracker = stream_tracker
+        self.tokenizer_registry = tokenizer_registry or TokenizerRegistry()
+        self.token_count_cache = token_count_cache
+        self.search_admission = search_admission
+        self.vision_admission = vision_admission
+        self.search_breaker = search_breaker
+        self.vision_breaker = vision_breaker
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
 
     @property
@@ -119,6 +153,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
+        # Vectors are only returned by the search for debugging, as they are only shown in the thought process
+        include_vectors = bool(overrides.get("include_vectors"))
         filter = self.build_filter(overrides, auth_claims)
 
         vector_fields = overrides.get("vector_fields", ["embedding"])
@@ -136,70 +172,54 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
 
         current_api = self.llm_clients[self.available_models[self.current_model].type]
 
-        # Load the Prompty objects for AI Search query and chat answer generation.
-        prompty_path = model_config.template_path
-
-        chat_prompty = Prompty.load(source=prompty_path / "chat.prompty")
-        query_prompty = Prompty.load(source=prompty_path / "query.prompty")
+        # Get the Prompty templates for AI Search query and chat answer generation.
+        chat_template = self.prompt_templates.get(model_config, "chat")
+        query_template = self.prompt_templates.get(model_config, "query")
 
         # If the parameters are overridden via the API request, use that value.
         # Otherwise, use the default value from the model configuration.
-        chat_prompty._model.parameters.update(
-            {
-                param: overrides[param]
-                for param in current_api.allowed_chat_completion_params
-                if overrides.get(param) is not None
-            }
-        )
+        chat_params = chat_template.get_parameters(overrides, current_api.allowed_chat_completion_params)
         # Shorten the past messages if needed
-        question_token_limit = chat_prompty._model.configuration.get(
-            "messages_length_limit", 4000
-        ) - chat_prompty._model.parameters.get("max_tokens", 1024)
+        question_token_limit = chat_template.configuration.get("messages_length_limit", 4000) - chat_params.get(
+            "max_tokens", 1024
+        )
 
         past_messages = build_past_messages(
             model=model_config.model_name,
-            model_type=query_prompty._model.configuration["type"],
+            tokenizer=self.tokenizer_registry.get(model_config.model_name, query_template.configuration["type"]),
             system_message=self.query_prompt_template,
             max_tokens=question_token_limit,
-            tools=query_prompty._model.parameters.get("tools"),
+            tools=self.prompt_templates.get_tools(model_config),
             new_user_content=original_user_query,
             few_shots=self.query_prompt_few_shots,
             past_messages=messages[:-1],
+            token_counts=self.token_count_cache,
         )
-
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        query_messages = query_prompty.render(
+        query_messages = query_template.render_messages(
             system_message=self.query_prompt_template,
             question=original_user_query,
             few_shots=self.query_prompt_few_shots,
             past_messages=past_messages,
         )
-        query_messages = ast.literal_eval(query_messages)
 
-        query_prompty._model.parameters.setdefault("temperature", 0.0)
+        # If the temperature is not set in the config, use default value equal to 0.0
+        query_params = query_template.get_parameters()
+        query_params.setdefault("temperature", 0.0)
         chat_completion: Union[ChatCompletion, ChatCompletionOutput, AsyncIterable[ChatCompletionStreamOutput]] = (
             await current_api.chat_completion(
                 messages=query_messages,  # type: ignore
                 model=(model_config.identifier),
-                **query_prompty._model.parameters,
+                **query_params,
                 n=1,
             )
         )
-
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
-        if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(query_text)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(query_text)
-                )
-                vectors.append(vector)
+        vectors = await self.compute_vectors(query_text, vector_fields) if use_vector_search else []
 
         results = await self.search(
             top,
@@ -212,7 +232,9 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors,
         )
+        self.preauthorize_citations(results, auth_claims)
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
 
@@ -224,33 +246,23 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
         )
 
-        chat_messages = chat_prompty.render(
-            system_message=system_message,
-            sources=sources_content,
-            past_messages=past_messages,
-            question=original_user_query,
-        )
-        chat_messages = ast.literal_eval(chat_messages)
-
         user_content: list[ChatCompletionContentPartParam] = [{"text": original_user_query, "type": "text"}]
         image_list: list[ChatCompletionContentPartImageParam] = []
 
         if send_text_to_gptvision:
             user_content.append({"text": "\n\nSources:\n" + content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            for url in await fetch_images(self.blob_container_client, results, self.image_cache):
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
 
-        chat_messages = chat_prompty.render(  # Model should be GPT4V here.
+        chat_messages = chat_template.render_messages(  # Model should be GPT4V here.
             system_message=system_message,
             sources=sources_content,
             past_messages=past_messages,
             question=original_user_query,
         )
-        chat_messages = ast.literal_eval(chat_messages)
 
         data_points = {
             "text": sources_content,
@@ -296,7 +308,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         chat_coroutine = current_api.chat_completion(
             model=(model_config.identifier),
             messages=chat_messages,
-            **chat_prompty._model.parameters,
+            **chat_params,
             n=1,
             stream=should_stream,
         )
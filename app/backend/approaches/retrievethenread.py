@@ -1,16 +1,19 @@
-import ast
-from typing import Any, Optional
+import copy
+from typing import Any, Optional, cast
 
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorQuery
+from azure.search.documents.models import VectorizedQuery, VectorQuery
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageParam
-from promptflow.core import Prompty  # type: ignore
 
 from api_wrappers import LLMClient
 from approaches.approach import Approach, ThoughtStep
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
+from core.circuitbreaker import CircuitBreaker
+from core.embeddingcache import EmbeddingCache
 from core.promptprotection import PromptProtection
-from error import PromptProtectionError
+from core.semanticcache import SemanticAnswerCache
+from templates.prompt_registry import PromptTemplateRegistry
 from templates.supported_models import ModelConfig
 
 
@@ -61,10 +64,16 @@ class RetrieveThenReadApproach(Approach):
         emb_client: LLMClient,
         current_model: str,
         available_models: dict[str, ModelConfig],
+        prompt_templates: PromptTemplateRegistry,
         prompt_protection: PromptProtection,
         embedding_model: str,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_dimensions: int,
+        embedding_cache: Optional[EmbeddingCache],
+        semantic_cache: Optional[SemanticAnswerCache],
+        search_admission: Optional[AdmissionController] = None,
+        search_breaker: Optional[CircuitBreaker] = None,
+        fallback_model: Optional[str] = None,
         sourcepage_field: str,
         content_field: str,
         query_language: str,
@@ -75,10 +84,16 @@ class RetrieveThenReadApproach(Approach):
         self.emb_client = emb_client
         self.current_model = current_model
         self.available_models = available_models
+        self.prompt_templates = prompt_templates
         self.prompt_protection = prompt_protection
         self.auth_helper = auth_helper
         self.embedding_model = embedding_model
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
+        self.semantic_cache = semantic_cache
+        self.search_admission = search_admission
+        self.search_breaker = search_breaker
+        self.fallback_model = fallback_model
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
@@ -103,33 +118,43 @@ class RetrieveThenReadApproach(Approach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
+        # Vectors are only returned by the search for debugging, as they are only shown in the thought process
+        include_vectors = bool(overrides.get("include_vectors"))
         filter = self.build_filter(overrides, auth_claims)
 
-        if overrides.get("set_model") is not None:
-            self.current_model = overrides.get("set_model")
-
-        model_config = self.available_models.get(self.current_model)
-        if not model_config:
-            raise ValueError(f"Model {self.current_model} is not supported. Please create a template for this model.")
-
-        prompty_path = model_config.template_path
-        current_api = self.llm_clients[model_config.type]
-
-        prompt_protection_overrides = overrides.get("prompt_protection")
-        if prompt_protection_overrides:
-            for protection_name, config in prompt_protection_overrides.items():
-                self.prompt_protection.set_protection_bool(protection_name, config.get("enabled", False))
-
-        if isinstance(q, str):
-            if not await self.prompt_protection.check_all_exploits(message=q, llm_client=self.llm_clients["hf"]):
-                raise PromptProtectionError(
-                    message="Prompt contains an exploit, the application has terminated.", code="content_filter"
+        # The model and protection settings of the request, which are never assigned to the shared approach
+        execution_context = self.get_execution_context(overrides)
+        model_config = execution_context.model_config
+        current_api = execution_context.llm_client
+
+        # If retrieval mode includes vectors, compute an embedding for the query,
+        # concurrently with the prompt protection checks that retrieval waits for
+        async def compute_vectors() -> list[VectorQuery]:
+            return [await self.compute_text_embedding(q)] if use_vector_search else []
+
+        vectors = await self.run_with_prompt_protection(execution_context.prompt_protection, q, compute_vectors())
+        query_vector = cast(VectorizedQuery, vectors[0]).vector if vectors else None
+
+        # Reuse the answer of a similar question, asked with the same settings by a user with the same access
+        semantic_cache_key = None
+        if self.semantic_cache is not None and query_vector is not None:
+            semantic_cache_key = self.semantic_cache.make_partition_key(
+                type(self).__name__, execution_context.model_name, overrides, filter
+            )
+            if hit := self.semantic_cache.get(semantic_cache_key, query_vector):
+                cached_answer = copy.deepcopy(hit.entry.answer)
+                cached_answer["extra_info"]["thoughts"].append(
+                    ThoughtStep(
+                        "Answer reused from the semantic cache",
+                        hit.entry.question,
+                        {"similarity": round(hit.similarity, 4)},
+                    )
                 )
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if use_vector_search:
-            vectors.append(await self.compute_text_embedding(q))
+                return {
+                    "message": cached_answer["message"],
+                    "context": cached_answer["extra_info"],
+                    "session_state": session_state,
+                }
 
         results = await self.search(
             top,
@@ -142,40 +167,31 @@ class RetrieveThenReadApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors,
         )
+        self.preauthorize_citations(results, auth_claims)
 
         # Process results
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
 
-        # Load the Prompty object
-
-        if prompty_path:
-            ask_prompty = Prompty.load(source=prompty_path / "ask.prompty")
-        else:
-            raise ValueError(f"Model {self.current_model} is not supported. Please create a template for this model.")
+        # Get the Prompty template
+        ask_template = self.prompt_templates.get(model_config, "ask")
 
         # If the parameters are overridden via the API request, use that value.
         # Otherwise, use the default value from the model configuration.
-        ask_prompty._model.parameters.update(
-            {
-                param: overrides[param]
-                for param in current_api.allowed_chat_completion_params
-                if overrides.get(param) is not None
-            }
-        )
+        ask_params = ask_template.get_parameters(overrides, current_api.allowed_chat_completion_params)
 
-        updated_messages = ask_prompty.render(
+        updated_messages = ask_template.render_messages(
             system_message=overrides.get("prompt_template", self.system_chat_template),
             few_shots=self.few_shots,
             question=q,
             sources=sources_content,
         )
-        updated_messages = ast.literal_eval(updated_messages)
 
         chat_completion = await current_api.chat_completion(
             model=(model_config.identifier),
             messages=updated_messages,
-            **ask_prompty._model.parameters,
+            **ask_params,
             n=1,
         )
         final_result = chat_completion.model_dump() if hasattr(chat_completion, "model_dump") else chat_completion
@@ -203,7 +219,7 @@ class RetrieveThenReadApproach(Approach):
                 ThoughtStep(
                     "Prompt to generate answer",
                     [str(message) for message in updated_messages],
-                    ({"model": self.current_model}),
+                    ({"model": execution_context.model_name}),
                 ),
             ],
         }
@@ -220,5 +236,13 @@ class RetrieveThenReadApproach(Approach):
         except Exception as e:
             raise ValueError(f"Failed to retrieve message from chat completion response: {e}")
 
+        if self.semantic_cache is not None and semantic_cache_key is not None and query_vector is not None:
+            self.semantic_cache.set(
+                semantic_cache_key,
+                query_vector,
+                q,
+                copy.deepcopy({"message": completion_message, "extra_info": extra_info}),
+            )
+
         completion = {"message": completion_message, "context": extra_info, "session_state": session_state}
         return completion
@@ -1,5 +1,6 @@
 from typing import Any, Awaitable, Callable, Optional
 
+import aiohttp
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
 from openai.types.chat import (
@@ -11,8 +12,12 @@ from openai_messages_token_helper import build_messages, get_token_limit
 
 from api_wrappers import LLMClient
 from approaches.approach import Approach, ThoughtStep
+from core.admission import AdmissionController
 from core.authentication import AuthenticationHelper
-from core.imageshelper import fetch_image
+from core.circuitbreaker import CircuitBreaker
+from core.embeddingcache import EmbeddingCache
+from core.imagecache import ImageCache
+from core.imageshelper import fetch_images
 from templates.supported_models import ModelConfig
 
 
@@ -23,6 +28,8 @@ class RetrieveThenReadVisionApproach(Approach):
     (answer) with that prompt.
     """
 
+    VECTOR_FIELDS = ["embedding", "imageEmbedding"]
+
     system_chat_template_gpt4v = (
         "You are an intelligent assistant helping analyze the Annual Financial Report of Contoso Ltd., The documents contain text, graphs, tables and images. "
         + "Each image source has the file name in the top left corner of the image with coordinates (10,10) pixels and is in the format SourceFileName:<file_name> "
@@ -49,12 +56,19 @@ class RetrieveThenReadVisionApproach(Approach):
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         embedding_dimensions: int,
+        embedding_cache: Optional[EmbeddingCache],
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
         vision_endpoint: str,
         vision_token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession],
+        image_cache: Optional[ImageCache],
+        search_admission: Optional[AdmissionController] = None,
+        vision_admission: Optional[AdmissionController] = None,
+        search_breaker: Optional[CircuitBreaker] = None,
+        vision_breaker: Optional[CircuitBreaker] = None,
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -66,6 +80,7 @@ class RetrieveThenReadVisionApproach(Approach):
         self.embedding_model = embedding_model
         self.embedding_deployment = embedding_deployment
         self.embedding_dimensions = embedding_dimensions
+        self.embedding_cache = embedding_cache
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.gpt4v_deployment = gpt4v_deployment
@@ -74,6 +89,12 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_token_provider = vision_token_provider
+        self.http_session = http_session
+        self.image_cache = image_cache
+        self.search_admission = search_admission
+        self.vision_admission = vision_admission
+        self.search_breaker = search_breaker
+        self.vision_breaker = vision_breaker
         self.gpt4v_token_limit = get_token_limit(gpt4v_model)
 
     async def run(
@@ -96,6 +117,8 @@ class RetrieveThenReadVisionApproach(Approach):
         top = overrides.get("top", 3)
         minimum_search_score = overrides.get("minimum_search_score", 0.0)
         minimum_reranker_score = overrides.get("minimum_reranker_score", 0.0)
+        # Vectors are only returned by the search for debugging, as they are only shown in the thought process
+        include_vectors = bool(overrides.get("include_vectors"))
         filter = self.build_filter(overrides, auth_claims)
 
         vector_fields = overrides.get("vector_fields", ["embedding"])
@@ -105,15 +128,7 @@ class RetrieveThenReadVisionApproach(Approach):
         current_api = self.llm_clients[self.available_models[self.current_model].type]
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors = []
-        if use_vector_search:
-            for field in vector_fields:
-                vector = (
-                    await self.compute_text_embedding(q)
-                    if field == "embedding"
-                    else await self.compute_image_embedding(q)
-                )
-                vectors.append(vector)
+        vectors = await self.compute_vectors(q, vector_fields) if use_vector_search else []
 
         results = await self.search(
             top,
@@ -126,7 +141,9 @@ class RetrieveThenReadVisionApproach(Approach):
             use_semantic_captions,
             minimum_search_score,
             minimum_reranker_score,
+            include_vectors,
         )
+        self.preauthorize_citations(results, auth_claims)
 
         image_list: list[ChatCompletionContentPartImageParam] = []
         user_content: list[ChatCompletionContentPartParam] = [{"text": q, "type": "text"}]
@@ -138,8 +155,7 @@ class RetrieveThenReadVisionApproach(Approach):
             content = "\n".join(sources_content)
             user_content.append({"text": content, "type": "text"})
         if send_images_to_gptvision:
-            for result in results:
-                url = await fetch_image(self.blob_container_client, result)
+            for url in await fetch_images(self.blob_container_client, results, self.image_cache):
                 if url:
                     image_list.append({"image_url": url, "type": "image_url"})
             user_content.extend(image_list)
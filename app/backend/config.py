@@ -16,6 +16,18 @@ CONFIG_LLM_CLIENTS = "llm_clients"
 CONFIG_PROMPT_PROTECTION = "prompt_protection"
 CONFIG_CURRENT_MODEL = "current_model"
 CONFIG_AVAILABLE_MODELS = "available_models"
+CONFIG_PROMPT_TEMPLATES = "prompt_templates"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_SEMANTIC_CACHE = "semantic_cache"
+CONFIG_DELTA_COALESCER = "delta_coalescer"
+CONFIG_STREAM_TRACKER = "stream_tracker"
+CONFIG_TOKENIZER_REGISTRY = "tokenizer_registry"
+CONFIG_TOKEN_COUNT_CACHE = "token_count_cache"
+CONFIG_ADMISSION_CONTROLLERS = "admission_controllers"
+CONFIG_CIRCUIT_BREAKERS = "circuit_breakers"
+CONFIG_HTTP_SESSIONS = "http_sessions"
+CONFIG_IMAGE_CACHE = "image_cache"
 CONFIG_INGESTER = "ingester"
 CONFIG_SPEECH_INPUT_ENABLED = "speech_input_enabled"
 CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED = "speech_output_browser_enabled"
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, FrozenSet, List, Optional, Set
+
+from azure.search.documents.aio import SearchClient
+
+logger = logging.getLogger("aclgroups")
+
+
+class KnownAclGroups:
+    """The groups referenced by the access control lists of the documents, read from the index of known ACL groups.
+
+    Users can belong to thousands of groups, while the documents only reference a few of them. Intersecting the groups
+    of a user with the known groups keeps the security filters short, so their length scales with the groups that
+    can grant access to documents, not with the memberships of the user. The groups are registered in the index when
+    documents are ingested by prepdocs, or when groups are added with manageacl.
+
+    The known groups are loaded on first use and reloaded in the background every `ttl` seconds. As a group that is
+    missing from the known groups may have been registered since they were loaded, they are also reloaded in the
+    background when a group of a user is missing, at most every `reload_interval` seconds. Until they are loaded, if
+    the index cannot be read, or if it has more than `max_groups` groups, the groups of users are used as they are.
+
+    Attributes:
+        ttl (float): Number of seconds after which the known groups are reloaded.
+        reload_interval (float): Minimum number of seconds between the loads of the known groups.
+        max_groups (int): Maximum number of known groups that are loaded.
+        groups (Optional[FrozenSet[str]]): The known groups, or None if they were never loaded.
+    """
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        ttl: float = 5 * 60,
+        reload_interval: float = 30,
+        max_groups: int = 100_000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.search_client = search_client
+        self.ttl = ttl
+        self.reload_interval = reload_interval
+        self.max_groups = max_groups
+        self.groups: Optional[FrozenSet[str]] = None
+        self.loads = 0
+        self.load_failures = 0
+        self.dropped_groups = 0
+        self.missing_group_reloads = 0
+        self._clock = clock
+        self._loaded_at: Optional[float] = None
+        self._load_task: Optional[asyncio.Task] = None
+
+    async def ensure_loaded(self):
+        """Load the known groups if they were never loaded, or start reloading them in the background if stale."""
+        if self._loaded_at is None:
+            # Shielded so a cancelled request does not cancel the load shared with the other requests
+            await asyncio.shield(self._start_load())
+        elif self._clock() >= self._loaded_at + self.ttl:
+            self._start_load()
+
+    def compact(self, groups: List[str]) -> List[str]:
+        """Keep only the groups referenced by documents, as the other groups cannot grant access to any document."""
+        if self.groups is None:
+            return groups
+        compacted = [group for group in groups if group in self.groups]
+        self.dropped_groups += len(groups) - len(compacted)
+        if (
+            len(compacted) < len(groups)
+            and self._loaded_at is not None
+            and self._clock() >= self._loaded_at + self.reload_interval
+            and (self._load_task is None or self._load_task.done())
+        ):
+            # The missing groups may have been registered since the known groups were loaded
+            self.missing_group_reloads += 1
+            self._start_load()
+        return compacted
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "known_groups": len(self.groups) if self.groups is not None else 0,
+            "loads": self.loads,
+            "load_failures": self.load_failures,
+            "dropped_groups": self.dropped_groups,
+            "missing_group_reloads": self.missing_group_reloads,
+        }
+
+    async def close(self):
+        await self.search_client.close()
+
+    def _start_load(self) -> asyncio.Task:
+        if self._load_task is None or self._load_task.done():
+            self._load_task = asyncio.ensure_future(self._load())
+        return self._load_task
+
+    async def _load(self) -> None:
+        try:
+            results = await self.search_client.search(search_text="*", select=["group"], top=self.max_groups + 1)
+            groups: Set[str] = set()
+            truncated = False
+            async for document in results:
+                if len(groups) == self.max_groups:
+                    truncated = True
+                    break
+                groups.add(document["group"])
+            if truncated:
+                logger.warning("More than %d known ACL groups, using the groups of users as they are", self.max_groups)
+            self.groups = None if truncated else frozenset(groups)
+            self.loads += 1
+        except Exception:
+            self.load_failures += 1
+            logger.warning("Failed to load the known ACL groups, keeping the previous ones", exc_info=True)
+        # Also set after a failure, so that the index is not read again on every request
+        self._loaded_at = self._clock()
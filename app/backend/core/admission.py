@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+import weakref
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncGenerator,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    TypeVar,
+    Union,
+    cast,
+)
+
+from core.streamtracker import close_stream
+from error import UpstreamOverloadedError
+
+logger = logging.getLogger("admission")
+
+T = TypeVar("T")
+
+
+@dataclass
+class AdmissionStats:
+    """Counters of an admission controller.
+
+    Attributes:
+        admitted (int): Number of calls admitted, right away or after waiting in the queue.
+        queued (int): Number of calls that waited in the queue.
+        rejected (int): Number of calls rejected because the queue was full.
+        timed_out (int): Number of calls rejected because they waited in the queue until the deadline.
+        wait_time (float): Total number of seconds waited in the queue by the admitted calls.
+        max_wait_time (float): Longest wait in the queue of an admitted call, in seconds.
+        max_queue_depth (int): Largest number of calls waiting in the queue at the same time.
+    """
+
+    admitted: int = 0
+    queued: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    max_queue_depth: int = 0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "mean_wait_ms": self.wait_time * 1000 / self.queued if self.queued else 0.0,
+            "max_wait_ms": self.max_wait_time * 1000,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class AdmissionController:
+    """Limits the number of concurrent calls of a worker to an upstream service.
+
+    Calls beyond `max_concurrency` wait in a queue of at most `max_queue` calls, for at most `queue_timeout`
+    seconds. Calls arriving when the queue is full, or waiting past the deadline, fail fast with an
+    UpstreamOverloadedError, which the routes turn into a 503 response, instead of adding to a burst of throttled
+    requests that slows down every request of the worker.
+
+    Attributes:
+        name (str): The name of the upstream service, e.g. "openai" or "search".
+        max_concurrency (int): Maximum number of concurrent calls.
+        max_queue (int): Maximum number of calls waiting for a slot.
+        queue_timeout (float): Maximum number of seconds a call waits for a slot.
+        max_hold_time (Optional[float]): Maximum number of seconds a stream holds a slot, after which the slot is
+            released even if the stream was not consumed or closed, or None to hold it until then.
+        stats (AdmissionStats): The counters of the controller.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int = 0,
+        queue_timeout: float = 10.0,
+        max_hold_time: Optional[float] = None,
+    ):
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be greater than 0")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_hold_time = max_hold_time
+        self.stats = AdmissionStats()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queue_depth = 0
+
+    @property
+    def active(self) -> int:
+        """Number of calls in progress."""
+        return self.max_concurrency - self._semaphore._value
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls waiting for a slot."""
+        return self._queue_depth
+
+    def metrics(self) -> Dict[str, float]:
+        return {**self.stats.as_dict(), "active": self.active, "queue_depth": self.queue_depth}
+
+    async def acquire(self):
+        """Wait for a slot, raising an UpstreamOverloadedError if the queue is full or the deadline is reached."""
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            self.stats.admitted += 1
+            return
+        if self._queue_depth >= self.max_queue:
+            self.stats.rejected += 1
+            logger.warning("Rejecting a call to %s, %d calls are queued", self.name, self._queue_depth)
+            raise UpstreamOverloadedError(self.name)
+        self._queue_depth += 1
+        self.stats.queued += 1
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, self._queue_depth)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timed_out += 1
+            logger.warning("Rejecting a call to %s, no slot after %.1f seconds", self.name, self.queue_timeout)
+            raise UpstreamOverloadedError(self.name) from None
+        finally:
+            self._queue_depth -= 1
+        wait_time = time.monotonic() - start
+        self.stats.admitted += 1
+        self.stats.wait_time += wait_time
+        self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+
+    def release(self):
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncGenerator[None, None]:
+        """Hold a slot for the duration of the block."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def _release_expired(name: str, release: weakref.finalize):
+    if release.alive:
+        logger.warning("Releasing the slot of a stream of %s that was not consumed or closed in time", name)
+        release()
+
+
+class AdmittedStream:
+    """Stream of an upstream service, such as a streamed chat completion, that holds a slot of an admission
+    controller until it is consumed, fails or is closed, as the service keeps generating it until then.
+
+    The stream is closed like an async generator, with `aclose`, which also closes the upstream stream. The slot of
+    a stream that is abandoned is released when the stream is garbage collected, or once it was held for the
+    `max_hold_time` of the controller.
+    """
+
+    def __init__(self, stream: AsyncIterable[Any], controller: AdmissionController):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._closed = False
+        # Releases the slot once, and does not reference the stream, so that it can be garbage collected
+        self._release = weakref.finalize(self, controller.release)
+        self._timer: Optional[asyncio.TimerHandle] = None
+        if controller.max_hold_time is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                controller.max_hold_time, _release_expired, controller.name, self._release
+            )
+
+    def __aiter__(self) -> "AdmittedStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._release()
+        if not self._closed:
+            self._closed = True
+            await close_stream(self._stream)
+
+
+def admit(controller: Optional[AdmissionController]) -> AsyncContextManager[Any]:
+    """Hold a slot of an admission controller for the duration of the block, if there is a controller."""
+    return controller.admit() if controller is not None else nullcontext()
+
+
+async def call_admitted(
+    controller: Optional[AdmissionController],
+    call: Callable[[], Awaitable[T]],
+    stream: bool = False,
+    stream_controller: Optional[AdmissionController] = None,
+) -> Union[T, AdmittedStream]:
+    """Make a call to an upstream service once it is admitted by its controller, if there is a controller.
+
+    The slot of `controller` is released once the call returns, so that the streams do not starve the other calls
+    to the service, such as the query rewrites and the embeddings. The streams hold a slot of `stream_controller`
+    instead, until they are consumed or closed.
+
+    Args:
+        controller (Optional[AdmissionController]): The admission controller of the service.
+        call (Callable[[], Awaitable[T]]): Makes the call, only invoked once the call is admitted.
+        stream (bool): Whether the call returns a stream.
+        stream_controller (Optional[AdmissionController]): The admission controller of the streams of the service.
+
+    Returns:
+        The result of the call, wrapped in an AdmittedStream for the streams admitted by `stream_controller`.
+
+    Raises:
+        UpstreamOverloadedError: If the call is not admitted.
+    """
+    if not stream or stream_controller is None:
+        async with admit(controller):
+            return await call()
+    # The slot of the stream is taken first, so that a stream that is not admitted does not make the call
+    await stream_controller.acquire()
+    try:
+        async with admit(controller):
+            result = await call()
+    except BaseException:
+        stream_controller.release()
+        raise
+    return AdmittedStream(cast(AsyncIterable[Any], result), stream_controller)
@@ -0,0 +1,108 @@
+import copy
+import json
+import logging
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from approaches.approach import Approach
+from core.cache import LRUCache
+
+logger = logging.getLogger("answercache")
+
+
+class AnswerCache(LRUCache[Dict[str, Any]]):
+    """Exact answer cache in front of `Approach.run`, for single-turn questions.
+
+    The key contains the security filter of the request, so an answer is only reused for users that can access
+    the same documents. Answers must be dropped with `invalidate` whenever the content of the index changes.
+    """
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).lower()
+
+    def make_key(
+        self,
+        approach: Approach,
+        messages: list[ChatCompletionMessageParam],
+        context: dict[str, Any],
+    ) -> Optional[str]:
+        """Build the cache key of a request, or return None if the answer of the request cannot be cached.
+
+        Only the first question of a conversation is cached, as the answers of the following ones depend on
+        the history. All the overrides are part of the key, as they can change the retrieval or the prompt, and so
+        is the model that answers the request, which is the fallback model while the circuit of the requested model
+        is open.
+
+        Args:
+            approach (Approach): The approach that answers the request.
+            messages (list[ChatCompletionMessageParam]): The messages of the request.
+            context (dict[str, Any]): The context of the request, with the overrides and the auth claims.
+        Returns:
+            Optional[str]: The key of the request.
+        """
+        if len(messages) != 1:
+            return None
+        question = messages[0].get("content")
+        if not isinstance(question, str):
+            return None
+        overrides = context.get("overrides", {})
+        security_filter = approach.build_filter(overrides, context.get("auth_claims", {}))
+        model = approach.get_execution_context(overrides).model_name
+        return json.dumps(
+            [type(approach).__name__, model, self.normalize(question), overrides, security_filter],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+
+    def get_answer(self, key: str, session_state: Any = None) -> Optional[Dict[str, Any]]:
+        """Get a cached answer, with the session state of the current request."""
+        answer = self.get(key)
+        if answer is None:
+            return None
+        return {**copy.deepcopy(answer), "session_state": session_state}
+
+    def set_answer(self, key: str, answer: Dict[str, Any]):
+        self.set(key, copy.deepcopy({**answer, "session_state": None}))
+
+    def invalidate(self):
+        """Drop all the cached answers, to be called when documents are added to or removed from the index."""
+        if len(self):
+            logger.info("Invalidating %d cached answers", len(self))
+        self.clear()
+
+    async def cache_stream(
+        self, key: str, events: AsyncGenerator[Dict[str, Any], None]
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """Forward the events of a chat stream, and cache the answer once the stream completed successfully."""
+        context: Dict[str, Any] = {}
+        followup_questions = None
+        content = []
+        try:
+            async for event in events:
+                yield event
+                if "context" in event:
+                    if not context:
+                        context = event["context"]
+                    elif "followup_questions" in event["context"]:
+                        followup_questions = event["context"]["followup_questions"]
+                if delta_content := (event.get("delta") or {}).get("content"):
+                    content.append(delta_content)
+        finally:
+            # Closing the forwarded events cancels the answer when the client disconnects
+            await events.aclose()
+        if followup_questions is not None:
+            context = {**context, "followup_questions": followup_questions}
+        self.set_answer(key, {"message": {"role": "assistant", "content": "".join(content)}, "context": context})
+
+    @staticmethod
+    async def replay_stream(answer: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        """Replay a cached answer with the same events as `ChatApproach.run_with_streaming`."""
+        context = dict(answer["context"])
+        followup_questions = context.pop("followup_questions", None)
+        yield {"delta": {"role": "assistant"}, "context": context, "session_state": answer["session_state"]}
+        yield {"delta": {"role": "assistant", "content": answer["message"]["content"]}}
+        if followup_questions:
+            yield {"delta": {"role": "assistant"}, "context": {"followup_questions": followup_questions}}
@@ -1,7 +1,11 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import functools
+import hashlib
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
 import aiohttp
@@ -18,6 +22,13 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from core.aclgroups import KnownAclGroups
+from core.claimscache import ClaimsCache
+from core.groupcache import GroupCache
+from core.httpsessions import session_or_new
+from core.jwkscache import JwksCache
+from core.pathauthcache import PathAuthCache
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -43,8 +54,20 @@ class AuthenticationHelper:
         require_access_control: bool = False,
         enable_global_documents: bool = False,
         enable_unauthenticated_access: bool = False,
+        http_session: Optional[aiohttp.ClientSession] = None,
+        jwks_cache_ttl: float = 24 * 60 * 60,
+        claims_cache: Optional[ClaimsCache] = None,
+        obo_max_workers: int = 4,
+        group_cache: Optional[GroupCache] = None,
+        known_acl_groups: Optional[KnownAclGroups] = None,
+        path_auth_cache: Optional[PathAuthCache] = None,
     ):
         self.use_authentication = use_authentication
+        self.http_session = http_session
+        self.claims_cache = claims_cache
+        self.group_cache = group_cache
+        self.known_acl_groups = known_acl_groups
+        self.path_auth_cache = path_auth_cache
         self.server_app_id = server_app_id
         self.server_app_secret = server_app_secret
         self.client_app_id = client_app_id
@@ -59,6 +82,8 @@ class AuthenticationHelper:
         self.valid_audiences = [f"api://{server_app_id}", str(server_app_id)]
         # See https://learn.microsoft.com/entra/identity-platform/access-tokens#validate-the-issuer for more information on token validation
         self.key_url = f"{self.authority}/discovery/v2.0/keys"
+        # The signing keys are shared by the requests of the worker instead of being downloaded for every token
+        self.jwks_cache = JwksCache(self.fetch_jwks, ttl=jwks_cache_ttl)
 
         if self.use_authentication:
             field_names = [field.name for field in search_index.fields] if search_index else []
@@ -69,11 +94,23 @@ class AuthenticationHelper:
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id, authority=self.authority, client_credential=server_app_secret, token_cache=TokenCache()
             )
+            # MSAL is synchronous, so tokens are acquired in threads to keep the event loop serving other requests
+            self.obo_executor: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(
+                max_workers=obo_max_workers, thread_name_prefix="obo"
+            )
         else:
             self.has_auth_fields = False
             self.require_access_control = False
             self.enable_global_documents = True
             self.enable_unauthenticated_access = True
+            self.obo_executor = None
+        self._obo_requests: dict[str, asyncio.Future] = {}
+
+    async def close(self):
+        if self.obo_executor is not None:
+            self.obo_executor.shutdown(wait=False, cancel_futures=True)
+        if self.known_acl_groups is not None:
+            await self.known_acl_groups.close()
 
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
@@ -151,10 +188,12 @@ class AuthenticationHelper:
         oid_security_filter = (
             "oids/any(g:search.in(g, '{}'))".format(auth_claims.get("oid", "")) if use_oid_security_filter else None
         )
+        groups = auth_claims.get("groups", [])
+        if use_groups_security_filter and self.known_acl_groups is not None:
+            # Only the groups referenced by documents can grant access, so the other groups are left out of the filter
+            groups = self.known_acl_groups.compact(groups)
         groups_security_filter = (
-            "groups/any(g:search.in(g, '{}'))".format(", ".join(auth_claims.get("groups", [])))
-            if use_groups_security_filter
-            else None
+            "groups/any(g:search.in(g, '{}'))".format(", ".join(groups)) if use_groups_security_filter else None
         )
 
         # If only one security filter is specified, use that filter
@@ -177,13 +216,17 @@ class AuthenticationHelper:
         return security_filter
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with session_or_new(session) as session:
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            async with session.get(
+                url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id", headers=headers
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -195,7 +238,7 @@ class AuthenticationHelper:
                     groups.append(group["id"])
                 next_link = resp_json.get("@odata.nextLink")
                 if next_link:
-                    async with session.get(url=next_link) as resp:
+                    async with session.get(url=next_link, headers=headers) as resp:
                         resp_json = await resp.json()
                         resp_status = resp.status
                 else:
@@ -205,22 +248,48 @@ class AuthenticationHelper:
 
         return groups
 
+    async def acquire_token_on_behalf_of(self, auth_token: str) -> dict[str, Any]:
+        """
+        Exchange an access token for a Microsoft Graph token, in the thread pool of the helper.
+        Concurrent requests with the same access token share a single exchange.
+        """
+        key = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+        future = self._obo_requests.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.obo_executor,
+                functools.partial(
+                    self.confidential_client.acquire_token_on_behalf_of,
+                    user_assertion=auth_token,
+                    scopes=["https://graph.microsoft.com/.default"],
+                ),
+            )
+            self._obo_requests[key] = future
+            future.add_done_callback(lambda _: self._obo_requests.pop(key, None))
+        # Shielded so a cancelled request does not cancel the exchange shared with the other requests
+        return await asyncio.shield(future)
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
+        if self.known_acl_groups is not None:
+            await self.known_acl_groups.ensure_loaded()
         try:
             # Read the authentication token from the authorization header and exchange it using the On Behalf Of Flow
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
+            # Reuse the claims of a token that was already validated and exchanged
+            if self.claims_cache is not None:
+                cached_claims = self.claims_cache.get_claims(auth_token)
+                if cached_claims is not None:
+                    return cached_claims
             # Validate the token before use
-            await self.validate_access_token(auth_token)
+            token_claims = await self.validate_access_token(auth_token)
 
             # Use the on-behalf-of-flow to acquire another token for use with Microsoft Graph
             # See https://learn.microsoft.com/entra/identity-platform/v2-oauth2-on-behalf-of-flow for more information
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
+            graph_resource_access_token = await self.acquire_token_on_behalf_of(auth_token)
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
 
@@ -240,7 +309,17 @@ class AuthenticationHelper:
             )
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                if self.group_cache is not None:
+                    auth_claims["groups"] = await self.group_cache.get_groups(
+                        auth_claims["oid"],
+                        lambda: AuthenticationHelper.list_groups(graph_resource_access_token, self.http_session),
+                    )
+                else:
+                    auth_claims["groups"] = await AuthenticationHelper.list_groups(
+                        graph_resource_access_token, self.http_session
+                    )
+            if self.claims_cache is not None:
+                self.claims_cache.set_claims(auth_token, auth_claims, (token_claims or {}).get("exp"))
             return auth_claims
         except AuthError as e:
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -261,9 +340,11 @@ class AuthenticationHelper:
             return True
 
         # Remove any fragment string from the path before checking
-        fragment_index = path.find("#")
-        if fragment_index != -1:
-            path = path[:fragment_index]
+        path = PathAuthCache.normalize_path(path)
+        if self.path_auth_cache is not None:
+            cached_allowed = self.path_auth_cache.get_decision(security_filter, path)
+            if cached_allowed is not None:
+                return cached_allowed
 
         # Filter down to only chunks that are from the specific source file
         # Sourcepage is used for GPT-4V
@@ -280,21 +361,35 @@ class AuthenticationHelper:
             allowed = True
             break
 
+        if self.path_auth_cache is not None:
+            self.path_auth_cache.set_decision(security_filter, path, allowed)
         return allowed
 
+    def preauthorize_paths(self, auth_claims: dict[str, Any], paths: list[str]):
+        """
+        Record that the user can access the given paths, so that check_path_auth does not need to search for them.
+        Only call this with the sources of search results retrieved with the security filter of the user.
+        """
+        if self.path_auth_cache is None:
+            return
+        security_filter = self.build_security_filters(overrides={}, auth_claims=auth_claims)
+        if security_filter:
+            self.path_auth_cache.preauthorize(security_filter, paths)
+
     # See https://github.com/Azure-Samples/ms-identity-python-on-behalf-of/blob/939be02b11f1604814532fdacc2c2eccd198b755/FlaskAPI/helpers/authorization.py#L44
-    async def validate_access_token(self, token: str):
+    async def fetch_jwks(self) -> dict[str, Any]:
         """
-        Validate an access token is issued by Entra
+        Download the keys used by Entra to sign access tokens
         """
         jwks = None
+        # Short waits, since a cached key set keeps being used while the endpoint is unavailable
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(AuthError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(5),
+            wait=wait_random_exponential(min=1, max=5),
+            stop=stop_after_attempt(3),
         ):
             with attempt:
-                async with aiohttp.ClientSession() as session:
+                async with session_or_new(self.http_session) as session:
                     async with session.get(url=self.key_url) as resp:
                         resp_status = resp.status
                         if resp_status in [500, 502, 503, 504]:
@@ -302,11 +397,14 @@ class AuthenticationHelper:
                                 error=f"Failed to get keys info: {await resp.text()}", status_code=resp_status
                             )
                         jwks = await resp.json()
+        if jwks is None:
+            raise AuthError(error="Failed to get keys info: the response is empty", status_code=500)
+        return jwks
 
-        if not jwks or "keys" not in jwks:
-            raise AuthError({"code": "invalid_keys", "description": "Unable to get keys to validate auth token."}, 401)
-
-        rsa_key = None
+    async def validate_access_token(self, token: str) -> dict[str, Any]:
+        """
+        Validate an access token is issued by Entra, and return its claims
+        """
         issuer = None
         audience = None
         try:
@@ -314,16 +412,26 @@ class AuthenticationHelper:
             unverified_claims = jwt.get_unverified_claims(token)
             issuer = unverified_claims.get("iss")
             audience = unverified_claims.get("aud")
-            for key in jwks["keys"]:
-                if key["kid"] == unverified_header["kid"]:
-                    rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
-                    break
+            kid = unverified_header["kid"]
         except Exception as exc:
             raise AuthError(
                 {"code": "invalid_header", "description": "Unable to parse authorization token."}, 401
             ) from exc
-        if not rsa_key:
+
+        try:
+            key = await self.jwks_cache.get_key(kid)
+        except Exception as exc:
+            raise AuthError(
+                {"code": "invalid_keys", "description": "Unable to get keys to validate auth token."}, 401
+            ) from exc
+        if not key:
             raise AuthError({"code": "invalid_header", "description": "Unable to find appropriate key"}, 401)
+        try:
+            rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
+        except KeyError as exc:
+            raise AuthError(
+                {"code": "invalid_header", "description": "Unable to parse authorization token."}, 401
+            ) from exc
 
         if issuer not in self.valid_issuers:
             raise AuthError(
@@ -340,7 +448,7 @@ class AuthenticationHelper:
             )
 
         try:
-            jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
+            return jwt.decode(token, rsa_key, algorithms=["RS256"], audience=audience, issuer=issuer)
         except ExpiredSignatureError as jwt_expired_exc:
             raise AuthError({"code": "token_expired", "description": "token is expired"}, 401) from jwt_expired_exc
         except JWTClaimsError as jwt_claims_exc:
@@ -0,0 +1,112 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    """Counters of a cache.
+
+    Attributes:
+        hits (int): Number of lookups that found a fresh entry.
+        misses (int): Number of lookups that found no entry or an expired one.
+        evictions (int): Number of entries dropped to respect the size bound.
+        expirations (int): Number of entries dropped because they were older than the TTL.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class LRUCache(Generic[V]):
+    """In-memory LRU cache with a time to live, shared by the requests of a worker.
+
+    The cache is not thread-safe, it is meant to be used from the event loop of the app.
+
+    Attributes:
+        max_entries (int): Maximum number of entries, the least recently used entries are evicted first.
+        ttl (Optional[float]): Number of seconds after which an entry expires, or None to never expire entries.
+        stats (CacheStats): The counters of the cache.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than 0")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._clock = clock
+        self._entries: OrderedDict[Hashable, Tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._is_expired(entry[0])
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Get the value of a key and mark it as recently used, or return None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        if self._is_expired(entry[0]):
+            del self._entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: V, expires_at: Optional[float] = None):
+        """Store a value, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (Hashable): The key of the entry.
+            value (V): The value to store.
+            expires_at (Optional[float]): Time at which the entry expires, on the clock of the cache.
+                Defaults to now plus the TTL of the cache.
+        """
+        if expires_at is None:
+            expires_at = self._clock() + self.ttl if self.ttl is not None else float("inf")
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        self._entries.clear()
+
+    def _is_expired(self, expires_at: float) -> bool:
+        return self._clock() >= expires_at
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass
+from enum import Enum
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    TypeVar,
+)
+
+from error import CircuitOpenError, UpstreamOverloadedError
+
+logger = logging.getLogger("circuitbreaker")
+
+T = TypeVar("T")
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+@dataclass
+class CircuitBreakerStats:
+    """Counters of a circuit breaker.
+
+    Attributes:
+        calls (int): Number of calls made to the service.
+        failures (int): Number of calls that failed.
+        slow_calls (int): Number of calls that succeeded, but took longer than the slow call duration.
+        rejected (int): Number of calls rejected without calling the service, because the circuit was open.
+        opened (int): Number of times the circuit opened.
+        state_changes (int): Number of state changes of the circuit.
+    """
+
+    calls: int = 0
+    failures: int = 0
+    slow_calls: int = 0
+    rejected: int = 0
+    opened: int = 0
+    state_changes: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "slow_calls": self.slow_calls,
+            "rejected": self.rejected,
+            "opened": self.opened,
+            "state_changes": self.state_changes,
+        }
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Whether an error of a call means that the service is failing, rather than that the request was invalid.
+
+    The client errors of the services, such as a content filter or a context length error, do not count as
+    failures, except for the timeouts and the throttling.
+    """
+    if isinstance(error, (UpstreamOverloadedError, CircuitOpenError)):
+        return False
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """Stops calling an upstream service that is failing or too slow, so that the requests fail fast, or use a
+    fallback, instead of waiting out the timeouts of the service.
+
+    The breaker keeps the outcome of the last `window_size` calls. A call is bad when it fails, or takes longer than
+    `slow_call_duration` seconds. The circuit opens when at least `min_calls` calls were made and the rate of bad
+    calls reaches `failure_rate_threshold`. The calls are then rejected with a CircuitOpenError for `open_duration`
+    seconds, after which the circuit is half-open: a single probe call is let through, which closes the circuit if it
+    is good, and opens it again otherwise. The calls made before the last state change, such as slow calls that
+    started while the circuit was closed, are only counted in the stats when they end.
+
+    Attributes:
+        name (str): The name of the upstream service, e.g. "hf" or "vision".
+        failure_rate_threshold (float): Rate of bad calls of the window that opens the circuit, between 0 and 1.
+        slow_call_duration (float): Number of seconds after which a call is slow.
+        window_size (int): Number of calls of which the outcome is kept.
+        min_calls (int): Minimum number of calls of the window before the circuit can open.
+        open_duration (float): Number of seconds the circuit stays open before a probe call is let through.
+        stats (CircuitBreakerStats): The counters of the breaker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = 30.0,
+        window_size: int = 20,
+        min_calls: int = 10,
+        open_duration: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not 0 < failure_rate_threshold <= 1:
+            raise ValueError("failure_rate_threshold must be between 0 and 1")
+        if not 0 < min_calls <= window_size:
+            raise ValueError("min_calls must be between 1 and window_size")
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.open_duration = open_duration
+        self.stats = CircuitBreakerStats()
+        self._clock = clock
+        self._state = CircuitState.CLOSED
+        self._outcomes: Deque[bool] = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._probing = False
+        # Incremented on each state change, so that the outcome of a call only counts for the state it was made in
+        self._generation = 0
+
+    @property
+    def state(self) -> CircuitState:
+        """The state of the circuit, which is half-open once an open circuit waited for `open_duration` seconds."""
+        if self._state == CircuitState.OPEN and self._clock() - self._opened_at >= self.open_duration:
+            self._set_state(CircuitState.HALF_OPEN)
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the calls are currently rejected, so that a fallback should be used instead."""
+        state = self.state
+        return state == CircuitState.OPEN or (state == CircuitState.HALF_OPEN and self._probing)
+
+    @property
+    def failure_rate(self) -> float:
+        return self._outcomes.count(True) / len(self._outcomes) if self._outcomes else 0.0
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**self.stats.as_dict(), "state": self.state.value, "failure_rate": self.failure_rate}
+
+    def _set_state(self, state: CircuitState):
+        log = logger.warning if state == CircuitState.OPEN else logger.info
+        log("Circuit of %s changed from %s to %s", self.name, self._state.value, state.value)
+        self._state = state
+        self._generation += 1
+        self.stats.state_changes += 1
+        if state == CircuitState.OPEN:
+            self.stats.opened += 1
+            self._opened_at = self._clock()
+        elif state == CircuitState.CLOSED:
+            self._outcomes.clear()
+
+    def before_call(self) -> int:
+        """Check that a call can be made, raising a CircuitOpenError otherwise.
+
+        Returns:
+            int: The generation of the state of the circuit the call is made in, to pass to `record`.
+        """
+        if self.is_open:
+            self.stats.rejected += 1
+            raise CircuitOpenError(self.name)
+        if self._state == CircuitState.HALF_OPEN:
+            self._probing = True
+        return self._generation
+
+    def record(self, duration: float, error: Optional[BaseException] = None, generation: Optional[int] = None):
+        """Record the outcome of a call that took `duration` seconds, and failed with `error` if it is given.
+
+        A call made in an earlier `generation` than the current state, as returned by `before_call`, only counts in
+        the stats, so that only the probe call moves the circuit out of half-open.
+        """
+        failed = error is not None and is_upstream_failure(error)
+        slow = error is None and duration > self.slow_call_duration
+        self.stats.calls += 1
+        self.stats.failures += int(failed)
+        self.stats.slow_calls += int(slow)
+        if generation is not None and generation != self._generation:
+            return
+        bad = failed or slow
+        if self._state == CircuitState.HALF_OPEN:
+            self._probing = False
+            self._set_state(CircuitState.OPEN if bad else CircuitState.CLOSED)
+            return
+        self._outcomes.append(bad)
+        if (
+            self._state == CircuitState.CLOSED
+            and len(self._outcomes) >= self.min_calls
+            and self.failure_rate >= self.failure_rate_threshold
+        ):
+            self._set_state(CircuitState.OPEN)
+
+    def cancel_call(self, generation: Optional[int] = None):
+        """Forget a call that was cancelled before its outcome was known, letting another probe through."""
+        if self._state == CircuitState.HALF_OPEN and generation in (None, self._generation):
+            self._probing = False
+
+    @asynccontextmanager
+    async def protect(self) -> AsyncGenerator[None, None]:
+        """Make a call to the service in the block, recording its outcome."""
+        generation = self.before_call()
+        start = self._clock()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.cancel_call(generation)
+            raise
+        except Exception as error:
+            self.record(self._clock() - start, error, generation)
+            raise
+        self.record(self._clock() - start, generation=generation)
+
+
+def protect(breaker: Optional[CircuitBreaker]) -> AsyncContextManager[Any]:
+    """Make a call to a service in the block through its circuit breaker, if there is a breaker."""
+    return breaker.protect() if breaker is not None else nullcontext()
+
+
+async def call_protected(breaker: Optional[CircuitBreaker], call: Callable[[], Awaitable[T]]) -> T:
+    """Make a call to a service through its circuit breaker, if there is a breaker.
+
+    For the streamed responses, the call ends when the service starts streaming, so its duration is the time to the
+    first chunk of the response.
+
+    Raises:
+        CircuitOpenError: If the circuit of the service is open.
+    """
+    async with protect(breaker):
+        return await call()
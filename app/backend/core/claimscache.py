@@ -0,0 +1,49 @@
+import hashlib
+import time
+from typing import Any, Callable, Dict, Optional
+
+from core.cache import LRUCache
+
+
+class ClaimsCache(LRUCache[Dict[str, Any]]):
+    """LRU cache of the authorization claims of access tokens, shared by the requests of a worker.
+
+    A chat UI sends many requests with the same access token, and getting its claims means validating the token,
+    exchanging it with the on-behalf-of flow and possibly listing the groups of the user from Microsoft Graph.
+    Entries are keyed by a hash of the token, so tokens are not kept in memory, and expire when the token expires
+    or after the TTL of the cache, which bounds how long changes to the group memberships of a user are ignored.
+
+    The clock of the cache is the wall clock, so it can be compared to the expiration time of the tokens.
+    """
+
+    # Unlike the other caches, the claims always expire, at the latest after the TTL
+    ttl: float
+
+    def __init__(self, max_entries: int, ttl: float, clock: Callable[[], float] = time.time):
+        super().__init__(max_entries, ttl, clock)
+
+    @staticmethod
+    def make_key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get_claims(self, token: str) -> Optional[Dict[str, Any]]:
+        claims = self.get(self.make_key(token))
+        # Copied so that callers cannot change the cached claims
+        return {**claims, "groups": list(claims.get("groups", []))} if claims is not None else None
+
+    def set_claims(self, token: str, claims: Dict[str, Any], token_expires_at: Optional[float] = None):
+        """Store the claims of a token.
+
+        Args:
+            token (str): The access token.
+            claims (Dict[str, Any]): The authorization claims of the token.
+            token_expires_at (Optional[float]): The `exp` claim of the token, in seconds since the epoch.
+        """
+        expires_at = self._clock() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        if expires_at > self._clock():
+            self.set(self.make_key(token), {**claims, "groups": list(claims.get("groups", []))}, expires_at)
+
+    def metrics(self) -> Dict[str, float]:
+        return {**self.stats.as_dict(), "entries": len(self)}
@@ -0,0 +1,147 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional
+
+
+@dataclass
+class CoalescerStats:
+    """Counters of a delta coalescer.
+
+    Attributes:
+        responses (int): Number of streamed responses.
+        deltas (int): Number of deltas received from the chat completion streams.
+        frames (int): Number of deltas sent to the clients, each one being a line of NDJSON.
+    """
+
+    responses: int = 0
+    deltas: int = 0
+    frames: int = 0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "responses": self.responses,
+            "deltas": self.deltas,
+            "frames": self.frames,
+            "frames_per_response": self.frames / self.responses if self.responses else 0.0,
+        }
+
+
+class DeltaCoalescer:
+    """Merges the small deltas of a chat completion stream into fewer frames.
+
+    Models stream a chunk per token, and each chunk costs a JSON encoding, an ASGI send and a TCP write. The deltas
+    are buffered, then flushed as a single delta once `window` seconds elapsed since the first buffered delta, or
+    once `max_chars` characters are buffered. The first delta with content is sent right away, so coalescing does
+    not delay the first token, and deltas that are not plain content, such as tool calls, are sent as they are.
+    The deltas received while the previous frame is sent to a slow client are also merged.
+
+    Attributes:
+        window (float): Number of seconds during which deltas are buffered, or 0 to only flush on `max_chars`.
+        max_chars (int): Number of buffered characters that triggers a flush, or 0 to only flush on `window`.
+        stats (CoalescerStats): The counters of the coalescer.
+    """
+
+    def __init__(self, window: float = 0.0, max_chars: int = 0):
+        if window <= 0 and max_chars <= 0:
+            raise ValueError("window or max_chars must be greater than 0")
+        self.window = window
+        self.max_chars = max_chars
+        self.stats = CoalescerStats()
+
+    def metrics(self) -> Dict[str, float]:
+        return self.stats.as_dict()
+
+    @staticmethod
+    def is_mergeable(completion: Dict[str, Any]) -> bool:
+        delta = completion.get("delta")
+        return (
+            completion.keys() == {"delta"}
+            and isinstance(delta, dict)
+            and not delta.get("tool_calls")
+            and not delta.get("function_call")
+        )
+
+    @staticmethod
+    def merge(completions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if len(completions) == 1:
+            return completions[0]
+        content = "".join(completion["delta"].get("content") or "" for completion in completions)
+        return {"delta": {**completions[0]["delta"], "content": content}}
+
+    def take_frames(self, buffer: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Merge the consecutive content deltas of the buffer into frames."""
+        frames: List[Dict[str, Any]] = []
+        mergeable: List[Dict[str, Any]] = []
+        for completion in buffer:
+            if self.is_mergeable(completion):
+                mergeable.append(completion)
+                continue
+            if mergeable:
+                frames.append(self.merge(mergeable))
+                mergeable = []
+            frames.append(completion)
+        if mergeable:
+            frames.append(self.merge(mergeable))
+        buffer.clear()
+        return frames
+
+    async def coalesce(self, completions: AsyncIterator[Dict[str, Any]]) -> AsyncGenerator[Dict[str, Any], None]:
+        """Forward the completions of `ChatApproach.run_with_streaming`, merging the consecutive content deltas.
+
+        The stream is read by a task, which buffers the deltas and wakes up the generator when they must be flushed,
+        so the cost of the coalescing is paid per frame and not per delta.
+        """
+        self.stats.responses += 1
+        loop = asyncio.get_running_loop()
+        buffer: List[Dict[str, Any]] = []
+        flush = asyncio.Event()
+        timer: Optional[asyncio.TimerHandle] = None
+        # Number of characters of the buffer, reset when the buffer is taken
+        buffered_chars = 0
+
+        async def read():
+            nonlocal timer, buffered_chars
+            sent_content = False
+            try:
+                async for completion in completions:
+                    self.stats.deltas += 1
+                    buffer.append(completion)
+                    if not self.is_mergeable(completion):
+                        flush.set()
+                        continue
+                    content = completion["delta"].get("content") or ""
+                    buffered_chars += len(content)
+                    if not sent_content and content:
+                        # The first token is not delayed
+                        sent_content = True
+                        flush.set()
+                    elif self.max_chars > 0 and buffered_chars >= self.max_chars:
+                        flush.set()
+                    elif self.window > 0 and timer is None and not flush.is_set():
+                        timer = loop.call_later(self.window, flush.set)
+            finally:
+                flush.set()
+
+        reader = asyncio.ensure_future(read())
+        try:
+            while True:
+                await flush.wait()
+                flush.clear()
+                if timer is not None:
+                    timer.cancel()
+                    timer = None
+                buffered_chars = 0
+                for frame in self.take_frames(buffer):
+                    self.stats.frames += 1
+                    yield frame
+                if reader.done() and not buffer:
+                    break
+            # Raise the errors of the stream
+            await reader
+        finally:
+            # Also stop reading the stream when the client stops reading the frames
+            if timer is not None:
+                timer.cancel()
+            if not reader.done():
+                reader.cancel()
+                await asyncio.wait({reader})
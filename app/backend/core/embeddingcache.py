@@ -0,0 +1,32 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from core.cache import LRUCache
+
+EmbeddingKey = Tuple[str, Optional[str], Optional[int], str]
+
+
+class EmbeddingCache(LRUCache[np.ndarray]):
+    """LRU and TTL cache of the embeddings of search queries.
+
+    Rewritten search queries repeat a lot, so caching their embeddings saves a call to the embeddings API
+    for most requests. Vectors are stored as float32 arrays, which is the precision of the vector fields
+    of the search index.
+    """
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize a query so that queries differing only by case or whitespace share an entry."""
+        return " ".join(text.split()).lower()
+
+    @classmethod
+    def make_key(cls, model: str, deployment: Optional[str], dimensions: Optional[int], text: str) -> EmbeddingKey:
+        return (model, deployment, dimensions, cls.normalize(text))
+
+    def get_vector(self, key: EmbeddingKey) -> Optional[List[float]]:
+        vector = self.get(key)
+        return vector.tolist() if vector is not None else None
+
+    def set_vector(self, key: EmbeddingKey, vector: List[float]):
+        self.set(key, np.asarray(vector, dtype=np.float32))
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from core.cache import LRUCache
+
+logger = logging.getLogger("groupcache")
+
+GroupEntry = Tuple[float, FrozenSet[str]]
+
+# Formats of the group ids stored in the shared store: packed 16 byte UUIDs, which is what Entra uses, or text
+_UUIDS_FORMAT = b"\x00"
+_TEXT_FORMAT = b"\x01"
+
+
+def encode_groups(groups: FrozenSet[str]) -> bytes:
+    try:
+        return _UUIDS_FORMAT + b"".join(uuid.UUID(group).bytes for group in sorted(groups))
+    except ValueError:
+        return _TEXT_FORMAT + "\n".join(sorted(groups)).encode("utf-8")
+
+
+def decode_groups(data: bytes) -> FrozenSet[str]:
+    body = data[1:]
+    if data[:1] == _UUIDS_FORMAT:
+        return frozenset(str(uuid.UUID(bytes=body[i : i + 16])) for i in range(0, len(body), 16))
+    return frozenset(body.decode("utf-8").split("\n")) if body else frozenset()
+
+
+class SqliteGroupStore:
+    """Group memberships stored in a SQLite file, so that the gunicorn workers of a host share them.
+
+    The methods are blocking, they are called in threads by the GroupCache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS groups (oid TEXT PRIMARY KEY, fetched_at REAL NOT NULL, groups BLOB NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, oid: str) -> Optional[GroupEntry]:
+        with self._connect() as connection:
+            row = connection.execute("SELECT fetched_at, groups FROM groups WHERE oid = ?", (oid,)).fetchone()
+        return (row[0], decode_groups(row[1])) if row else None
+
+    def set(self, oid: str, fetched_at: float, groups: FrozenSet[str]):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO groups (oid, fetched_at, groups) VALUES (?, ?, ?)",
+                (oid, fetched_at, encode_groups(groups)),
+            )
+
+
+@dataclass
+class GroupCacheStats:
+    """Counters of a group cache.
+
+    Attributes:
+        hits (int): Number of lookups served from the memory of the worker.
+        shared_hits (int): Number of lookups served from the store shared by the workers.
+        misses (int): Number of lookups that had to wait for the groups to be listed.
+        refreshes (int): Number of times the groups of a user were listed.
+        refresh_failures (int): Number of times listing the groups of a user failed.
+    """
+
+    hits: int = 0
+    shared_hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    refresh_failures: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+        }
+
+
+class GroupCache:
+    """Cache of the group memberships of users, keyed by object id.
+
+    Users with many groups get a groups overage claim, and listing their groups takes several sequential calls to
+    Microsoft Graph. The groups are kept as frozensets for `ttl` seconds, and refreshed in the background once
+    `refresh_ahead` of the TTL has elapsed, so most requests do not wait for Microsoft Graph. Concurrent refreshes
+    of a user share the same calls. With a shared store, the groups listed by a worker are reused by the others.
+
+    The clock of the cache is the wall clock, so that the entries of the shared store can be compared across workers.
+
+    Attributes:
+        ttl (float): Number of seconds after which the groups of a user must be listed again.
+        refresh_ahead (float): Share of the TTL after which the groups are refreshed in the background.
+        store (Optional[SqliteGroupStore]): The store shared by the workers, if any.
+        stats (GroupCacheStats): The counters of the cache.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        refresh_ahead: float = 0.8,
+        max_entries: int = 10000,
+        store: Optional[SqliteGroupStore] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.store = store
+        self.stats = GroupCacheStats()
+        self._clock = clock
+        self._entries: LRUCache[GroupEntry] = LRUCache(max_entries, ttl, clock)
+        self._refreshes: Dict[str, asyncio.Task] = {}
+
+    async def get_groups(self, oid: str, list_groups: Callable[[], Awaitable[List[str]]]) -> List[str]:
+        """Get the groups of a user, sorted so that the security filters built from them are stable.
+
+        Args:
+            oid (str): The object id of the user.
+            list_groups (Callable[[], Awaitable[List[str]]]): Lists the groups of the user from Microsoft Graph.
+        """
+        entry = self._entries.get(oid)
+        if entry is not None:
+            self.stats.hits += 1
+        elif self.store is not None:
+            entry = await self._get_shared(oid)
+            if entry is not None:
+                self.stats.shared_hits += 1
+
+        if entry is None:
+            self.stats.misses += 1
+            groups = await asyncio.shield(self._start_refresh(oid, list_groups))
+        else:
+            fetched_at, groups = entry
+            if self._clock() >= fetched_at + self.ttl * self.refresh_ahead:
+                self._start_refresh(oid, list_groups)
+        return sorted(groups)
+
+    def metrics(self) -> Dict[str, int]:
+        return {**self.stats.as_dict(), "entries": len(self._entries)}
+
+    async def _get_shared(self, oid: str) -> Optional[GroupEntry]:
+        try:
+            entry = await asyncio.to_thread(self.store.get, oid)  # type: ignore[union-attr]
+        except sqlite3.Error:
+            logger.warning("Failed to read the groups of %s from the shared store", oid, exc_info=True)
+            return None
+        if entry is None or self._clock() >= entry[0] + self.ttl:
+            return None
+        self._entries.set(oid, entry, entry[0] + self.ttl)
+        return entry
+
+    def _start_refresh(self, oid: str, list_groups: Callable[[], Awaitable[List[str]]]) -> asyncio.Task:
+        task = self._refreshes.get(oid)
+        if task is None:
+            task = self._refreshes[oid] = asyncio.ensure_future(self._refresh(oid, list_groups))
+            task.add_done_callback(lambda _: self._refreshes.pop(oid, None))
+            task.add_done_callback(self._log_refresh_error)
+        return task
+
+    async def _refresh(self, oid: str, list_groups: Callable[[], Awaitable[List[str]]]) -> FrozenSet[str]:
+        groups = frozenset(await list_groups())
+        fetched_at = self._clock()
+        self.stats.refreshes += 1
+        self._entries.set(oid, (fetched_at, groups), fetched_at + self.ttl)
+        if self.store is not None:
+            try:
+                await asyncio.to_thread(self.store.set, oid, fetched_at, groups)
+            except sqlite3.Error:
+                logger.warning("Failed to write the groups of %s to the shared store", oid, exc_info=True)
+        return groups
+
+    def _log_refresh_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.stats.refresh_failures += 1
+            logger.warning("Failed to list the groups: %s", task.exception())
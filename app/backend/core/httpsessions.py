@@ -0,0 +1,164 @@
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterable, Optional
+
+import aiohttp
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+logger = logging.getLogger("httpsessions")
+
+
+@dataclass
+class HttpSessionSettings:
+    """Connection settings of the pooled HTTP sessions.
+
+    Attributes:
+        limit (int): Maximum number of open connections of a session.
+        limit_per_host (int): Maximum number of open connections to the same host.
+        keepalive_timeout (float): Number of seconds an idle connection is kept open for reuse.
+        dns_cache_ttl (int): Number of seconds resolved host names are cached.
+        total_timeout (float): Maximum number of seconds for a whole request, including reading the response.
+        connect_timeout (float): Maximum number of seconds to get a connection, from the pool or a new one.
+    """
+
+    limit: int = 100
+    limit_per_host: int = 20
+    keepalive_timeout: float = 60
+    dns_cache_ttl: int = 300
+    total_timeout: float = 60
+    connect_timeout: float = 10
+
+
+@dataclass
+class ConnectionStats:
+    """Counters of the connections of a session.
+
+    Attributes:
+        requests (int): Number of requests sent.
+        connections_created (int): Number of new connections, each paying for the TCP and TLS handshakes.
+        connections_reused (int): Number of requests sent on an idle connection of the pool.
+        dns_cache_hits (int): Number of host name resolutions served by the DNS cache.
+        dns_cache_misses (int): Number of host name resolutions sent to the resolver.
+    """
+
+    requests: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    dns_cache_hits: int = 0
+    dns_cache_misses: int = 0
+
+    @property
+    def reuse_rate(self) -> float:
+        connections = self.connections_created + self.connections_reused
+        return self.connections_reused / connections if connections else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "reuse_rate": self.reuse_rate,
+        }
+
+
+class HttpSessionPool:
+    """The aiohttp sessions shared by the requests of the app, one per upstream service.
+
+    Opening a session per call pays for the DNS resolution and the TCP and TLS handshakes every time,
+    while the sessions of the pool keep their connections alive between requests. Sessions are created
+    on first use, from the event loop of the app, and must be closed with `close` when the app shuts down.
+
+    Attributes:
+        settings (HttpSessionSettings): The connection settings of the sessions.
+        stats (Dict[str, ConnectionStats]): The connection counters of each session.
+    """
+
+    def __init__(self, settings: Optional[HttpSessionSettings] = None):
+        self.settings = settings or HttpSessionSettings()
+        self.stats: Dict[str, ConnectionStats] = {}
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._register_metrics()
+
+    def get(self, name: str) -> aiohttp.ClientSession:
+        """Get the session of an upstream service, creating it on first use.
+
+        Args:
+            name (str): The name of the upstream service, e.g. "vision" or "graph".
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._sessions[name] = self._create_session(name)
+        return session
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
+
+    async def close(self):
+        for name, session in self._sessions.items():
+            if name in self.stats:
+                logger.info("Closing HTTP session %s: %s", name, self.stats[name].as_dict())
+            await session.close()
+        self._sessions.clear()
+
+    def _register_metrics(self):
+        # Exported with the other telemetry of the app when Azure Monitor is configured
+        meter = metrics.get_meter("httpsessions")
+        for counter in ("requests", "connections_created", "connections_reused"):
+
+            def observe(options: CallbackOptions, counter: str = counter) -> Iterable[Observation]:
+                return [Observation(getattr(stats, counter), {"session": name}) for name, stats in self.stats.items()]
+
+            meter.create_observable_counter(f"http_session.{counter}", callbacks=[observe])
+
+    def _create_session(self, name: str) -> aiohttp.ClientSession:
+        stats = self.stats.setdefault(name, ConnectionStats())
+
+        async def on_request_start(session: Any, context: SimpleNamespace, params: Any):
+            stats.requests += 1
+
+        async def on_connection_create_end(session: Any, context: SimpleNamespace, params: Any):
+            stats.connections_created += 1
+
+        async def on_connection_reuseconn(session: Any, context: SimpleNamespace, params: Any):
+            stats.connections_reused += 1
+
+        async def on_dns_cache_hit(session: Any, context: SimpleNamespace, params: Any):
+            stats.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session: Any, context: SimpleNamespace, params: Any):
+            stats.dns_cache_misses += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.settings.limit,
+            limit_per_host=self.settings.limit_per_host,
+            keepalive_timeout=self.settings.keepalive_timeout,
+            ttl_dns_cache=self.settings.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.settings.total_timeout, connect=self.settings.connect_timeout),
+            trace_configs=[trace_config],
+        )
+
+
+@asynccontextmanager
+async def session_or_new(session: Optional[aiohttp.ClientSession]) -> AsyncIterator[aiohttp.ClientSession]:
+    """Use a shared session if one is given, or a new session closed on exit otherwise, e.g. in scripts."""
+    if session is not None:
+        yield session
+    else:
+        async with aiohttp.ClientSession() as new_session:
+            yield new_session
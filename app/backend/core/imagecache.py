@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from core.cache import CacheStats
+
+
+@dataclass(frozen=True)
+class CachedImage:
+    etag: str
+    url: str
+
+
+class ImageCache:
+    """LRU cache of the base64 data URLs of the page images sent to GPT-4V, bounded by size.
+
+    Entries are keyed by blob name and carry the ETag of the blob they were encoded from, so they can be
+    revalidated with a conditional download instead of being downloaded and encoded again.
+
+    The cache is not thread-safe, it is meant to be used from the event loop of the app.
+
+    Attributes:
+        max_bytes (int): Maximum total size of the cached data URLs. The least recently used are evicted first.
+        stats (CacheStats): The counters of the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be greater than 0")
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self.size = 0
+        self._entries: OrderedDict[str, CachedImage] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, blob_name: str) -> Optional[CachedImage]:
+        """Get the cached image of a blob and mark it as recently used. The ETag must still be validated."""
+        image = self._entries.get(blob_name)
+        if image is None:
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(blob_name)
+        self.stats.hits += 1
+        return image
+
+    def set(self, blob_name: str, etag: str, url: str):
+        """Store the data URL of a blob, unless it is larger than the whole cache."""
+        self.pop(blob_name)
+        if len(url) > self.max_bytes:
+            return
+        self._entries[blob_name] = CachedImage(etag=etag, url=url)
+        self.size += len(url)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.url)
+            self.stats.evictions += 1
+
+    def pop(self, blob_name: str) -> Optional[CachedImage]:
+        image = self._entries.pop(blob_name, None)
+        if image is not None:
+            self.size -= len(image.url)
+        return image
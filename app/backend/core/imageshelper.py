@@ -1,13 +1,21 @@
+import asyncio
 import base64
 import logging
 import os
-from typing import Optional
+from typing import List, Optional
 
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.storage.blob.aio import ContainerClient
 from typing_extensions import Literal, Required, TypedDict
 
 from approaches.approach import Document
+from core.imagecache import ImageCache
+
+# Maximum number of images downloaded at the same time for a request
+MAX_CONCURRENT_IMAGE_DOWNLOADS = 4
+# Images larger than this are base64 encoded in a thread, so the event loop keeps serving other requests
+ENCODE_IN_THREAD_MIN_BYTES = 256 * 1024
 
 
 class ImageURL(TypedDict, total=False):
@@ -18,26 +26,72 @@ class ImageURL(TypedDict, total=False):
     """Specifies the detail level of the image."""
 
 
-async def download_blob_as_base64(blob_container_client: ContainerClient, file_path: str) -> Optional[str]:
+def encode_data_url(image: bytes) -> str:
+    return "data:image/png;base64," + base64.b64encode(image).decode("utf-8")
+
+
+async def download_blob_as_base64(
+    blob_container_client: ContainerClient, file_path: str, image_cache: Optional[ImageCache] = None
+) -> Optional[str]:
     base_name, _ = os.path.splitext(file_path)
     image_filename = base_name + ".png"
+    cached = image_cache.get(image_filename) if image_cache is not None else None
     try:
-        blob = await blob_container_client.get_blob_client(image_filename).download_blob()
+        blob_client = blob_container_client.get_blob_client(image_filename)
+        if cached is not None:
+            # Only download the image again if it changed since it was cached
+            blob = await blob_client.download_blob(etag=cached.etag, match_condition=MatchConditions.IfModified)
+        else:
+            blob = await blob_client.download_blob()
         if not blob.properties:
             logging.warning(f"No blob exists for {image_filename}")
             return None
-        img = base64.b64encode(await blob.readall()).decode("utf-8")
-        return f"data:image/png;base64,{img}"
+        image = await blob.readall()
+        if len(image) >= ENCODE_IN_THREAD_MIN_BYTES:
+            url = await asyncio.to_thread(encode_data_url, image)
+        else:
+            url = encode_data_url(image)
+        if image_cache is not None and blob.properties.etag:
+            image_cache.set(image_filename, blob.properties.etag, url)
+        return url
     except ResourceNotFoundError:
         logging.warning(f"No blob exists for {image_filename}")
+        if image_cache is not None:
+            image_cache.pop(image_filename)
         return None
+    except HttpResponseError as error:
+        if cached is not None and error.status_code == 304:
+            return cached.url
+        raise
 
 
-async def fetch_image(blob_container_client: ContainerClient, result: Document) -> Optional[ImageURL]:
+async def fetch_image(
+    blob_container_client: ContainerClient, result: Document, image_cache: Optional[ImageCache] = None
+) -> Optional[ImageURL]:
     if result.sourcepage:
-        img = await download_blob_as_base64(blob_container_client, result.sourcepage)
+        img = await download_blob_as_base64(blob_container_client, result.sourcepage, image_cache)
         if img:
             return {"url": img, "detail": "auto"}
         else:
             return None
     return None
+
+
+async def fetch_images(
+    blob_container_client: ContainerClient,
+    results: List[Document],
+    image_cache: Optional[ImageCache] = None,
+    max_concurrency: int = MAX_CONCURRENT_IMAGE_DOWNLOADS,
+) -> List[Optional[ImageURL]]:
+    """Fetch the images of the search results concurrently, with at most `max_concurrency` downloads at a time.
+
+    Returns:
+        List[Optional[ImageURL]]: The image of each result, in the order of the results.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(result: Document) -> Optional[ImageURL]:
+        async with semaphore:
+            return await fetch_image(blob_container_client, result, image_cache)
+
+    return await asyncio.gather(*(fetch(result) for result in results))
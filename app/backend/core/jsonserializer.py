@@ -0,0 +1,112 @@
+import dataclasses
+import json
+from typing import Any, Callable, Dict, Optional, Type, cast
+
+from pydantic import BaseModel
+from quart.json.provider import DefaultJSONProvider
+from quart.wrappers import Response
+from werkzeug.sansio.response import Response as BaseResponse
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the json module is used without it
+    orjson = None  # type: ignore[assignment]
+
+Encoder = Callable[[Any], Any]
+
+# Encoders of the types that JSON libraries cannot serialize, compiled once per type
+_encoders: Dict[type, Optional[Encoder]] = {}
+
+
+def _compile_fields_encoder(field_names: tuple, extra: bool = False) -> Encoder:
+    # Shallow: nested objects are encoded by the JSON library calling the encoders again
+    def encode(o: Any) -> Dict[str, Any]:
+        encoded = {name: getattr(o, name) for name in field_names}
+        if extra and o.__pydantic_extra__:
+            encoded.update(o.__pydantic_extra__)
+        return encoded
+
+    return encode
+
+
+def compile_encoder(cls: type) -> Optional[Encoder]:
+    """Build the encoder of a type into JSON compatible values, or None if the type is not supported.
+
+    Search results are encoded with their `serialize_for_results` method, pydantic models, such as the chunks of
+    OpenAI streams, like `model_dump` and dataclasses, such as the thought steps, like `dataclasses.asdict`.
+    The huggingface-hub types subclass dict, so they are serialized by the JSON libraries themselves.
+    """
+    if callable(getattr(cls, "serialize_for_results", None)):
+        return cls.serialize_for_results  # type: ignore[attr-defined]
+    if issubclass(cls, BaseModel):
+        return _compile_fields_encoder(tuple(cls.model_fields), extra=True)
+    if dataclasses.is_dataclass(cls):
+        return _compile_fields_encoder(tuple(field.name for field in dataclasses.fields(cls)))
+    return None
+
+
+def to_jsonable(o: Any) -> Any:
+    """Convert an object that JSON libraries cannot serialize into JSON compatible values."""
+    cls = type(o)
+    try:
+        encoder = _encoders[cls]
+    except KeyError:
+        encoder = _encoders[cls] = compile_encoder(cls)
+    if encoder is None:
+        raise TypeError(f"Object of type {cls.__name__} is not JSON serializable")
+    return encoder(o)
+
+
+class JSONSerializer:
+    """Serializes the responses of the app into compact UTF-8 JSON.
+
+    orjson is used when it is installed, and is several times faster than the json module, which is used otherwise.
+    Both backends produce the same output.
+
+    Attributes:
+        backend (str): The name of the JSON library used, "orjson" or "json".
+        sort_keys (bool): Whether the keys of the dicts are sorted.
+    """
+
+    def __init__(self, use_orjson: bool = True, sort_keys: bool = False):
+        self.backend = "orjson" if use_orjson and orjson is not None else "json"
+        self.sort_keys = sort_keys
+        if self.backend == "orjson":
+            # Dataclasses are passed to the encoders, so that search results are serialized the same way as with json
+            options = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            self._dumps = lambda obj: orjson.dumps(obj, default=to_jsonable, option=options)
+            self._dumps_line = lambda obj: orjson.dumps(
+                obj, default=to_jsonable, option=options | orjson.OPT_APPEND_NEWLINE
+            )
+        else:
+            encoder = json.JSONEncoder(
+                ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=to_jsonable
+            )
+            self._dumps = lambda obj: encoder.encode(obj).encode("utf-8")
+            self._dumps_line = lambda obj: (encoder.encode(obj) + "\n").encode("utf-8")
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._dumps(obj)
+
+    def dumps_line(self, obj: Any) -> bytes:
+        """Serialize an object into a line of NDJSON."""
+        return self._dumps_line(obj)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """JSON provider of the app, which serializes the responses of `jsonify` with a JSONSerializer.
+
+    Keys are sorted like with the default provider, but non-ASCII characters are not escaped, which gives
+    smaller responses.
+    """
+
+    serializer = JSONSerializer(sort_keys=DefaultJSONProvider.sort_keys)
+
+    def response(self, *args: Any, **kwargs: Any) -> BaseResponse:
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        response_class = cast(Type[Response], self._app.response_class)
+        return response_class(self.serializer.dumps_line(obj), mimetype=self.mimetype)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger("jwkscache")
+
+
+@dataclass
+class JwksCacheStats:
+    """Counters of a JWKS cache.
+
+    Attributes:
+        hits (int): Number of lookups that found the key of the token.
+        misses (int): Number of lookups that did not find the key of the token, even after a refresh.
+        refreshes (int): Number of downloads of the key set.
+        refresh_failures (int): Number of failed downloads of the key set.
+        stale_lookups (int): Number of lookups served from an expired key set because the endpoint was unavailable.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    refresh_failures: int = 0
+    stale_lookups: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+            "stale_lookups": self.stale_lookups,
+        }
+
+
+class JwksCache:
+    """Cache of the signing keys used to validate access tokens, shared by the requests of a worker.
+
+    The key set is downloaded once and kept for `ttl` seconds. It is refreshed in the background once
+    `refresh_ahead` of the TTL has elapsed, so requests do not wait for the download, and in the foreground
+    when a token is signed with an unknown key, which happens when the keys are rotated. Concurrent refreshes
+    share a single download. When the endpoint is unavailable, the last key set keeps being used.
+
+    Attributes:
+        ttl (float): Number of seconds after which the key set must be downloaded again.
+        refresh_ahead (float): Share of the TTL after which the key set is refreshed in the background.
+        min_refresh_interval (float): Minimum number of seconds between two downloads triggered by unknown keys
+            or by failures, so that tokens with made-up key ids cannot be used to flood the endpoint.
+        stats (JwksCacheStats): The counters of the cache.
+    """
+
+    def __init__(
+        self,
+        fetch_keys: Callable[[], Awaitable[Dict[str, Any]]],
+        ttl: float = 24 * 60 * 60,
+        refresh_ahead: float = 0.8,
+        min_refresh_interval: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refresh_interval = min_refresh_interval
+        self.stats = JwksCacheStats()
+        self._fetch_keys = fetch_keys
+        self._clock = clock
+        self._keys: Dict[str, Dict[str, Any]] = {}
+        self._fetched_at: Optional[float] = None
+        self._last_attempt_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def get_key(self, kid: str) -> Optional[Dict[str, Any]]:
+        """Get the key with the given key id, downloading the key set if needed.
+
+        Raises:
+            Exception: The error of the download, if the key set could never be downloaded.
+        """
+        now = self._clock()
+        if self._fetched_at is None:
+            await self._refresh()
+        elif now >= self._fetched_at + self.ttl:
+            if self._can_refresh(now):
+                await self._refresh_or_keep_stale()
+            else:
+                self.stats.stale_lookups += 1
+        elif now >= self._fetched_at + self.ttl * self.refresh_ahead and self._can_refresh(now):
+            self._start_refresh().add_done_callback(self._log_background_refresh_error)
+
+        key = self._keys.get(kid)
+        if key is None and self._can_refresh(self._clock()):
+            # The keys may have been rotated since they were downloaded
+            await self._refresh_or_keep_stale()
+            key = self._keys.get(kid)
+
+        if key is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return key
+
+    def _can_refresh(self, now: float) -> bool:
+        return self._last_attempt_at is None or now >= self._last_attempt_at + self.min_refresh_interval
+
+    async def _refresh(self):
+        # Shielded so a cancelled request does not cancel the download shared with the other requests
+        await asyncio.shield(self._start_refresh())
+
+    async def _refresh_or_keep_stale(self):
+        try:
+            await self._refresh()
+        except Exception:
+            if not self._keys:
+                raise
+            self.stats.stale_lookups += 1
+            logger.warning("Failed to refresh the signing keys, using the keys downloaded before", exc_info=True)
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._download())
+        return self._refresh_task
+
+    async def _download(self) -> None:
+        self._last_attempt_at = self._clock()
+        try:
+            jwks = await self._fetch_keys()
+            if not jwks or "keys" not in jwks:
+                raise ValueError("The key set does not contain any keys")
+        except Exception:
+            self.stats.refresh_failures += 1
+            raise
+        self._keys = {key["kid"]: key for key in jwks["keys"] if "kid" in key}
+        self._fetched_at = self._clock()
+        self.stats.refreshes += 1
+
+    def _log_background_refresh_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to refresh the signing keys in the background: %s", task.exception())
@@ -1,10 +1,8 @@
 import logging
 import unicodedata
 from collections.abc import Iterable
-from contextlib import contextmanager
-from typing import Any, Optional, Union
+from typing import Optional, Union
 
-import tiktoken
 from openai.types.chat import (
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
@@ -13,12 +11,11 @@ from openai.types.chat import (
     ChatCompletionToolParam,
     ChatCompletionUserMessageParam,
 )
-from openai_messages_token_helper import model_helper
-from openai_messages_token_helper.model_helper import (
-    count_tokens_for_message,
-    count_tokens_for_system_and_tools,
-)
-from transformers import AutoTokenizer  # type: ignore
+from openai_messages_token_helper.function_format import format_function_definitions
+from openai_messages_token_helper.images_helper import count_tokens_for_image
+
+from core.tokencountcache import TokenCountCache
+from core.tokenizers import Tokenizer
 
 
 def normalize_content(content: Union[str, Iterable[ChatCompletionContentPartParam]]):
@@ -38,47 +35,75 @@ def normalize_content(content: Union[str, Iterable[ChatCompletionContentPartPara
         return content
 
 
-def get_hf_encoding(model: Union[str, Any], *args) -> AutoTokenizer:
+def count_tokens_for_message(model: str, tokenizer: Tokenizer, message: ChatCompletionMessageParam) -> int:
     """
-    Get the Hugging Face tokenizer for a given model.
+    Calculate the number of tokens required to encode a message, like
+    `openai_messages_token_helper.count_tokens_for_message` but with the given tokenizer.
     Args:
-        model (str): The name of the model to get the tokenizer for.
+        model (str): The name of the model, used for the tokens of the images.
+        tokenizer (Tokenizer): The tokenizer of the model.
+        message (ChatCompletionMessageParam): The message to encode.
     Returns:
-        AutoTokenizer: The tokenizer for the model.
+        int: The total number of tokens required to encode the message.
     """
-    try:
-        return AutoTokenizer.from_pretrained(model)
-    except ValueError:
-        raise ValueError(f"Could not load the tokenizer for model {model}. Maybe this model is not supported?")
-
-
-@contextmanager
-def select_encoding(model_type: str):
+    # Assumes we're using a recent model
+    num_tokens = 3
+    for key, value in message.items():
+        if isinstance(value, list):
+            for item in value:
+                if item["type"] == "text":
+                    num_tokens += len(tokenizer.encode(item["text"]))
+                elif item["type"] == "image_url":
+                    num_tokens += count_tokens_for_image(item["image_url"]["url"], item["image_url"]["detail"], model)
+        elif isinstance(value, str):
+            num_tokens += len(tokenizer.encode(value))
+        else:
+            raise ValueError(f"Could not encode unsupported message value type: {type(value)}")
+        if key == "name":
+            num_tokens += 1
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+def count_tokens_for_system_and_tools(
+    model: str,
+    tokenizer: Tokenizer,
+    system_message: Optional[ChatCompletionSystemMessageParam] = None,
+    tools: Optional[list[ChatCompletionToolParam]] = None,
+    tool_choice: Optional[ChatCompletionNamedToolChoiceParam] = None,
+) -> int:
     """
-    Override the encoding for a given model and then restore it.
+    Calculate the number of tokens required to encode a system message and tools, like
+    `openai_messages_token_helper.count_tokens_for_system_and_tools` but with the given tokenizer.
     Args:
-        model (str): The name of the model to override the encoding for.
+        model (str): The name of the model, used for the tokens of the images.
+        tokenizer (Tokenizer): The tokenizer of the model.
+        system_message (ChatCompletionSystemMessageParam): The system message to encode.
+        tools (list[ChatCompletionToolParam]): The tools to encode.
+        tool_choice (ChatCompletionNamedToolChoiceParam): The tool choice to encode.
+    Returns:
+        int: The total number of tokens required to encode the system message and tools.
     """
-    original_encoding_for_model = model_helper.encoding_for_model
-    original_tiktoken_encoding = tiktoken.encoding_for_model
-
-    def hugging_face_encoding(model, *args):
-        return get_hf_encoding(model, *args)
-
-    if model_type == "hf":
-        model_helper.encoding_for_model = hugging_face_encoding
-        tiktoken.encoding_for_model = hugging_face_encoding
-
-    try:
-        yield
-    finally:
-        model_helper.encoding_for_model = original_encoding_for_model
-        tiktoken.encoding_for_model = original_tiktoken_encoding
+    tokens = 0
+    if system_message:
+        tokens += count_tokens_for_message(model, tokenizer, system_message)
+    if tools:
+        tokens += len(tokenizer.encode(format_function_definitions(tools)))
+        tokens += 9  # Additional tokens for function definition of tools
+    # If there's a system message and tools are present, subtract four tokens
+    if tools and system_message:
+        tokens -= 4
+    if tool_choice == "none":
+        tokens += 1
+    elif isinstance(tool_choice, dict):
+        tokens += 7
+        tokens += len(tokenizer.encode(tool_choice["function"]["name"]))
+    return tokens
 
 
 def build_past_messages(
     model: str,
-    model_type: str,
+    tokenizer: Tokenizer,
     system_message: str,
     max_tokens: int,
     *,
@@ -87,15 +112,17 @@ def build_past_messages(
     new_user_content: Union[str, list[ChatCompletionContentPartParam], None] = None,  # list is for GPT4v usage
     few_shots: Optional[list[ChatCompletionMessageParam]] = None,
     past_messages: list[ChatCompletionMessageParam] = [],  # *not* including system prompt
-    fallback_to_default: bool = False,
+    token_counts: Optional[TokenCountCache] = None,
 ) -> list[ChatCompletionMessageParam]:
     """
     Build a list of messages for a chat conversation, given the system prompt, new user message,
     and past messages. The function will truncate the history of past messages if necessary to
     stay within the token limit and return the truncated messages.
+    The token counts of the messages are cached in `token_counts` if given, so that each turn of a conversation
+    only tokenizes its new messages.
     Args:
         model (str): The model name to use for token calculation, like gpt-3.5-turbo.
-        model_type (str): The type of the model to use for encoding [openai, hf].
+        tokenizer (Tokenizer): The tokenizer of the model, from the TokenizerRegistry.
         system_prompt (str): The initial system prompt message.
         tools (list[ChatCompletionToolParam]): A list of tools to include in the conversation.
         tool_choice (ChatCompletionNamedToolChoiceParam): The tool to use in the conversation.
@@ -103,42 +130,46 @@ def build_past_messages(
         past_messages (list[ChatCompletionMessageParam]): The list of past messages in the conversation.
         few_shots (list[ChatCompletionMessageParam]): A few-shot list of messages to insert after the system prompt.
         max_tokens (int): The maximum number of tokens allowed for the conversation.
-        fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        token_counts (TokenCountCache): The cache of the token counts of the messages.
     Returns:
-        list[ChatCompletionMessageParam]: Past messages truncated to fit within the token limit.
+        list[ChatCompletionMessageParam]: The most recent past messages that fit within the token limit.
     """
-    with select_encoding(model_type):
-        total_token_count = count_tokens_for_system_and_tools(
-            model,
-            ChatCompletionSystemMessageParam(role="system", content=normalize_content(system_message)),
-            tools,
-            tool_choice,
-            default_to_cl100k=fallback_to_default,
+
+    def count_message(message: ChatCompletionMessageParam) -> int:
+        if token_counts is None:
+            return count_tokens_for_message(model, tokenizer, message)
+        return token_counts.get_count(
+            token_counts.make_key(model, message), lambda: count_tokens_for_message(model, tokenizer, message)
+        )
+
+    system = ChatCompletionSystemMessageParam(role="system", content=normalize_content(system_message))
+    if token_counts is None:
+        total_token_count = count_tokens_for_system_and_tools(model, tokenizer, system, tools, tool_choice)
+    else:
+        total_token_count = token_counts.get_count(
+            token_counts.make_key(model, system, tools, tool_choice),
+            lambda: count_tokens_for_system_and_tools(model, tokenizer, system, tools, tool_choice),
         )
-        if few_shots:
-            for shot in reversed(few_shots):
-                if shot["role"] is None or shot["content"] is None:
-                    raise ValueError("Few-shot messages must have both role and content")
-                total_token_count += count_tokens_for_message(model, shot, default_to_cl100k=fallback_to_default)
-
-        if new_user_content:
-            total_token_count += count_tokens_for_message(
-                model,
-                ChatCompletionUserMessageParam(role="user", content=new_user_content),
-                default_to_cl100k=fallback_to_default,
-            )
-
-        newest_to_oldest = list(reversed(past_messages))
-        for index, message in enumerate(newest_to_oldest):
-            potential_message_count = count_tokens_for_message(model, message, default_to_cl100k=fallback_to_default)
-
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
-                return newest_to_oldest[: index - 1]
-
-            if message["role"] is None or message["content"] is None:
+    if few_shots:
+        for shot in reversed(few_shots):
+            if shot["role"] is None or shot["content"] is None:
                 raise ValueError("Few-shot messages must have both role and content")
+            total_token_count += count_message(shot)
+
+    if new_user_content:
+        total_token_count += count_message(ChatCompletionUserMessageParam(role="user", content=new_user_content))
+
+    for index, message in enumerate(reversed(past_messages)):
+        potential_message_count = count_message(message)
+
+        if (total_token_count + potential_message_count) > max_tokens:
+            logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
+            # The `index` most recent messages fit, in the order of the conversation
+            return past_messages[len(past_messages) - index :]
+
+        if message["role"] is None or message["content"] is None:
+            raise ValueError("Few-shot messages must have both role and content")
 
-            total_token_count += potential_message_count
+        total_token_count += potential_message_count
 
-        return past_messages
+    return past_messages
@@ -0,0 +1,36 @@
+import hashlib
+from typing import Iterable, Optional, Tuple
+
+from core.cache import LRUCache
+
+PathAuthKey = Tuple[str, str]
+
+
+class PathAuthCache(LRUCache[bool]):
+    """LRU and TTL cache of the decisions of `AuthenticationHelper.check_path_auth`.
+
+    Opening the citations of an answer checks each file with a search query. Decisions are keyed by a hash of the
+    security filter of the user, which captures their identity and groups, and by the path of the file. The TTL
+    bounds how long changes to the access control lists of the documents are ignored.
+    """
+
+    @staticmethod
+    def normalize_path(path: str) -> str:
+        # Remove any fragment string from the path, e.g. a page number
+        fragment_index = path.find("#")
+        return path[:fragment_index] if fragment_index != -1 else path
+
+    @classmethod
+    def make_key(cls, security_filter: str, path: str) -> PathAuthKey:
+        return (hashlib.sha256(security_filter.encode("utf-8")).hexdigest(), cls.normalize_path(path))
+
+    def get_decision(self, security_filter: str, path: str) -> Optional[bool]:
+        return self.get(self.make_key(security_filter, path))
+
+    def set_decision(self, security_filter: str, path: str, allowed: bool):
+        self.set(self.make_key(security_filter, path), allowed)
+
+    def preauthorize(self, security_filter: str, paths: Iterable[str]):
+        """Allow paths without a search query, e.g. the sources of search results retrieved with the same filter."""
+        for path in set(paths):
+            self.set_decision(security_filter, path, True)
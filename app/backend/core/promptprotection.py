@@ -1,5 +1,11 @@
-from dataclasses import dataclass
-from typing import Dict
+import copy
+import logging
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Mapping, Optional
+
+from error import CircuitOpenError
+
+logger = logging.getLogger("promptprotection")
 
 
 @dataclass
@@ -48,9 +54,12 @@ class InjectionProtection(ProtectionMechanism):
     Attributes:
         model_name (str): The name of the model to use for the protection mechanism.
         enabled (bool): Whether the protection mechanism is enabled or not.
+        skip_when_unavailable (bool): Whether the check is skipped while the circuit of the Hugging Face Inference
+            API is open, instead of failing the request.
     """
 
     model_name: str = "protectai/deberta-v3-base-prompt-injection"
+    skip_when_unavailable: bool = False
 
     @ProtectionMechanism.run_if_enabled
     async def check_for_violation(self, **kwargs) -> bool:
@@ -65,12 +74,21 @@ class InjectionProtection(ProtectionMechanism):
 
         Raises:
             ValueError: If the required arguments (`llm_client` and `message`) are not provided.
+            CircuitOpenError: If the circuit of the Hugging Face Inference API is open and the check is not skipped.
         """
         required_args = frozenset(["llm_client", "message"])
         if not required_args.issubset(kwargs):
             raise ValueError(f"Missing required arguments: {required_args - kwargs.keys()}")
         llm_client, message = kwargs["llm_client"], kwargs["message"]
-        result = await llm_client.text_classification(text=message, model=self.model_name)
+        try:
+            result = await llm_client.text_classification(text=message, model=self.model_name)
+        except CircuitOpenError:
+            if not self.skip_when_unavailable:
+                raise
+            logger.warning(
+                "Skipping the injection protection check of a request, the circuit of %s is open", self.model_name
+            )
+            return True
 
         for element in result:
             if element.label == "INJECTION" and element.score > 0.8:
@@ -89,7 +107,7 @@ class PromptProtection:
         protections (Dict[str, ProtectionMechanism]): A dictionary containing all registered protection mechanisms.
     """
 
-    def __init__(self, injection_protection_enabled=False):
+    def __init__(self, injection_protection_enabled=False, skip_injection_protection_when_unavailable=False):
         """Register and initialise the supported protection mechanisms.
 
         Initialise the `PromptProtection` class with the supported protection mechanisms, which are
@@ -98,9 +116,14 @@ class PromptProtection:
 
         Args:
             injection_protection_enabled (bool): Enable or disable the injection protection mechanism.
+            skip_injection_protection_when_unavailable (bool): Skip the injection protection check while the circuit
+                of the Hugging Face Inference API is open.
         """
         self.protections: Dict[str, ProtectionMechanism] = {
-            "injection_protection": InjectionProtection(enabled=injection_protection_enabled),
+            "injection_protection": InjectionProtection(
+                enabled=injection_protection_enabled,
+                skip_when_unavailable=skip_injection_protection_when_unavailable,
+            ),
         }
 
     def set_protection_bool(self, protection_name: str, value: bool):
@@ -115,6 +138,33 @@ class PromptProtection:
         else:
             raise ValueError(f"Protection {protection_name} not found.")
 
+    def with_overrides(self, overrides: Optional[Mapping[str, Mapping[str, Any]]]) -> "PromptProtection":
+        """Get the protection mechanisms of a request, with the `enabled` attributes overridden by the request.
+
+        The `PromptProtection` of the app is shared by the concurrent requests, so it is never modified: the
+        overridden mechanisms are copies, and the shared instance is returned when nothing is overridden.
+
+        Args:
+            overrides (Mapping[str, Mapping[str, Any]]): The settings of the protection mechanisms sent with the
+                request, by name, e.g. `{"injection_protection": {"enabled": True}}`.
+
+        Returns:
+            PromptProtection: The protection mechanisms of the request.
+
+        Raises:
+            ValueError: If one of the protection mechanisms is not registered.
+        """
+        if not overrides:
+            return self
+        protections = dict(self.protections)
+        for protection_name, config in overrides.items():
+            if protection_name not in protections:
+                raise ValueError(f"Protection {protection_name} not found.")
+            protections[protection_name] = replace(protections[protection_name], enabled=config.get("enabled", False))
+        prompt_protection = copy.copy(self)
+        prompt_protection.protections = protections
+        return prompt_protection
+
     async def check_all_exploits(self, **kwargs) -> bool:
         """Check for all exploits using the configured protection mechanisms.
 
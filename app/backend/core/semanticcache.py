@@ -0,0 +1,200 @@
+import itertools
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.cache import CacheStats
+
+logger = logging.getLogger("semanticcache")
+
+PartitionKey = Tuple[Hashable, ...]
+
+
+@dataclass
+class SemanticCacheEntry:
+    """An answer stored in the semantic cache.
+
+    Attributes:
+        question (str): The question, or search query, the answer was generated for.
+        answer (Any): The cached answer.
+        expires_at (float): Time at which the entry expires, on the clock of the cache.
+    """
+
+    question: str
+    answer: Any
+    expires_at: float
+
+
+@dataclass
+class SemanticCacheHit:
+    entry: SemanticCacheEntry
+    similarity: float
+
+
+class _Partition:
+    """Vectors and entries of the answers sharing the same model, overrides and security filter."""
+
+    def __init__(self, dimensions: int):
+        self.vectors = np.empty((8, dimensions), dtype=np.float32)
+        self.ids: List[int] = []
+        self.entries: List[SemanticCacheEntry] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, entry_id: int, vector: np.ndarray, entry: SemanticCacheEntry):
+        if len(self) == self.vectors.shape[0]:
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.vectors[len(self)] = vector
+        self.ids.append(entry_id)
+        self.entries.append(entry)
+
+    def remove(self, entry_id: int):
+        # Move the last row in place of the removed one, so the used rows stay contiguous
+        row = self.ids.index(entry_id)
+        last = len(self) - 1
+        self.vectors[row] = self.vectors[last]
+        self.ids[row], self.entries[row] = self.ids[last], self.entries[last]
+        self.ids.pop()
+        self.entries.pop()
+
+    def expired_ids(self, now: float) -> List[int]:
+        return [entry_id for entry_id, entry in zip(self.ids, self.entries) if now >= entry.expires_at]
+
+    def top1(self, vector: np.ndarray) -> Tuple[int, float]:
+        similarities = self.vectors[: len(self)] @ vector
+        row = int(np.argmax(similarities))
+        return row, float(similarities[row])
+
+
+class SemanticAnswerCache:
+    """Cache of answers looked up by the cosine similarity of the query embeddings.
+
+    Answers are partitioned by model, overrides and security filter: an answer is only returned for a request
+    with exactly the same settings and access to exactly the same documents. Within a partition, the most similar
+    question is found with a matrix product over the normalized float32 query vectors.
+
+    Attributes:
+        threshold (float): Minimum cosine similarity for a cached answer to be returned.
+        max_entries (int): Maximum number of answers, over all partitions. The least recently used are evicted.
+        ttl (Optional[float]): Number of seconds after which an answer expires, or None to never expire answers.
+        stats (CacheStats): The counters of the cache.
+        similarity_histogram (np.ndarray): Number of lookups per best similarity, in bins of `HISTOGRAM_BIN_SIZE`
+            from -1 to 1, to help tuning the threshold.
+    """
+
+    HISTOGRAM_BIN_SIZE = 0.05
+
+    def __init__(
+        self,
+        threshold: float,
+        max_entries: int,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than 0")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self.similarity_histogram = np.zeros(int(round(2 / self.HISTOGRAM_BIN_SIZE)), dtype=np.int64)
+        self._clock = clock
+        self._partitions: Dict[PartitionKey, _Partition] = {}
+        # Entry id -> partition key, ordered from the least to the most recently used
+        self._lru: OrderedDict[int, PartitionKey] = OrderedDict()
+        self._ids = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    @staticmethod
+    def make_partition_key(
+        namespace: str, model: Optional[str], overrides: Dict[str, Any], security_filter: Optional[str]
+    ) -> PartitionKey:
+        return (namespace, model, json.dumps(overrides, sort_keys=True, default=str), security_filter)
+
+    @staticmethod
+    def normalize(vector: Sequence[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def get(self, partition_key: PartitionKey, vector: Sequence[float]) -> Optional[SemanticCacheHit]:
+        """Get the answer of the most similar question in a partition, if it is similar enough."""
+        partition = self._partitions.get(partition_key)
+        if partition is None or len(partition) == 0:
+            self.stats.misses += 1
+            return None
+        query = self.normalize(vector)
+        if query.shape[0] != partition.vectors.shape[1]:
+            self.stats.misses += 1
+            return None
+        # Drop the expired answers first, so that an expired best match does not hide a valid one
+        for entry_id in partition.expired_ids(self._clock()):
+            self._remove(entry_id)
+            self.stats.expirations += 1
+        if len(partition) == 0:
+            self.stats.misses += 1
+            return None
+        row, similarity = partition.top1(query)
+        self._record_similarity(similarity)
+        entry_id, entry = partition.ids[row], partition.entries[row]
+        if similarity < self.threshold:
+            self.stats.misses += 1
+            return None
+        self._lru.move_to_end(entry_id)
+        self.stats.hits += 1
+        return SemanticCacheHit(entry=entry, similarity=similarity)
+
+    def set(self, partition_key: PartitionKey, vector: Sequence[float], question: str, answer: Any):
+        """Store an answer, evicting the least recently used answers if the cache is full."""
+        normalized = self.normalize(vector)
+        partition = self._partitions.get(partition_key)
+        if partition is None:
+            partition = self._partitions[partition_key] = _Partition(normalized.shape[0])
+        elif partition.vectors.shape[1] != normalized.shape[0]:
+            return
+        expires_at = self._clock() + self.ttl if self.ttl is not None else float("inf")
+        entry_id = next(self._ids)
+        partition.add(entry_id, normalized, SemanticCacheEntry(question=question, answer=answer, expires_at=expires_at))
+        self._lru[entry_id] = partition_key
+        while len(self._lru) > self.max_entries:
+            self._remove(next(iter(self._lru)))
+            self.stats.evictions += 1
+
+    def invalidate(self):
+        """Drop all the cached answers, to be called when documents are added to or removed from the index."""
+        if self._lru:
+            logger.info("Invalidating %d cached answers", len(self._lru))
+        self._partitions.clear()
+        self._lru.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Get the counters of the cache and the distribution of the best similarities of the lookups."""
+        bins = np.round(np.arange(-1, 1, self.HISTOGRAM_BIN_SIZE), 2)
+        return {
+            **self.stats.as_dict(),
+            "entries": len(self),
+            "partitions": len(self._partitions),
+            "threshold": self.threshold,
+            "similarity_histogram": {
+                f"{low:.2f}": int(count) for low, count in zip(bins, self.similarity_histogram) if count
+            },
+        }
+
+    def _record_similarity(self, similarity: float):
+        index = int((min(max(similarity, -1.0), 1.0) + 1) / self.HISTOGRAM_BIN_SIZE)
+        self.similarity_histogram[min(index, len(self.similarity_histogram) - 1)] += 1
+
+    def _remove(self, entry_id: int):
+        partition_key = self._lru.pop(entry_id)
+        partition = self._partitions[partition_key]
+        partition.remove(entry_id)
+        if len(partition) == 0:
+            del self._partitions[partition_key]
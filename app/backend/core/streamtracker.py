@@ -0,0 +1,81 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict
+
+logger = logging.getLogger("streamtracker")
+
+
+@dataclass
+class StreamStats:
+    """Counters of the streamed answers.
+
+    Attributes:
+        completed (int): Number of answers streamed until their end.
+        cancelled (int): Number of answers cancelled before their end, because the client disconnected.
+        completed_tokens (int): Number of tokens of the completed answers.
+        cancelled_tokens (int): Number of tokens streamed by the cancelled answers before they were cancelled.
+        tokens_saved (int): Estimated number of tokens that the cancelled answers did not generate.
+    """
+
+    completed: int = 0
+    cancelled: int = 0
+    completed_tokens: int = 0
+    cancelled_tokens: int = 0
+    tokens_saved: int = 0
+
+    @property
+    def mean_answer_tokens(self) -> float:
+        return self.completed_tokens / self.completed if self.completed else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "completed_tokens": self.completed_tokens,
+            "cancelled_tokens": self.cancelled_tokens,
+            "tokens_saved": self.tokens_saved,
+            "mean_answer_tokens": self.mean_answer_tokens,
+        }
+
+
+async def close_stream(stream: Any):
+    """Close a chat completion stream, so that the model stops generating the answer.
+
+    The OpenAI `AsyncStream` closes its HTTP response, which makes the service stop the generation. The streams of
+    huggingface-hub and of the caches are async generators, which are closed with `aclose`.
+    """
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
+    elif hasattr(stream, "close"):
+        await stream.close()
+
+
+class StreamTracker:
+    """Counts the tokens of the streamed answers, and the tokens saved by cancelling the answers of the clients that
+    disconnected.
+
+    The tokens are counted as the chunks with content, as the models stream a chunk per token. The number of tokens
+    that a cancelled answer would have generated is estimated with the mean length of the completed answers.
+
+    Attributes:
+        stats (StreamStats): The counters of the tracker.
+    """
+
+    def __init__(self):
+        self.stats = StreamStats()
+
+    def metrics(self) -> Dict[str, float]:
+        return self.stats.as_dict()
+
+    def record_completed(self, tokens: int):
+        self.stats.completed += 1
+        self.stats.completed_tokens += tokens
+
+    def record_cancelled(self, tokens: int) -> int:
+        """Record an answer cancelled after `tokens` tokens, and return the estimated number of tokens saved."""
+        tokens_saved = max(0, round(self.stats.mean_answer_tokens) - tokens)
+        self.stats.cancelled += 1
+        self.stats.cancelled_tokens += tokens
+        self.stats.tokens_saved += tokens_saved
+        logger.info("Answer cancelled by the client after %d tokens, saving about %d tokens", tokens, tokens_saved)
+        return tokens_saved
@@ -0,0 +1,31 @@
+import hashlib
+import json
+from typing import Any, Callable, Tuple
+
+from core.cache import LRUCache
+
+TokenCountKey = Tuple[str, bytes]
+
+
+class TokenCountCache(LRUCache[int]):
+    """LRU and TTL cache of the token counts of the messages of the chat conversations.
+
+    The whole conversation is sent with every turn, so without the cache the history is tokenized again on each turn
+    and the cost of a conversation grows quadratically with its length. The counts are keyed by the model, which
+    determines the tokenizer, and a hash of the content of the message, so only the new messages of a turn are
+    tokenized.
+    """
+
+    @staticmethod
+    def make_key(model: str, *parts: Any) -> TokenCountKey:
+        """Build the key of a message, or of the system message and the tools, counted with the tokenizer of a model."""
+        content = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+        return (model, hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+
+    def get_count(self, key: TokenCountKey, count: Callable[[], int]) -> int:
+        """Get the cached token count of a key, or count the tokens and cache them."""
+        tokens = self.get(key)
+        if tokens is None:
+            tokens = count()
+            self.set(key, tokens)
+        return tokens
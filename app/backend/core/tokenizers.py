@@ -0,0 +1,62 @@
+import logging
+import threading
+from typing import Dict, List, Protocol, Tuple
+
+from openai_messages_token_helper.model_helper import encoding_for_model
+from transformers import AutoTokenizer  # type: ignore
+
+logger = logging.getLogger("tokenizers")
+
+
+class Tokenizer(Protocol):
+    """A tokenizer, such as a tiktoken encoding or a Hugging Face tokenizer."""
+
+    def encode(self, text: str) -> List[int]: ...
+
+
+class TokenizerRegistry:
+    """Loads the tokenizer of each model once per process.
+
+    The OpenAI models use their tiktoken encoding, and the Hugging Face models their tokenizer from the hub, which is
+    a fast tokenizer when the model has one. Loading a Hugging Face tokenizer reads its files from the disk or the
+    hub, so the tokenizers are loaded once and shared by the requests. Tokenizers are only loaded under a lock, so
+    the registry can be shared with threads.
+    """
+
+    def __init__(self):
+        self._tokenizers: Dict[Tuple[str, str, bool], Tokenizer] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def metrics(self) -> Dict[str, int]:
+        return {"tokenizers": len(self._tokenizers), "loads": self.loads}
+
+    def get(self, model: str, model_type: str, fallback_to_default: bool = False) -> Tokenizer:
+        """
+        Get the tokenizer of a model, loading it on first use.
+        Args:
+            model (str): The name of the model, like gpt-35-turbo or mistralai/Mistral-7B-Instruct-v0.3.
+            model_type (str): The type of the model [openai, hf].
+            fallback_to_default (bool): Whether to fallback to the CL100k encoding if the OpenAI model is not found.
+        Returns:
+            Tokenizer: The tokenizer of the model.
+        """
+        key = (model, model_type, fallback_to_default)
+        tokenizer = self._tokenizers.get(key)
+        if tokenizer is None:
+            with self._lock:
+                tokenizer = self._tokenizers.get(key)
+                if tokenizer is None:
+                    tokenizer = self._tokenizers[key] = self.load(model, model_type, fallback_to_default)
+                    self.loads += 1
+        return tokenizer
+
+    @staticmethod
+    def load(model: str, model_type: str, fallback_to_default: bool = False) -> Tokenizer:
+        if model_type == "hf":
+            logger.info("Loading the tokenizer of %s", model)
+            try:
+                return AutoTokenizer.from_pretrained(model)
+            except ValueError:
+                raise ValueError(f"Could not load the tokenizer for model {model}. Maybe this model is not supported?")
+        return encoding_for_model(model, default_to_cl100k=fallback_to_default)
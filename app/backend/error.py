@@ -10,6 +10,10 @@ Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the content filter."""
 
+ERROR_MESSAGE_OVERLOADED = """The app is busy right now. Please try again in a few seconds."""
+
+ERROR_MESSAGE_UNAVAILABLE = """A service used by the app is temporarily unavailable. Please try again later."""
+
 ERROR_MESSAGE_LENGTH = """Your message exceeded the context length limit for this model. Please shorten your message or change your settings to retrieve fewer search results."""
 
 
@@ -22,11 +26,36 @@ class PromptProtectionError(Exception):
         self.code = code
 
 
+class UpstreamOverloadedError(Exception):
+    """Raised when a call to an upstream service is not admitted because the worker already has too many calls
+    to this service in progress."""
+
+    upstream: str
+
+    def __init__(self, upstream: str) -> None:
+        super().__init__(f"Too many concurrent calls to {upstream}")
+        self.upstream = upstream
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call to an upstream service is not made because the service has been failing recently."""
+
+    upstream: str
+
+    def __init__(self, upstream: str) -> None:
+        super().__init__(f"The circuit of {upstream} is open")
+        self.upstream = upstream
+
+
 def error_dict(error: Exception) -> dict:
     if isinstance(error, (APIError, PromptProtectionError)) and error.code == "content_filter":
         return {"error": ERROR_MESSAGE_FILTER}
     if isinstance(error, APIError) and error.code == "context_length_exceeded":
         return {"error": ERROR_MESSAGE_LENGTH}
+    if isinstance(error, UpstreamOverloadedError):
+        return {"error": ERROR_MESSAGE_OVERLOADED}
+    if isinstance(error, CircuitOpenError):
+        return {"error": ERROR_MESSAGE_UNAVAILABLE}
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
@@ -34,4 +63,6 @@ def error_response(error: Exception, route: str, status_code: int = 500):
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, (APIError, PromptProtectionError)) and error.code == "content_filter":
         status_code = 400
+    elif isinstance(error, (UpstreamOverloadedError, CircuitOpenError)):
+        status_code = 503
     return jsonify(error_dict(error)), status_code
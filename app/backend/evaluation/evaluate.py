@@ -14,6 +14,7 @@ import numpy as np
 import pandas as pd
 import requests
 from promptflow.core import AzureOpenAIModelConfiguration
+from requests.adapters import HTTPAdapter
 from rich.progress import track
 
 from evaluation import service_setup
@@ -36,8 +37,17 @@ from evaluation.utils import load_jsonl
 logger = logging.getLogger("evaluation")
 
 
-def send_question_to_target(question: str, url: str, parameters: dict = None, raise_error=True) -> dict:
-    """Send a question to the ask endpoint and return the response."""
+def send_question_to_target(
+    question: str,
+    url: str,
+    parameters: dict = None,
+    raise_error=True,
+    session: Optional[requests.Session] = None,
+) -> dict:
+    """Send a question to the ask endpoint and return the response.
+
+    A session shared between the questions keeps the connections to the target alive.
+    """
     headers = {
         "Content-Type": "application/json",
     }
@@ -47,7 +57,8 @@ def send_question_to_target(question: str, url: str, parameters: dict = None, ra
     }
 
     try:
-        r = requests.post(url, headers=headers, json=body)
+        post = session.post if session is not None else requests.post
+        r = post(url, headers=headers, json=body)
 
         r.raise_for_status()
         latency = r.elapsed.total_seconds()
@@ -82,12 +93,22 @@ def send_question_to_target(question: str, url: str, parameters: dict = None, ra
         }
 
 
+def create_target_session(max_workers: int) -> requests.Session:
+    """Create a session to send the questions to the target, with a connection kept alive per worker."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def evaluate_row(
     row,
     target_url: str,
     openai_config: dict,
     requested_metrics: list,
     target_parameters: dict,
+    session: Optional[requests.Session] = None,
 ) -> dict:
     """Evaluate a single row of test data."""
     output = {}
@@ -98,6 +119,7 @@ def evaluate_row(
         question=row["question"],
         url=target_url,
         parameters=target_parameters,
+        session=session,
     )
     output.update(target_response)
     for metric in requested_metrics:
@@ -148,7 +170,7 @@ async def run_evaluation(
         questions_per_model_with_ratings = []
 
         loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, create_target_session(max_workers) as session:
             coroutines = [
                 loop.run_in_executor(
                     executor,
@@ -158,6 +180,7 @@ async def run_evaluation(
                     openai_config,
                     requested_metrics,
                     target_parameters,
+                    session,
                 )
                 for row in testdata
             ]
@@ -3,6 +3,7 @@ import asyncio
 import logging
 from typing import Optional, Union
 
+import aiohttp
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential, get_bearer_token_provider
@@ -195,7 +196,10 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    http_session: Optional[aiohttp.ClientSession] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -204,6 +208,7 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            http_session=http_session,
         )
     return image_embeddings_service
 
@@ -241,6 +246,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--useacls", action="store_true", help="Store ACLs from Azure Data Lake Gen2 Filesystem in the search index"
     )
+    parser.add_argument(
+        "--aclgroupsindex",
+        required=False,
+        help="Optional. Name of the index where the groups referenced by the ACLs of the documents are registered, so the app can keep security filters short",
+    )
     parser.add_argument(
         "--category", help="Value for the category field in the search index for all sections indexed in this run"
     )
@@ -474,6 +484,7 @@ if __name__ == "__main__":
             search_analyzer_name=args.searchanalyzername,
             use_acls=args.useacls,
             category=args.category,
+            acl_groups_index_name=args.aclgroupsindex,
         )
 
     loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
@@ -1,5 +1,6 @@
 import logging
 from abc import ABC
+from contextlib import AsyncExitStack
 from typing import Awaitable, Callable, List, Optional, Union
 from urllib.parse import urljoin
 
@@ -229,9 +230,15 @@ class ImageEmbeddings:
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        http_session: Optional[aiohttp.ClientSession] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        self.http_session = http_session
 
     async def create_embeddings(self, blob_urls: List[str]) -> List[List[float]]:
         endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
@@ -240,7 +247,13 @@ class ImageEmbeddings:
         headers["Authorization"] = "Bearer " + await self.token_provider()
 
         embeddings: List[List[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with AsyncExitStack() as stack:
+            # Use the session shared by the app if there is one, prepdocs opens a session per call
+            session: aiohttp.ClientSession = (
+                self.http_session
+                if self.http_session is not None
+                else await stack.enter_async_context(aiohttp.ClientSession())
+            )
             for blob_url in blob_urls:
                 async for attempt in AsyncRetrying(
                     retry=retry_if_exception_type(Exception),
@@ -250,7 +263,7 @@ class ImageEmbeddings:
                 ):
                     with attempt:
                         body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
+                        async with session.post(url=endpoint, params=params, headers=headers, json=body) as resp:
                             resp_json = await resp.json()
                             embeddings.append(resp_json["vector"])
 
@@ -1,5 +1,5 @@
 import logging
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
@@ -50,6 +50,7 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        acl_groups_index_name: Optional[str] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -61,6 +62,7 @@ class FileStrategy(Strategy):
         self.search_info = search_info
         self.use_acls = use_acls
         self.category = category
+        self.acl_groups_index_name = acl_groups_index_name
 
     async def setup(self):
         search_manager = SearchManager(
@@ -70,12 +72,18 @@ class FileStrategy(Strategy):
             False,
             self.embeddings,
             search_images=self.image_embeddings is not None,
+            acl_groups_index_name=self.acl_groups_index_name,
         )
         await search_manager.create_index()
 
     async def run(self):
         search_manager = SearchManager(
-            self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings
+            self.search_info,
+            self.search_analyzer_name,
+            self.use_acls,
+            False,
+            self.embeddings,
+            acl_groups_index_name=self.acl_groups_index_name,
         )
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
@@ -118,6 +126,15 @@ class UploadUserFileStrategy:
         self.image_embeddings = image_embeddings
         self.search_info = search_info
         self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        self.index_change_listeners: List[Callable[[], None]] = []
+
+    def add_index_change_listener(self, listener: Callable[[], None]):
+        """Register a function called after documents are added to or removed from the index."""
+        self.index_change_listeners.append(listener)
+
+    def notify_index_changed(self):
+        for listener in self.index_change_listeners:
+            listener()
 
     async def add_file(self, file: File):
         if self.image_embeddings:
@@ -125,9 +142,11 @@ class UploadUserFileStrategy:
         sections = await parse_file(file, self.file_processors)
         if sections:
             await self.search_manager.update_content(sections, url=file.url)
+            self.notify_index_changed()
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
             logging.warning("Filename is required to remove a file")
             return
         await self.search_manager.remove_content(filename, oid)
+        self.notify_index_changed()
@@ -1,8 +1,11 @@
 import asyncio
+import base64
 import logging
 import os
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.indexes.models import (
     HnswAlgorithmConfiguration,
     HnswParameters,
@@ -29,6 +32,12 @@ from .textsplitter import SplitPage
 logger = logging.getLogger("ingester")
 
 
+def acl_group_key(group: str) -> str:
+    """Key of a group in the index of the known ACL groups, shared by the ingestion and the manageacl script."""
+    # Document keys can only contain letters, digits, dashes, underscores and equal signs
+    return base64.urlsafe_b64encode(group.encode("utf-8")).decode("ascii")
+
+
 class Section:
     """
     A section of a page that is stored in a search service. These sections are used as context by Azure OpenAI service
@@ -54,6 +63,7 @@ class SearchManager:
         use_int_vectorization: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        acl_groups_index_name: Optional[str] = None,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -63,6 +73,8 @@ class SearchManager:
         # Integrated vectorization uses the ada-002 model with 1536 dimensions
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else 1536
         self.search_images = search_images
+        # Index of the groups referenced by the documents, used by the app to keep security filters short
+        self.acl_groups_index_name = acl_groups_index_name
 
     async def create_index(self, vectorizers: Optional[List[VectorSearchVectorizer]] = None):
         logger.info("Ensuring search index %s exists", self.search_info.index_name)
@@ -200,6 +212,38 @@ class SearchManager:
                     )
                     await search_index_client.create_or_update_index(index_definition)
 
+            if self.acl_groups_index_name:
+                await self.create_acl_groups_index(search_index_client)
+
+    async def create_acl_groups_index(self, search_index_client: SearchIndexClient):
+        if self.acl_groups_index_name in [name async for name in search_index_client.list_index_names()]:
+            logger.info("Search index %s already exists", self.acl_groups_index_name)
+            return
+        logger.info("Creating %s search index", self.acl_groups_index_name)
+        await search_index_client.create_index(
+            SearchIndex(
+                name=self.acl_groups_index_name,
+                fields=[
+                    SimpleField(name="id", type="Edm.String", key=True),
+                    SimpleField(name="group", type="Edm.String", filterable=True),
+                ],
+            )
+        )
+
+    async def register_acl_groups(self, groups: Iterable[str]):
+        """Add groups referenced by documents to the index of known ACL groups."""
+        if not self.acl_groups_index_name:
+            return
+        documents = [{"id": acl_group_key(group), "group": group} for group in sorted(set(groups))]
+        if not documents:
+            return
+        async with SearchClient(
+            endpoint=self.search_info.endpoint,
+            index_name=self.acl_groups_index_name,
+            credential=self.search_info.credential,
+        ) as search_client:
+            await search_client.merge_or_upload_documents(documents)
+
     async def update_content(
         self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None, url: Optional[str] = None
     ):
@@ -243,6 +287,7 @@ class SearchManager:
                         document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
 
                 await search_client.upload_documents(documents)
+                await self.register_acl_groups(group for document in documents for group in document.get("groups", []))
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
@@ -0,0 +1,252 @@
+import ast
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+from jinja2 import Template
+from openai.types.chat import ChatCompletionMessageParam
+from promptflow.core import Prompty  # type: ignore
+
+try:
+    # Internals of promptflow used by `PromptTemplate.render_messages`, tested with the versions pinned in
+    # requirements.in. Without them, the messages are parsed from the output of the public `Prompty.render`.
+    from promptflow.core import _prompty_utils  # type: ignore
+except ImportError:
+    _prompty_utils = None
+
+from templates.supported_models import ModelConfig
+
+PROMPT_TEMPLATE_NAMES = ("ask", "chat", "query")
+TOOLS_FILE_NAME = "tools.json"
+
+logger = logging.getLogger("prompts")
+
+PROMPTY_UTILS_NAMES = ("Escaper", "find_referenced_image_set", "parse_chat", "preprocess_template_string")
+PROMPTY_NAMES = ("_template", "_resolve_inputs", "_model")
+
+
+def _file_mtimes(paths: List[Path]) -> Tuple[Tuple[Path, int], ...]:
+    return tuple((path, os.stat(path).st_mtime_ns) for path in paths if path.exists())
+
+
+def has_render_internals(prompty: Prompty) -> bool:
+    """Whether the internals of promptflow that `PromptTemplate.render_messages` relies on are available."""
+    return (
+        _prompty_utils is not None
+        and all(hasattr(_prompty_utils, name) for name in PROMPTY_UTILS_NAMES)
+        and all(hasattr(prompty, name) for name in PROMPTY_NAMES)
+        and hasattr(prompty._model, "api")
+    )
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """A parsed Prompty template that is shared by all requests for the models using it.
+
+    The underlying Prompty object must never be mutated. Per-request changes to the chat completion
+    parameters are applied on a copy via `get_parameters`.
+
+    Attributes:
+        name (str): The name of the template, e.g. "chat".
+        prompty (Prompty): The parsed Prompty object used for rendering.
+        parameters (Mapping[str, Any]): Read-only view of the default chat completion parameters.
+        configuration (Mapping[str, Any]): Read-only view of the model configuration of the template.
+        mtimes (Tuple[Tuple[Path, int], ...]): The files the template was loaded from, with their mtimes.
+        jinja_template (Optional[Template]): The compiled Jinja template of a chat Prompty, used by `render_messages`,
+            or None if the internals of promptflow it relies on are not available.
+    """
+
+    name: str
+    prompty: Prompty
+    parameters: Mapping[str, Any]
+    configuration: Mapping[str, Any]
+    mtimes: Tuple[Tuple[Path, int], ...]
+    jinja_template: Optional[Template] = None
+
+    @classmethod
+    def load(cls, path: Path, name: str) -> "PromptTemplate":
+        prompty_path = path / f"{name}.prompty"
+        # Load the mtimes first, so a change made while parsing triggers another reload
+        mtimes = _file_mtimes([prompty_path, path / TOOLS_FILE_NAME])
+        prompty = Prompty.load(source=prompty_path)
+        jinja_template = None
+        if not has_render_internals(prompty):
+            logger.warning("Rendering prompt template %s with Prompty.render, promptflow internals changed", name)
+        elif prompty._model.api == "chat":
+            jinja_template = Template(
+                _prompty_utils.preprocess_template_string(prompty._template),
+                trim_blocks=True,
+                keep_trailing_newline=True,
+            )
+        return cls(
+            name=name,
+            prompty=prompty,
+            parameters=MappingProxyType(dict(prompty._model.parameters)),
+            configuration=MappingProxyType(dict(prompty._model.configuration)),
+            mtimes=mtimes,
+            jinja_template=jinja_template,
+        )
+
+    def is_stale(self) -> bool:
+        """Check whether any of the files the template was loaded from changed on disk."""
+        try:
+            return _file_mtimes([path for path, _ in self.mtimes]) != self.mtimes
+        except OSError:
+            return True
+
+    def get_parameters(
+        self, overrides: Optional[Dict[str, Any]] = None, allowed_params: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """Get the chat completion parameters of the template with the request overrides applied.
+
+        Args:
+            overrides (dict): The overrides sent with the request.
+            allowed_params (list[str]): The parameters that can be overridden, usually
+                `LLMClient.allowed_chat_completion_params`.
+        Returns:
+            dict: A new dictionary with the parameters, safe to modify.
+        """
+        parameters = dict(self.parameters)
+        if overrides and allowed_params:
+            parameters.update({param: overrides[param] for param in allowed_params if overrides.get(param) is not None})
+        return parameters
+
+    def render(self, **inputs) -> str:
+        return self.prompty.render(**inputs)
+
+    def render_messages(self, **inputs) -> list[ChatCompletionMessageParam]:
+        """Render the template into a list of chat messages.
+
+        The result is the same as parsing the output of `render` with `ast.literal_eval`, without building
+        and parsing the Python literal string. The Jinja template is compiled once, when the template is loaded.
+        The output of `render` is parsed if the internals of promptflow used to do so are not available.
+
+        Args:
+            **inputs: The inputs of the Prompty template.
+        Returns:
+            list[ChatCompletionMessageParam]: The messages to send to the chat completion API.
+        """
+        if self.jinja_template is None:
+            return ast.literal_eval(self.render(**inputs))
+
+        resolved_inputs = self.prompty._resolve_inputs(inputs)
+        escaper = _prompty_utils.Escaper
+
+        # Same steps as promptflow's build_messages: escape the roles found in the inputs, so that user content
+        # cannot start a new message, render and parse the chat, then restore the escaped roles.
+        input_names = list(resolved_inputs.keys())
+        escape_dict = escaper.build_escape_dict_from_kwargs(_inputs_to_escape=input_names, **resolved_inputs)
+        escaped_inputs = escaper.escape_kwargs(
+            escape_dict=escape_dict, _inputs_to_escape=input_names, **resolved_inputs
+        )
+        chat_str = self.jinja_template.render(**escaped_inputs)
+        messages = _prompty_utils.parse_chat(
+            chat_str, images=_prompty_utils.find_referenced_image_set(resolved_inputs), escape_dict=escape_dict
+        )
+        if escape_dict:
+            for message in messages:
+                for key, value in message.items():
+                    message[key] = escaper.unescape_roles(value, escape_dict)
+        return messages
+
+
+class PromptTemplateRegistry:
+    """Registry of the Prompty templates and tools of the supported models.
+
+    The templates are parsed once when the registry is created, instead of on every request.
+    Models sharing a template folder share the same `PromptTemplate` objects. A template is only
+    reloaded from disk when the mtime of one of its files changes. The mtimes are checked at most every
+    `check_interval` seconds, so that the lookups of the requests do not stat the files.
+
+    Attributes:
+        available_models (dict[str, ModelConfig]): The models to load the templates for.
+        check_interval (float): Minimum number of seconds between the checks of the files of a template.
+    """
+
+    def __init__(
+        self,
+        available_models: Dict[str, ModelConfig],
+        check_interval: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.available_models = available_models
+        self.check_interval = check_interval
+        self._clock = clock
+        self._templates: Dict[Tuple[Path, str], PromptTemplate] = {}
+        self._tools: Dict[Path, Tuple[Optional[List[Any]], Tuple[Tuple[Path, int], ...]]] = {}
+        self._checked_at: Dict[Union[Path, Tuple[Path, str]], float] = {}
+        self._lock = threading.Lock()
+        for model_config in available_models.values():
+            self.load_model_templates(model_config)
+
+    def load_model_templates(self, model_config: ModelConfig):
+        """Load all the templates available in the template folder of the given model."""
+        path = model_config.template_path
+        for name in PROMPT_TEMPLATE_NAMES:
+            if (path, name) not in self._templates and (path / f"{name}.prompty").exists():
+                self._load_template(path, name)
+        if path not in self._tools:
+            self._load_tools(path)
+
+    def get(self, model_config: ModelConfig, name: str) -> PromptTemplate:
+        """Get a template of a model, reloading it if its files changed since it was loaded.
+
+        Args:
+            model_config (ModelConfig): The configuration of the model.
+            name (str): The name of the template, one of "ask", "chat" or "query".
+        Returns:
+            PromptTemplate: The shared template. It must not be modified.
+        Raises:
+            ValueError: If the model has no template with the given name.
+        """
+        path = model_config.template_path
+        template = self._templates.get((path, name))
+        if template is None or (self._should_check((path, name)) and template.is_stale()):
+            if not (path / f"{name}.prompty").exists():
+                raise ValueError(
+                    f"Model {model_config.display_name} is not supported. Please create a {name} template for this model."
+                )
+            template = self._load_template(path, name)
+        return template
+
+    def get_tools(self, model_config: ModelConfig) -> Optional[List[Any]]:
+        """Get the tools of a model, as defined in the `tools.json` file of its template folder."""
+        path = model_config.template_path
+        tools, mtimes = self._tools.get(path, (None, ()))
+        if path not in self._tools or (self._should_check(path) and _file_mtimes([path / TOOLS_FILE_NAME]) != mtimes):
+            tools = self._load_tools(path)
+        return tools
+
+    def _should_check(self, key: Union[Path, Tuple[Path, str]]) -> bool:
+        """Whether the files of a template or of the tools are due for a check, at most every `check_interval`."""
+        now = self._clock()
+        if now < self._checked_at.get(key, float("-inf")) + self.check_interval:
+            return False
+        self._checked_at[key] = now
+        return True
+
+    def _load_template(self, path: Path, name: str) -> PromptTemplate:
+        template = PromptTemplate.load(path, name)
+        with self._lock:
+            self._templates[(path, name)] = template
+            self._checked_at[(path, name)] = self._clock()
+        logger.info("Loaded prompt template %s from %s", name, path)
+        return template
+
+    def _load_tools(self, path: Path) -> Optional[List[Any]]:
+        tools_path = path / TOOLS_FILE_NAME
+        mtimes = _file_mtimes([tools_path])
+        tools = None
+        if mtimes:
+            with open(tools_path, encoding="utf-8") as f:
+                tools = json.load(f)
+        with self._lock:
+            self._tools[path] = (tools, mtimes)
+            self._checked_at[path] = self._clock()
+        return tools
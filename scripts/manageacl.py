@@ -2,7 +2,9 @@ import argparse
 import asyncio
 import json
 import logging
-from typing import Any, Union
+import sys
+from pathlib import Path
+from typing import Any, Iterable, Optional, Union
 from urllib.parse import urljoin
 
 from azure.core.credentials import AzureKeyCredential
@@ -15,6 +17,10 @@ from azure.search.documents.indexes.models import (
     SimpleField,
 )
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "backend"))
+
+from prepdocslib.searchmanager import acl_group_key  # noqa: E402
+
 logger = logging.getLogger("manageacl")
 
 
@@ -32,6 +38,7 @@ class ManageAcl:
         acl_type: str,
         acl: str,
         credentials: Union[AsyncTokenCredential, AzureKeyCredential],
+        acl_groups_index: Optional[str] = None,
     ):
         """
         Initializes the command
@@ -45,13 +52,15 @@ class ManageAcl:
         url
             Full Blob storage URL of the document to manage acls for
         acl_action
-            Action to take regarding the index or document. Valid values include enable_acls (turn acls on for the entire index), view (print acls for the document), remove_all (remove all acls), remove (remove a specific acl), or add (add a specific acl)
+            Action to take regarding the index or document. Valid values include enable_acls (turn acls on for the entire index), view (print acls for the document), remove_all (remove all acls), remove (remove a specific acl), add (add a specific acl), or register_acl_groups (register the groups of all documents in the acl groups index)
         acl_type
             Type of acls to manage. Valid values include groups or oids.
         acl
             The actual value of the acl, if the acl action is add or remove
         credentials
             Credentials for the azure search service
+        acl_groups_index
+            Optional name of the index of the groups referenced by the documents, where added groups are registered
         """
         self.service_name = service_name
         self.index_name = index_name
@@ -60,9 +69,10 @@ class ManageAcl:
         self.acl_action = acl_action
         self.acl_type = acl_type
         self.acl = acl
+        self.acl_groups_index = acl_groups_index
 
     async def run(self):
-        endpoint = f"https://{self.service_name}.search.windows.net"
+        endpoint = search_client_endpoint(self.service_name)
         if self.acl_action == "enable_acls":
             await self.enable_acls(endpoint)
             return
@@ -80,6 +90,8 @@ class ManageAcl:
                 await self.add_acl(search_client)
             elif self.acl_action == "update_storage_urls":
                 await self.update_storage_urls(search_client)
+            elif self.acl_action == "register_acl_groups":
+                await self.register_all_acl_groups(search_client)
             else:
                 raise Exception(f"Unknown action {self.acl_action}")
 
@@ -134,6 +146,32 @@ class ManageAcl:
             await search_client.merge_documents(documents=documents_to_merge)
         else:
             logger.info("Not updating any search documents")
+        if self.acl_type == "groups":
+            await self.register_acl_groups([self.acl])
+
+    async def register_acl_groups(self, groups: Iterable[str]):
+        if not self.acl_groups_index:
+            return
+        documents = [{"id": acl_group_key(group), "group": group} for group in sorted(set(groups))]
+        if len(documents) == 0:
+            return
+        logger.info("Registering %d groups in index %s", len(documents), self.acl_groups_index)
+        async with SearchClient(
+            endpoint=search_client_endpoint(self.service_name),
+            index_name=self.acl_groups_index,
+            credential=self.credentials,
+        ) as acl_groups_client:
+            await acl_groups_client.merge_or_upload_documents(documents=documents)
+
+    async def register_all_acl_groups(self, search_client: SearchClient):
+        """Register the groups of all the documents, e.g. for documents added before the index of groups existed."""
+        if not self.acl_groups_index:
+            raise Exception("The register_acl_groups action requires --acl-groups-index")
+        documents = await search_client.search("", filter="groups/any()", select=["groups"])
+        groups = set()
+        async for document in documents:
+            groups.update(document["groups"])
+        await self.register_acl_groups(groups)
 
     async def get_documents(self, search_client: SearchClient):
         filter = f"storageUrl eq '{self.url}'"
@@ -201,6 +239,10 @@ class ManageAcl:
             logger.info("Not updating any search documents")
 
 
+def search_client_endpoint(service_name: str) -> str:
+    return f"https://{service_name}.search.windows.net"
+
+
 async def main(args: Any):
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
     azd_credential = (
@@ -220,6 +262,7 @@ async def main(args: Any):
         acl_type=args.acl_type,
         acl=args.acl,
         credentials=search_credential,
+        acl_groups_index=args.acl_groups_index,
     )
     await command.run()
 
@@ -248,11 +291,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--acl-action",
         required=False,
-        choices=["remove", "add", "view", "remove_all", "enable_acls", "update_storage_urls"],
+        choices=["remove", "add", "view", "remove_all", "enable_acls", "update_storage_urls", "register_acl_groups"],
         help="Optional. Whether to remove or add the ACL to the document, or enable acls on the index",
     )
     parser.add_argument("--acl", required=False, default=None, help="Optional. Value of ACL to add or remove.")
     parser.add_argument("--url", required=False, help="Optional. Storage URL of document to update ACLs for")
+    parser.add_argument(
+        "--acl-groups-index",
+        required=False,
+        help="Optional. Name of the index of the groups referenced by the documents, where added groups are registered",
+    )
     parser.add_argument(
         "--tenant-id", required=False, help="Optional. Use this to define the Azure directory where to authenticate)"
     )
@@ -264,8 +312,8 @@ if __name__ == "__main__":
         # to avoid seeing the noisy INFO level logs from the Azure SDKs
         logger.setLevel(logging.INFO)
 
-    if not args.acl_type and args.acl_action != "enable_acls" and args.acl_action != "update_storage_urls":
-        print("Must specify either --acl-type or --acl-action enable_acls or --acl-action update_storage_urls")
+    if not args.acl_type and args.acl_action not in ["enable_acls", "update_storage_urls", "register_acl_groups"]:
+        print("Must specify either --acl-type or --acl-action enable_acls, update_storage_urls or register_acl_groups")
         exit(1)
 
     asyncio.run(main(args))
@@ -29,6 +29,9 @@ if ($env:AZURE_ADLS_GEN2_STORAGE_ACCOUNT) {
 if ($env:AZURE_USE_AUTHENTICATION) {
     $aclArg = "--useacls"
 }
+if ($env:AZURE_SEARCH_ACL_GROUPS_INDEX) {
+  $aclGroupsIndexArg = "--aclgroupsindex $env:AZURE_SEARCH_ACL_GROUPS_INDEX"
+}
 # Optional Search Analyzer name if using a custom analyzer
 if ($env:AZURE_SEARCH_ANALYZER_NAME) {
   $searchAnalyzerNameArg = "--searchanalyzername $env:AZURE_SEARCH_ANALYZER_NAME"
@@ -90,7 +93,7 @@ $argumentList = "./app/backend/prepdocs.py $dataArg --verbose " + `
 "--documentintelligenceservice $env:AZURE_DOCUMENTINTELLIGENCE_SERVICE " + `
 "$searchImagesArg $visionEndpointArg " + `
 "$adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg  " + `
-"$tenantArg $aclArg " + `
+"$tenantArg $aclArg $aclGroupsIndexArg " + `
 "$disableVectorsArg $localPdfParserArg $localHtmlParserArg " + `
 "$integratedVectorizationArg " + `
 "$additionalArgs "
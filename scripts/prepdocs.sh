@@ -30,6 +30,11 @@ if [ -n "$AZURE_USE_AUTHENTICATION" ]; then
   aclArg="--useacls"
 fi
 
+aclGroupsIndexArg=""
+if [ -n "$AZURE_SEARCH_ACL_GROUPS_INDEX" ]; then
+  aclGroupsIndexArg="--aclgroupsindex $AZURE_SEARCH_ACL_GROUPS_INDEX"
+fi
+
 visionEndpointArg=""
 if [ -n "$AZURE_VISION_ENDPOINT" ]; then
   visionEndpointArg="--visionendpoint $AZURE_VISION_ENDPOINT"
@@ -86,7 +91,7 @@ $openAiApiKeyArg --openaiorg "$OPENAI_ORGANIZATION" \
 --documentintelligenceservice "$AZURE_DOCUMENTINTELLIGENCE_SERVICE" \
 $searchImagesArg $visionEndpointArg \
 $adlsGen2StorageAccountArg $adlsGen2FilesystemArg $adlsGen2FilesystemPathArg \
-$tenantArg $aclArg \
+$tenantArg $aclArg $aclGroupsIndexArg \
 $disableVectorsArg $localPdfParserArg $localHtmlParserArg \
 $integratedVectorizationArg \
 $additionalArgs
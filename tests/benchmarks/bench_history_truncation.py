@@ -0,0 +1,163 @@
+"""Benchmark of the truncation of the chat history of the Hugging Face models.
+
+Compares the former path, which patched `tiktoken.encoding_for_model` for the Hugging Face models and loaded the
+tokenizer with `AutoTokenizer.from_pretrained` for every counted message, with the tokenizers of the
+TokenizerRegistry passed to `build_past_messages`. The history has 20 turns and is truncated to 1500 tokens.
+
+The tokenizers of the Llama, Mistral and Phi-3 models are loaded from the Hugging Face hub, or its local cache.
+When they cannot be loaded, e.g. without network access or access to the gated models, a BPE tokenizer with a
+vocabulary of 32000 tokens is trained and saved locally as a stand-in, which is reloaded like a model of the hub.
+
+Usage: python tests/benchmarks/bench_history_truncation.py [--iterations 20] [--turns 20] [--max-tokens 1500]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+import tiktoken  # noqa: E402
+from openai_messages_token_helper import model_helper  # noqa: E402
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers  # noqa: E402
+from transformers import AutoTokenizer, PreTrainedTokenizerFast  # noqa: E402
+
+from approaches.chatapproach import ChatApproach  # noqa: E402
+from core.messageshelper import build_past_messages  # noqa: E402
+from core.tokenizers import TokenizerRegistry  # noqa: E402
+from templates.supported_models import MODEL_CONFIGS  # noqa: E402
+
+MODELS = [
+    "meta-llama/Meta-Llama-3-8B-Instruct",
+    "mistralai/Mistral-7B-Instruct-v0.3",
+    "microsoft/Phi-3-mini-4k-instruct",
+]
+assert set(MODELS) <= {config.model_name for config in MODEL_CONFIGS.values() if not isinstance(config, dict)}
+
+ANSWER = (
+    "The Northwind Health Plus plan covers in-network and out-of-network visits, with a deductible of $2,000 "
+    "per year. Preventive care is covered at 100% and prescriptions have a copay [Benefit_Options-2.pdf]. "
+)
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_sources",
+            "description": "Retrieve sources from the Azure AI Search index",
+            "parameters": {
+                "type": "object",
+                "properties": {"search_query": {"type": "string", "description": "Query string to retrieve documents"}},
+                "required": ["search_query"],
+            },
+        },
+    }
+]
+
+
+def build_history(turns: int) -> list:
+    history = []
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"Question {turn}: what does my plan cover for the visits?"})
+        history.append({"role": "assistant", "content": ANSWER * 3})
+    return history
+
+
+def save_stand_in_tokenizer(directory: Path) -> str:
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=32000, special_tokens=["<unk>", "<s>", "</s>"])
+    corpus = [f"{ANSWER} {word}{i}" for i in range(20000) for word in ("plan", "visit", "copay")]
+    tokenizer.train_from_iterator(corpus, trainer)
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>").save_pretrained(directory)
+    return str(directory)
+
+
+@contextmanager
+def former_select_encoding():
+    """The former `messageshelper.select_encoding`, which loaded the tokenizer for every counted message."""
+    original_encoding_for_model = model_helper.encoding_for_model
+    original_tiktoken_encoding = tiktoken.encoding_for_model
+
+    def hugging_face_encoding(model, *args):
+        return AutoTokenizer.from_pretrained(model)
+
+    model_helper.encoding_for_model = hugging_face_encoding
+    tiktoken.encoding_for_model = hugging_face_encoding
+    try:
+        yield
+    finally:
+        model_helper.encoding_for_model = original_encoding_for_model
+        tiktoken.encoding_for_model = original_tiktoken_encoding
+
+
+def former_build_past_messages(model: str, history: list, max_tokens: int) -> list:
+    with former_select_encoding():
+        total = model_helper.count_tokens_for_system_and_tools(
+            model, {"role": "system", "content": ChatApproach.query_prompt_template}, TOOLS
+        )
+        for shot in ChatApproach.query_prompt_few_shots:
+            total += model_helper.count_tokens_for_message(model, shot)
+        total += model_helper.count_tokens_for_message(model, {"role": "user", "content": "And for prescriptions?"})
+        for message in reversed(history):
+            total += model_helper.count_tokens_for_message(model, message)
+            if total > max_tokens:
+                break
+    return history
+
+
+def new_build_past_messages(registry: TokenizerRegistry, model: str, history: list, max_tokens: int) -> list:
+    return build_past_messages(
+        model,
+        registry.get(model, "hf"),
+        ChatApproach.query_prompt_template,
+        max_tokens,
+        tools=TOOLS,
+        new_user_content="And for prescriptions?",
+        few_shots=ChatApproach.query_prompt_few_shots,
+        past_messages=history,
+    )
+
+
+def measure(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=1500)
+    args = parser.parse_args()
+
+    history = build_history(args.turns)
+    with tempfile.TemporaryDirectory() as directory:
+        stand_in = None
+        for model in MODELS:
+            name = model
+            try:
+                AutoTokenizer.from_pretrained(model)
+            except (OSError, ValueError):
+                stand_in = stand_in or save_stand_in_tokenizer(Path(directory))
+                model, name = stand_in, f"{model} (stand-in tokenizer)"
+            registry = TokenizerRegistry()
+            new_build_past_messages(registry, model, history, args.max_tokens)
+            former_time = measure(
+                lambda: former_build_past_messages(model, history, args.max_tokens), max(1, args.iterations // 10)
+            )
+            new_time = measure(
+                lambda: new_build_past_messages(registry, model, history, args.max_tokens), args.iterations
+            )
+            print(
+                f"{name}: {former_time * 1000:.1f} ms per turn with a load per message, "
+                f"{new_time * 1000:.2f} ms with the registry ({former_time / new_time:.0f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Microbenchmark of the serialization of the NDJSON events of /chat/stream.
+
+Compares the former path, which converted every OpenAI chunk with `model_dump` and serialized the events with
+`json.dumps` and a `JSONEncoder` calling `dataclasses.asdict`, with the JSONSerializer and its compiled encoders,
+with the json and orjson backends. The first event carries the thought process, with the prompt messages and 10
+search results, and is followed by 500 chunks of the answer.
+
+Usage: python tests/benchmarks/bench_ndjson_streaming.py [--iterations 20] [--chunks 500]
+"""
+
+import argparse
+import dataclasses
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+from openai.types.chat import ChatCompletionChunk  # noqa: E402
+
+from approaches.approach import Document, ThoughtStep  # noqa: E402
+from core.jsonserializer import JSONSerializer, to_jsonable  # noqa: E402
+
+SOURCES = 10
+
+
+class FormerJSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclasses.asdict(o)
+        return super().default(o)
+
+
+def build_first_event() -> dict:
+    documents = [
+        Document(
+            id=f"file-Benefit_Options_pdf-{i}",
+            content="The plan covers in-network visits with a deductible. " * 20,
+            embedding=None,
+            image_embedding=None,
+            category=None,
+            sourcepage=f"Benefit_Options-{i}.pdf",
+            sourcefile="Benefit_Options.pdf",
+            oids=[],
+            groups=[],
+            captions=[],
+            score=0.03,
+            reranker_score=2.5,
+        )
+        for i in range(SOURCES)
+    ]
+    messages = [{"role": "system", "content": "Assistant helps the company employees. " * 20}] + [
+        {"role": "user", "content": f"Question {turn}: what does my plan cover?"} for turn in range(10)
+    ]
+    thoughts = [
+        ThoughtStep("Prompt to generate search query", messages, {"model": "gpt-35-turbo"}),
+        ThoughtStep("Search using generated search query", "deductible", {"top": SOURCES, "use_text_search": True}),
+        ThoughtStep("Search results", [document.serialize_for_results() for document in documents]),
+        ThoughtStep("Prompt to generate answer", messages, {"model": "gpt-35-turbo"}),
+    ]
+    data_points = {"text": [f"{document.sourcepage}: {document.content}" for document in documents]}
+    return {
+        "delta": {"role": "assistant"},
+        "context": {"data_points": data_points, "thoughts": thoughts},
+        "session_state": None,
+    }
+
+
+def build_chunks(count: int) -> list:
+    return [
+        ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": f" token{i}"},
+                        "finish_reason": None,
+                        "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}},
+                    }
+                ],
+            }
+        )
+        for i in range(count)
+    ]
+
+
+def former_dumps(event: dict) -> bytes:
+    return (json.dumps(event, ensure_ascii=False, cls=FormerJSONEncoder) + "\n").encode("utf-8")
+
+
+def former_chunk(chunk: ChatCompletionChunk) -> bytes:
+    event = chunk.model_dump()
+    return former_dumps({"delta": event["choices"][0]["delta"]})
+
+
+def measure(function, items: list, iterations: int) -> float:
+    """Measure the CPU time per item of a function."""
+    start = time.process_time()
+    for _ in range(iterations):
+        for item in items:
+            function(item)
+    return (time.process_time() - start) / iterations / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=500)
+    args = parser.parse_args()
+
+    first_event = build_first_event()
+    chunks = build_chunks(args.chunks)
+    json_serializer = JSONSerializer(use_orjson=False)
+    orjson_serializer = JSONSerializer()
+    variants = {
+        "json.dumps + model_dump": (former_dumps, former_chunk),
+        "JSONSerializer (json)": (
+            json_serializer.dumps_line,
+            lambda chunk: json_serializer.dumps_line({"delta": to_jsonable(chunk.choices[0].delta)}),
+        ),
+        "JSONSerializer (orjson)": (
+            orjson_serializer.dumps_line,
+            lambda chunk: orjson_serializer.dumps_line({"delta": to_jsonable(chunk.choices[0].delta)}),
+        ),
+    }
+    for dumps_event, dumps_chunk in variants.values():
+        assert json.loads(dumps_event(first_event)) == json.loads(former_dumps(first_event))
+        assert json.loads(dumps_chunk(chunks[0])) == json.loads(former_chunk(chunks[0]))
+
+    baseline = None
+    for name, (dumps_event, dumps_chunk) in variants.items():
+        first_event_time = measure(dumps_event, [first_event], args.iterations * 10)
+        chunk_time = measure(dumps_chunk, chunks, args.iterations)
+        baseline = baseline or chunk_time
+        print(
+            f"{name}: first event {first_event_time * 1_000_000:.0f} us, "
+            f"{chunk_time * 1_000_000:.1f} us CPU per chunk ({baseline / chunk_time:.1f}x the speed of json.dumps)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Load test of the on-behalf-of token exchange against concurrent streaming responses.
+
+Streams tokens every 10 ms, as a chat response does, while users log in. Each exchange takes 200 ms, as a round
+trip to Entra ID may. It compares calling MSAL from the event loop, as the app used to do, with
+`AuthenticationHelper.acquire_token_on_behalf_of`, and reports the worst delay between two tokens of a stream.
+
+Usage: python tests/benchmarks/bench_obo_login.py [--streams 20] [--logins 10] [--latency 0.2]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+from core.authentication import AuthenticationHelper  # noqa: E402
+
+TOKENS_PER_STREAM = 100
+TOKEN_INTERVAL = 0.01
+
+
+class MockConfidentialClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.exchanges = 0
+
+    def acquire_token_on_behalf_of(self, user_assertion: str, scopes: list) -> dict:
+        self.exchanges += 1
+        time.sleep(self.latency)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": user_assertion, "groups": []}}
+
+
+async def stream(gaps: list):
+    last = time.monotonic()
+    for _ in range(TOKENS_PER_STREAM):
+        await asyncio.sleep(TOKEN_INTERVAL)
+        now = time.monotonic()
+        gaps.append(now - last - TOKEN_INTERVAL)
+        last = now
+
+
+async def run(helper: AuthenticationHelper, streams: int, logins: int, in_executor: bool) -> list:
+    gaps: list = []
+
+    async def login(user: int):
+        # Spread the logins over the lifetime of the streams, with two concurrent requests per user
+        await asyncio.sleep(user * TOKENS_PER_STREAM * TOKEN_INTERVAL / logins / 2)
+        if in_executor:
+            await asyncio.gather(*(helper.acquire_token_on_behalf_of(f"Token{user}") for _ in range(2)))
+        else:
+            for _ in range(2):
+                helper.confidential_client.acquire_token_on_behalf_of(
+                    user_assertion=f"Token{user}", scopes=[AuthenticationHelper.scope]
+                )
+
+    await asyncio.gather(*(stream(gaps) for _ in range(streams)), *(login(user) for user in range(logins)))
+    return gaps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    helper = AuthenticationHelper(
+        search_index=None,
+        use_authentication=False,
+        server_app_id="SERVER_APP",
+        server_app_secret="SERVER_SECRET",
+        client_app_id="CLIENT_APP",
+        tenant_id="TENANT_ID",
+    )
+    for in_executor in (False, True):
+        client = MockConfidentialClient(args.latency)
+        helper.confidential_client = client
+        helper.obo_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="obo")
+        gaps = asyncio.run(run(helper, args.streams, args.logins, in_executor))
+        gaps_ms = sorted(gap * 1000 for gap in gaps)
+        name = "executor" if in_executor else "event loop"
+        asyncio.run(helper.close())
+        print(
+            f"{name:>10}: {client.exchanges} exchanges, stream delay median {statistics.median(gaps_ms):.1f} ms, "
+            f"p99 {gaps_ms[int(len(gaps_ms) * 0.99)]:.1f} ms, max {gaps_ms[-1]:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Microbenchmark of the prompt rendering of the chat approaches.
+
+Compares rendering a Prompty into a string and parsing it back with `ast.literal_eval`, as the approaches used
+to do, with `PromptTemplate.render_messages`, on 20-turn conversations with 10 sources.
+
+Usage: python tests/benchmarks/bench_prompt_rendering.py [--iterations 200]
+"""
+
+import argparse
+import ast
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+from templates.prompt_registry import PromptTemplateRegistry  # noqa: E402
+from templates.supported_models import get_supported_models  # noqa: E402
+
+TURNS = 20
+SOURCES = 10
+
+
+def build_inputs() -> dict:
+    past_messages = []
+    for turn in range(TURNS):
+        past_messages.append({"role": "user", "content": f"Question {turn}: what does my plan cover for visit {turn}?"})
+        past_messages.append(
+            {"role": "assistant", "content": f"Answer {turn}: visits are covered [Benefit_Options-{turn}.pdf]. " * 5}
+        )
+    sources = [
+        f"Benefit_Options-{i}.pdf: " + "The plan covers in-network visits with a deductible. " * 20
+        for i in range(SOURCES)
+    ]
+    return {
+        "system_message": "Assistant helps the company employees with their healthcare plan questions.",
+        "question": "What is the deductible for a visit to Overlake?",
+        "few_shots": past_messages[:4],
+        "past_messages": past_messages,
+        "sources": sources,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    registry = PromptTemplateRegistry(
+        get_supported_models({"type": "openai", "model_name": "gpt-3.5-turbo", "deployment_name": ""})
+    )
+    model_config = registry.available_models["GPT 3.5 Turbo"]
+    inputs = build_inputs()
+
+    for name in ["query", "chat"]:
+        template = registry.get(model_config, name)
+        template_inputs = {key: inputs[key] for key in template.prompty._get_input_signature()}
+        assert template.render_messages(**template_inputs) == ast.literal_eval(template.render(**template_inputs))
+
+        literal_eval_time = timeit.timeit(
+            lambda: ast.literal_eval(template.render(**template_inputs)), number=args.iterations
+        )
+        structured_time = timeit.timeit(lambda: template.render_messages(**template_inputs), number=args.iterations)
+        print(
+            f"{name}.prompty: render + literal_eval {literal_eval_time / args.iterations * 1000:.3f} ms, "
+            f"render_messages {structured_time / args.iterations * 1000:.3f} ms "
+            f"({literal_eval_time / structured_time:.1f}x faster)"
+        )
+
+
+if __name__ == "__main__":
+    main()
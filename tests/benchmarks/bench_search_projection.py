@@ -0,0 +1,98 @@
+"""Microbenchmark of the size and deserialization time of search responses with and without a `select` projection.
+
+Compares a response with all the fields of the index, including the 1536 dimensions text embedding and the 1024
+dimensions image embedding, with a response projected on the fields read by the approaches, for top=10 results.
+
+Usage: python tests/benchmarks/bench_search_projection.py [--iterations 200] [--top 10]
+"""
+
+import argparse
+import json
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+from azure.search.documents._generated.models import SearchDocumentsResult  # noqa: E402
+
+from approaches.approach import Approach, Document  # noqa: E402
+
+TEXT_EMBEDDING_DIMENSIONS = 1536
+IMAGE_EMBEDDING_DIMENSIONS = 1024
+
+
+def build_response(top: int, fields: list) -> bytes:
+    rng = random.Random(0)
+    documents = []
+    for i in range(top):
+        document = {
+            "@search.score": 0.03,
+            "@search.rerankerScore": 2.5,
+            "id": f"file-Benefit_Options_pdf-{i}",
+            "content": "The plan covers in-network visits with a deductible. " * 20,
+            "category": None,
+            "sourcepage": f"Benefit_Options-{i}.pdf",
+            "sourcefile": "Benefit_Options.pdf",
+            "oids": ["00000000-0000-0000-0000-000000000000"],
+            "groups": ["00000000-0000-0000-0000-000000000001"],
+            "storageUrl": "https://account.blob.core.windows.net/content/Benefit_Options.pdf",
+            "embedding": [rng.uniform(-1, 1) for _ in range(TEXT_EMBEDDING_DIMENSIONS)],
+            "imageEmbedding": [rng.uniform(-1, 1) for _ in range(IMAGE_EMBEDDING_DIMENSIONS)],
+        }
+        documents.append({key: value for key, value in document.items() if key.startswith("@") or key in fields})
+    return json.dumps({"value": documents}).encode("utf-8")
+
+
+def deserialize(response: bytes) -> list:
+    # What the search client and Approach.search do with each page of results
+    results = SearchDocumentsResult.deserialize(json.loads(response))
+    documents = []
+    for result in results.results:
+        document = {**result.additional_properties, "@search.score": result.score}
+        documents.append(
+            Document(
+                id=document.get("id"),
+                content=document.get("content"),
+                embedding=document.get("embedding"),
+                image_embedding=document.get("imageEmbedding"),
+                category=document.get("category"),
+                sourcepage=document.get("sourcepage"),
+                sourcefile=document.get("sourcefile"),
+                oids=document.get("oids"),
+                groups=document.get("groups"),
+                captions=[],
+                score=document.get("@search.score"),
+                reranker_score=result.reranker_score,
+            )
+        )
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    all_fields = Approach.SEARCH_FIELDS + Approach.ACL_FIELDS + ["storageUrl", "embedding", "imageEmbedding"]
+    projections = {
+        "all fields": all_fields,
+        "select with vectors": Approach.SEARCH_FIELDS + Approach.ACL_FIELDS + ["embedding", "imageEmbedding"],
+        "select": Approach.SEARCH_FIELDS + Approach.ACL_FIELDS,
+    }
+    baseline_time = None
+    for name, fields in projections.items():
+        response = build_response(args.top, fields)
+        assert len(deserialize(response)) == args.top
+        elapsed = timeit.timeit(lambda: deserialize(response), number=args.iterations) / args.iterations
+        baseline_time = baseline_time or elapsed
+        print(
+            f"{name}: {len(response) / 1024:.1f} KiB, deserialization {elapsed * 1000:.3f} ms "
+            f"({baseline_time / elapsed:.1f}x the speed of all fields)"
+        )
+
+
+if __name__ == "__main__":
+    main()
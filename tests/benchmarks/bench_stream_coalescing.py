@@ -0,0 +1,130 @@
+"""Benchmark of the frames and CPU time per streamed answer with and without coalescing the deltas.
+
+Streams concurrent answers of 300 tokens, each token arriving every 5 ms as an OpenAI chunk, through
+`ChatApproach.run_with_streaming` and `format_as_ndjson`, and writes each frame to a local TCP connection. Counts the
+NDJSON frames and the CPU time of the process per answer, including the reading side of the connections, for
+several settings of the DeltaCoalescer.
+
+Usage: python tests/benchmarks/bench_stream_coalescing.py [--streams 50] [--tokens 300] [--interval 0.005] [--repeat 5]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "app" / "backend"))
+
+from openai.types.chat import ChatCompletionChunk  # noqa: E402
+
+from app import format_as_ndjson  # noqa: E402
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+from core.deltacoalescer import DeltaCoalescer  # noqa: E402
+
+
+def build_approach(delta_coalescer: Optional[DeltaCoalescer]) -> ChatReadRetrieveReadApproach:
+    return ChatReadRetrieveReadApproach(
+        search_client=None,  # type: ignore[arg-type]
+        auth_helper=None,  # type: ignore[arg-type]
+        llm_clients={},
+        emb_client=None,  # type: ignore[arg-type]
+        current_model="",
+        available_models={},
+        prompt_templates=None,  # type: ignore[arg-type]
+        prompt_protection=None,  # type: ignore[arg-type]
+        embedding_deployment=None,
+        embedding_model="",
+        embedding_dimensions=0,
+        embedding_cache=None,
+        semantic_cache=None,
+        delta_coalescer=delta_coalescer,
+        sourcepage_field="",
+        content_field="",
+        query_language="",
+        query_speller="",
+    )
+
+
+async def chat_stream(tokens: int, interval: float):
+    for i in range(tokens):
+        await asyncio.sleep(interval)
+        yield ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "created": 1,
+                "model": "gpt-35-turbo",
+                "choices": [{"index": 0, "delta": {"content": f" tok{i % 10}"}, "finish_reason": None}],
+            }
+        )
+
+
+async def stream_answer(approach: ChatReadRetrieveReadApproach, tokens: int, interval: float, port: int) -> int:
+    async def run_until_final_call(*args, **kwargs):
+        async def chat_coroutine():
+            return chat_stream(tokens, interval)
+
+        return {"thoughts": []}, chat_coroutine()
+
+    approach.run_until_final_call = run_until_final_call  # type: ignore[method-assign]
+    events = approach.run_with_streaming([{"role": "user", "content": "question"}], {}, {})
+    # Each frame is written to a TCP connection, like the ASGI server does with the chunks of the response body
+    _, writer = await asyncio.open_connection("127.0.0.1", port)
+    frames = 0
+    async for frame in format_as_ndjson(events):
+        writer.write(frame)
+        await writer.drain()
+        frames += 1
+    writer.close()
+    await writer.wait_closed()
+    return frames
+
+
+async def discard(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while await reader.read(65536):
+        pass
+    writer.close()
+
+
+async def run(delta_coalescer: Optional[DeltaCoalescer], streams: int, tokens: int, interval: float):
+    approach = build_approach(delta_coalescer)
+    server = await asyncio.start_server(discard, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.process_time()
+    frames = await asyncio.gather(*(stream_answer(approach, tokens, interval, port) for _ in range(streams)))
+    cpu_time = time.process_time() - start
+    server.close()
+    await server.wait_closed()
+    return sum(frames) / streams, cpu_time / streams
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    settings = {
+        "no coalescing": lambda: None,
+        "window 20 ms": lambda: DeltaCoalescer(window=0.02),
+        "window 50 ms": lambda: DeltaCoalescer(window=0.05),
+        "64 characters": lambda: DeltaCoalescer(max_chars=64),
+    }
+    results: dict = {name: [] for name in settings}
+    # The settings are interleaved and the median is kept, as the timers of the streams make the runs noisy
+    for _ in range(args.repeat):
+        for name, build_coalescer in settings.items():
+            results[name].append(asyncio.run(run(build_coalescer(), args.streams, args.tokens, args.interval)))
+    for name, runs in results.items():
+        frames = runs[0][0]
+        cpu_time = statistics.median(cpu_time for _, cpu_time in runs)
+        print(f"{name}: {frames:.0f} frames per answer, {cpu_time * 1000:.1f} ms CPU per answer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import asyncio
+import gc
+
+import pytest
+
+from core.admission import AdmissionController, AdmittedStream, admit, call_admitted
+from error import UpstreamOverloadedError
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limited():
+    controller = AdmissionController("search", max_concurrency=2, max_queue=10)
+    running = 0
+    max_running = 0
+
+    async def call():
+        nonlocal running, max_running
+        async with controller.admit():
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(call() for _ in range(6)))
+    assert max_running == 2
+    metrics = controller.metrics()
+    assert metrics["admitted"] == 6
+    assert metrics["queued"] == 4
+    assert metrics["max_queue_depth"] == 4
+    assert metrics["mean_wait_ms"] > 0
+    assert metrics["active"] == 0
+    assert metrics["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rejected_when_queue_full():
+    controller = AdmissionController("openai", max_concurrency=1, max_queue=1, queue_timeout=1)
+    await controller.acquire()
+    queued = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    assert controller.queue_depth == 1
+    with pytest.raises(UpstreamOverloadedError) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.upstream == "openai"
+    controller.release()
+    await queued
+    controller.release()
+    assert controller.metrics()["rejected"] == 1
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_rejected_after_queue_timeout():
+    controller = AdmissionController("hf", max_concurrency=1, max_queue=5, queue_timeout=0.01)
+    async with controller.admit():
+        with pytest.raises(UpstreamOverloadedError):
+            await controller.acquire()
+    metrics = controller.metrics()
+    assert metrics["timed_out"] == 1
+    assert metrics["queue_depth"] == 0
+    # The slot of the timed out call was not taken
+    assert controller.active == 0
+    async with controller.admit():
+        assert controller.active == 1
+
+
+@pytest.mark.asyncio
+async def test_invalid_settings():
+    with pytest.raises(ValueError):
+        AdmissionController("openai", max_concurrency=0)
+    with pytest.raises(ValueError):
+        AdmissionController("openai", max_concurrency=1, max_queue=-1)
+
+
+@pytest.mark.asyncio
+async def test_admit_without_controller():
+    async with admit(None):
+        pass
+    assert await call_admitted(None, lambda: asyncio.sleep(0, result=42)) == 42
+
+
+@pytest.mark.asyncio
+async def test_call_admitted_releases_on_error():
+    controller = AdmissionController("search", max_concurrency=1)
+
+    async def call():
+        raise ZeroDivisionError()
+
+    with pytest.raises(ZeroDivisionError):
+        await call_admitted(controller, call)
+    assert controller.active == 0
+
+
+class MockStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_stream_holds_stream_slot_until_consumed():
+    controller = AdmissionController("openai", max_concurrency=1)
+    stream_controller = AdmissionController("openai_streams", max_concurrency=1)
+    stream = MockStream(["a", "b"])
+    admitted = await call_admitted(
+        controller, lambda: asyncio.sleep(0, result=stream), stream=True, stream_controller=stream_controller
+    )
+    assert isinstance(admitted, AdmittedStream)
+    # The slot of the call is released once the call returned, so that the other calls are not starved
+    assert controller.active == 0
+    assert stream_controller.active == 1
+    assert [chunk async for chunk in admitted] == ["a", "b"]
+    assert stream_controller.active == 0
+    assert stream.closed
+    # Closing again does not release the slot twice
+    await admitted.aclose()
+    assert stream_controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_without_stream_controller_is_not_wrapped():
+    controller = AdmissionController("openai", max_concurrency=1)
+    stream = MockStream(["a"])
+    assert await call_admitted(controller, lambda: asyncio.sleep(0, result=stream), stream=True) is stream
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_releases_slot_when_closed():
+    controller = AdmissionController("openai_streams", max_concurrency=1)
+    stream = MockStream(["a", "b"])
+    admitted = await call_admitted(
+        None, lambda: asyncio.sleep(0, result=stream), stream=True, stream_controller=controller
+    )
+    assert await admitted.__anext__() == "a"
+    await admitted.aclose()
+    assert controller.active == 0
+    assert stream.closed
+
+
+@pytest.mark.asyncio
+async def test_stream_not_admitted_is_not_called():
+    controller = AdmissionController("openai_streams", max_concurrency=1)
+    await controller.acquire()
+    called = False
+
+    async def call():
+        nonlocal called
+        called = True
+
+    with pytest.raises(UpstreamOverloadedError):
+        await call_admitted(None, call, stream=True, stream_controller=controller)
+    assert not called
+    controller.release()
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_releases_slot_when_collected():
+    controller = AdmissionController("openai_streams", max_concurrency=1)
+    admitted = await call_admitted(
+        None, lambda: asyncio.sleep(0, result=MockStream(["a"])), stream=True, stream_controller=controller
+    )
+    assert controller.active == 1
+    del admitted
+    gc.collect()
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_releases_slot_after_max_hold_time():
+    controller = AdmissionController("openai_streams", max_concurrency=1, max_hold_time=0.01)
+    stream = MockStream(["a", "b"])
+    admitted = await call_admitted(
+        None, lambda: asyncio.sleep(0, result=stream), stream=True, stream_controller=controller
+    )
+    await asyncio.sleep(0.02)
+    assert controller.active == 0
+    # The stream can still be read, and its slot is not released twice
+    assert [chunk async for chunk in admitted] == ["a", "b"]
+    assert controller.active == 0
+    assert stream.closed
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -7,8 +8,13 @@ import pytest
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
+from openai.types.chat import ChatCompletionChunk
 
 import app
+from core.admission import AdmissionController
+from core.answercache import AnswerCache
+from core.circuitbreaker import CircuitBreaker
+from core.semanticcache import SemanticAnswerCache
 
 
 def fake_response(http_code):
@@ -971,4 +977,248 @@ async def test_format_as_ndjson():
         yield {"b": "Newlines inside \n strings are fine"}
 
     result = [line async for line in app.format_as_ndjson(gen())]
-    assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+    assert result == ['{"a":"I ❤️ 🐍"}\n'.encode(), b'{"b":"Newlines inside \\n strings are fine"}\n']
+
+
+@pytest.mark.asyncio
+async def test_chat_answer_cache(client, monkeypatch):
+    client.app.config[app.CONFIG_ANSWER_CACHE] = AnswerCache(max_entries=10, ttl=60)
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text", "suggest_followup_questions": True}},
+        "session_state": "first",
+    }
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+
+    async def mock_run(*args, **kwargs):
+        raise AssertionError("The cached answer should be used")
+
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "run", mock_run)
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "run_stream", mock_run)
+
+    request_json["messages"][0]["content"] = "what is the capital of  France?"
+    request_json["session_state"] = "second"
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["message"] == result["message"]
+    assert cached_result["context"] == result["context"]
+    assert cached_result["session_state"] == "second"
+
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["context"]["data_points"] == result["context"]["data_points"]
+    assert events[0]["session_state"] == "second"
+    assert events[1]["delta"]["content"] == result["message"]["content"]
+    assert events[2]["context"]["followup_questions"] == result["context"]["followup_questions"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_answer_cache(client):
+    answer_cache = AnswerCache(max_entries=10, ttl=60)
+    client.app.config[app.CONFIG_ANSWER_CACHE] = answer_cache
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text"}},
+    }
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    streamed = await response.get_data(as_text=True)
+    assert len(answer_cache) == 1
+
+    response = await client.post("/chat/stream", json=request_json)
+    replayed = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    streamed_events = [json.loads(line) for line in streamed.splitlines()]
+    assert replayed[0] == streamed_events[0]
+    assert replayed[1]["delta"]["content"] == "".join(
+        event["delta"].get("content") or "" for event in streamed_events[1:]
+    )
+    assert answer_cache.stats.hits == 1
+
+    # Follow-up questions of a conversation are not cached
+    request_json["messages"].extend(
+        [{"content": "Paris", "role": "assistant"}, {"content": "And Spain?", "role": "user"}]
+    )
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    await response.get_data()
+    assert len(answer_cache) == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_semantic_cache(client):
+    semantic_cache = SemanticAnswerCache(threshold=0.95, max_entries=10, ttl=60)
+    client.app.config[app.CONFIG_CHAT_APPROACH].semantic_cache = semantic_cache
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "hybrid", "suggest_followup_questions": True}},
+    }
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert len(semantic_cache) == 1
+
+    request_json["messages"][0]["content"] = "Which city is the capital of France?"
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["message"]["content"] == result["message"]["content"]
+    assert cached_result["context"]["followup_questions"] == result["context"]["followup_questions"]
+    assert cached_result["context"]["thoughts"][-1]["title"] == "Answer reused from the semantic cache"
+
+    response = await client.post("/chat/stream", json=request_json)
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["context"]["thoughts"][-1]["title"] == "Answer reused from the semantic cache"
+    assert "".join(event["delta"].get("content") or "" for event in events) == result["message"]["content"]
+    assert events[-1]["context"]["followup_questions"] == result["context"]["followup_questions"]
+    assert semantic_cache.stats.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_speculative_retrieval(client, monkeypatch):
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    searched_queries = []
+    search = chat_approach.search
+
+    async def mock_search(top, query_text, *args):
+        searched_queries.append(query_text)
+        return await search(top, query_text, *args)
+
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text", "speculative_retrieval": True}},
+    }
+
+    monkeypatch.setattr(chat_approach, "get_search_query", lambda *args: "capital of France")
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    search_thought = (await response.get_json())["context"]["thoughts"][1]
+    # The results of the question are reused, but the thoughts show the rewritten query
+    assert search_thought["description"] == "capital of France"
+    assert search_thought["props"]["speculative_retrieval_hit"] is True
+    assert searched_queries == ["What is the capital of France?"]
+
+    searched_queries.clear()
+    monkeypatch.setattr(chat_approach, "get_search_query", lambda *args: "France population growth")
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    search_thought = (await response.get_json())["context"]["thoughts"][1]
+    assert search_thought["description"] == "France population growth"
+    assert search_thought["props"]["speculative_retrieval_hit"] is False
+    assert searched_queries[-1] == "France population growth"
+
+
+@pytest.mark.asyncio
+async def test_chat_speculative_retrieval_failure(client, monkeypatch):
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    searched_queries = []
+    search = chat_approach.search
+
+    async def mock_search(top, query_text, *args):
+        searched_queries.append(query_text)
+        if query_text == "What is the capital of France?":
+            raise ConnectionError("Search is unavailable")
+        return await search(top, query_text, *args)
+
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    monkeypatch.setattr(chat_approach, "get_search_query", lambda *args: "capital of France")
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "speculative_retrieval": True}},
+        },
+    )
+    # The failed speculative search falls back to a search with the rewritten query
+    assert response.status_code == 200
+    search_thought = (await response.get_json())["context"]["thoughts"][1]
+    assert search_thought["description"] == "capital of France"
+    assert search_thought["props"]["speculative_retrieval_hit"] is False
+    assert searched_queries == ["What is the capital of France?", "capital of France"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_client_disconnect(client):
+    llm_client = client.app.config[app.CONFIG_LLM_CLIENTS]["openai"]
+    create = llm_client.client.chat.completions.create
+    streams = []
+
+    class SlowChatStream:
+        closed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            await asyncio.sleep(0.01)
+            return ChatCompletionChunk.model_validate(
+                {
+                    "id": "test-123",
+                    "object": "chat.completion.chunk",
+                    "created": 1,
+                    "model": "test-model",
+                    "choices": [{"delta": {"content": " Paris"}, "index": 0, "finish_reason": None}],
+                }
+            )
+
+        async def close(self):
+            self.closed = True
+
+    async def mock_create(*args, **kwargs):
+        if not kwargs.get("stream"):
+            return await create(*args, **kwargs)
+        streams.append(SlowChatStream())
+        return streams[-1]
+
+    llm_client.client.chat.completions.create = mock_create
+    async with client.request(
+        "/chat/stream", method="POST", headers={"Content-Type": "application/json"}
+    ) as connection:
+        await connection.send(
+            json.dumps({"messages": [{"content": "What is the capital of France?", "role": "user"}]}).encode()
+        )
+        await connection.send_complete()
+        assert "context" in json.loads(await connection.receive())
+        assert json.loads(await connection.receive())["delta"]["content"] == " Paris"
+        await connection.disconnect()
+    assert streams[0].closed
+    assert client.app.config[app.CONFIG_STREAM_TRACKER].metrics()["cancelled"] == 1
+    # The slot of the cancelled answer is released
+    assert client.app.config[app.CONFIG_ADMISSION_CONTROLLERS]["openai"].active == 0
+    assert client.app.config[app.CONFIG_ADMISSION_CONTROLLERS]["openai_streams"].active == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_upstream_overloaded(client):
+    controller = AdmissionController("openai", max_concurrency=1, max_queue=0)
+    client.app.config[app.CONFIG_LLM_CLIENTS]["openai"].admission_controller = controller
+    await controller.acquire()
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    result = await response.get_json()
+    assert result["error"] == "The app is busy right now. Please try again in a few seconds."
+    assert controller.metrics()["rejected"] == 1
+    controller.release()
+
+
+@pytest.mark.asyncio
+async def test_chat_upstream_circuit_open(client):
+    breaker = CircuitBreaker("openai", window_size=1, min_calls=1)
+    breaker.record(0, ConnectionError())
+    client.app.config[app.CONFIG_LLM_CLIENTS]["openai"].circuit_breaker = breaker
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 503
+    result = await response.get_json()
+    assert result["error"] == "A service used by the app is temporarily unavailable. Please try again later."
+    assert breaker.metrics()["rejected"] == 1
@@ -1,11 +1,20 @@
+import asyncio
 import json
+import time
 
+import msal
 import pytest
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import SearchField, SearchIndex
+from jose import jwt
 
+from core.aclgroups import KnownAclGroups
 from core.authentication import AuthenticationHelper, AuthError
+from core.claimscache import ClaimsCache
+from core.groupcache import GroupCache
+from core.jwkscache import JwksCache
+from core.pathauthcache import PathAuthCache
 
 from .mocks import MockAsyncPageIterator
 
@@ -48,6 +57,26 @@ async def test_get_auth_claims_success(mock_confidential_client_success, mock_va
     assert auth_claims.get("groups") == ["GROUP_Y", "GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(monkeypatch, mock_confidential_client_success):
+    helper = create_authentication_helper()
+    helper.claims_cache = ClaimsCache(max_entries=10, ttl=300)
+    validated_tokens = []
+
+    async def mock_validate_access_token(self, token):
+        validated_tokens.append(token)
+        return {"exp": time.time() + 3600}
+
+    monkeypatch.setattr(AuthenticationHelper, "validate_access_token", mock_validate_access_token)
+
+    for _ in range(3):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer OtherToken"})
+    assert validated_tokens == ["Token", "OtherToken"]
+    assert helper.claims_cache.stats.hits == 2
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_unauthorized(mock_confidential_client_unauthorized, mock_validate_token_success):
     helper = create_authentication_helper()
@@ -65,6 +94,19 @@ async def test_get_auth_claims_overage_success(
     assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_overage_group_cache(
+    mock_confidential_client_overage, mock_list_groups_success, mock_validate_token_success
+):
+    helper = create_authentication_helper()
+    helper.group_cache = GroupCache(ttl=300)
+    for _ in range(2):
+        auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+        assert auth_claims.get("groups") == ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]
+    assert helper.group_cache.stats.refreshes == 1
+    assert helper.group_cache.stats.hits == 1
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_overage_unauthorized(
     mock_confidential_client_overage, mock_list_groups_unauthorized, mock_validate_token_success
@@ -229,6 +271,85 @@ def test_build_security_filters(mock_confidential_client_success, mock_validate_
     )
 
 
+@pytest.mark.asyncio
+async def test_build_security_filters_known_acl_groups(
+    monkeypatch, mock_confidential_client_success, mock_validate_token_success
+):
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        return MockAsyncPageIterator(data=[{"group": "GROUP_Y"}, {"group": "GROUP_W"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    helper = create_authentication_helper(require_access_control=True)
+    helper.known_acl_groups = KnownAclGroups(create_search_client())
+    auth_claims = {"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]}
+    # The groups of the user are used as they are until the known groups are loaded
+    assert (
+        helper.build_security_filters(overrides={}, auth_claims=auth_claims)
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
+    )
+
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert len(searches) == 1
+    assert (
+        helper.build_security_filters(overrides={}, auth_claims=auth_claims)
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y')))"
+    )
+    assert helper.known_acl_groups.metrics() == {
+        "known_groups": 2,
+        "loads": 1,
+        "load_failures": 0,
+        "dropped_groups": 1,
+        "missing_group_reloads": 0,
+    }
+    assert searches[0]["top"] == helper.known_acl_groups.max_groups + 1
+
+
+@pytest.mark.asyncio
+async def test_known_acl_groups_reload_when_group_missing(monkeypatch):
+    known_groups = [{"group": "GROUP_Y"}]
+
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator(data=list(known_groups))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    now = 0.0
+    acl_groups = KnownAclGroups(create_search_client(), ttl=300, reload_interval=30, clock=lambda: now)
+    await acl_groups.ensure_loaded()
+
+    # A group registered after the load is dropped until the known groups are reloaded, at most every 30 seconds
+    known_groups.append({"group": "GROUP_Z"})
+    assert acl_groups.compact(["GROUP_Y", "GROUP_Z"]) == ["GROUP_Y"]
+    now = 30
+    assert acl_groups.compact(["GROUP_Y", "GROUP_Z"]) == ["GROUP_Y"]
+    await acl_groups._load_task
+    assert acl_groups.compact(["GROUP_Y", "GROUP_Z"]) == ["GROUP_Y", "GROUP_Z"]
+    assert acl_groups.compact(["GROUP_Y", "GROUP_X"]) == ["GROUP_Y"]
+    assert acl_groups.metrics()["loads"] == 2
+    assert acl_groups.metrics()["missing_group_reloads"] == 1
+
+
+@pytest.mark.asyncio
+async def test_known_acl_groups_max_groups(monkeypatch):
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator(data=[{"group": "GROUP_X"}, {"group": "GROUP_Y"}, {"group": "GROUP_Z"}])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    acl_groups = KnownAclGroups(create_search_client(), max_groups=2)
+    await acl_groups.ensure_loaded()
+    # The known groups are incomplete, so the groups of users are used as they are
+    assert acl_groups.groups is None
+    assert acl_groups.compact(["GROUP_W", "GROUP_Z"]) == ["GROUP_W", "GROUP_Z"]
+
+    acl_groups = KnownAclGroups(create_search_client(), max_groups=3)
+    await acl_groups.ensure_loaded()
+    assert acl_groups.groups == {"GROUP_X", "GROUP_Y", "GROUP_Z"}
+
+
 @pytest.mark.asyncio
 async def test_check_path_auth_denied(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
     auth_helper_require_access_control = create_authentication_helper(require_access_control=True)
@@ -479,3 +600,172 @@ async def test_check_path_auth_allowed_public_without_access_control(
     )
     assert filter is None
     assert called_search is False
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def create_jwks_cache(responses, clock, **kwargs):
+    calls = []
+
+    async def fetch_keys():
+        calls.append(clock())
+        await asyncio.sleep(0)
+        response = responses[min(len(calls), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return {"keys": [{"kid": kid} for kid in response]}
+
+    return JwksCache(fetch_keys, ttl=100, min_refresh_interval=10, clock=clock, **kwargs), calls
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_single_flight():
+    clock = MockClock()
+    cache, calls = create_jwks_cache([["KEY_1"]], clock)
+
+    keys = await asyncio.gather(*(cache.get_key("KEY_1") for _ in range(5)))
+    assert keys == [{"kid": "KEY_1"}] * 5
+    assert len(calls) == 1
+    assert cache.stats.hits == 5
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_refreshes_on_unknown_key():
+    clock = MockClock()
+    cache, calls = create_jwks_cache([["KEY_1"], ["KEY_1", "KEY_2"]], clock)
+
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    # Recently downloaded keys are not downloaded again for every unknown key id
+    assert await cache.get_key("KEY_2") is None
+    assert len(calls) == 1
+
+    clock.now = 10
+    assert await cache.get_key("KEY_2") == {"kid": "KEY_2"}
+    assert len(calls) == 2
+    assert cache.stats.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_refreshes_in_background():
+    clock = MockClock()
+    cache, calls = create_jwks_cache([["KEY_1"], ["KEY_2"]], clock)
+
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    clock.now = 85
+    # The current keys are used while the new keys are downloaded
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    await asyncio.sleep(0.01)
+    assert calls == [0, 85]
+    assert await cache.get_key("KEY_2") == {"kid": "KEY_2"}
+    assert cache.stats.refreshes == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_serves_stale_keys():
+    clock = MockClock()
+    cache, calls = create_jwks_cache([["KEY_1"], AuthError("unavailable", 503)], clock)
+
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    clock.now = 150
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    # Failed downloads are not retried for every request
+    assert await cache.get_key("KEY_1") == {"kid": "KEY_1"}
+    assert len(calls) == 2
+    assert cache.stats.refresh_failures == 1
+    assert cache.stats.stale_lookups == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache_without_keys():
+    clock = MockClock()
+    cache, _ = create_jwks_cache([AuthError("unavailable", 503)], clock)
+
+    with pytest.raises(AuthError):
+        await cache.get_key("KEY_1")
+
+
+@pytest.mark.asyncio
+async def test_validate_access_token_unknown_key(mock_confidential_client_success):
+    helper = create_authentication_helper()
+    calls = 0
+
+    async def mock_fetch_jwks():
+        nonlocal calls
+        calls += 1
+        return {"keys": [{"kid": "KEY_1", "kty": "RSA", "use": "sig", "n": "N", "e": "AQAB"}]}
+
+    helper.jwks_cache = JwksCache(mock_fetch_jwks)
+    token = jwt.encode({"iss": helper.valid_issuers[0], "aud": "SERVER_APP"}, "secret", headers={"kid": "KEY_2"})
+
+    for _ in range(2):
+        with pytest.raises(AuthError) as exc_info:
+            await helper.validate_access_token(token)
+        assert exc_info.value.error["description"] == "Unable to find appropriate key"
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_acquire_token_on_behalf_of_does_not_block(monkeypatch, mock_confidential_client_success):
+    helper = create_authentication_helper()
+    assertions = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        assertions.append(kwargs["user_assertion"])
+        time.sleep(0.2)
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": []}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+
+    gaps = []
+
+    async def stream():
+        last = time.monotonic()
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            gaps.append(time.monotonic() - last)
+            last = time.monotonic()
+
+    start = time.monotonic()
+    tokens, _ = await asyncio.gather(
+        asyncio.gather(*(helper.acquire_token_on_behalf_of(token) for token in ["Token"] * 3 + ["OtherToken"])),
+        stream(),
+    )
+    # The stream kept running while the tokens were exchanged
+    assert max(gaps) < 0.1
+    assert [token["access_token"] for token in tokens] == ["MockToken"] * 4
+    assert sorted(assertions) == ["OtherToken", "Token"]
+    # Both exchanges ran in parallel threads
+    assert time.monotonic() - start < 0.35
+    await helper.close()
+
+
+@pytest.mark.asyncio
+async def test_check_path_auth_cached(monkeypatch, mock_confidential_client_success, mock_validate_token_success):
+    helper = create_authentication_helper(require_access_control=True)
+    helper.path_auth_cache = PathAuthCache(max_entries=10, ttl=60)
+    searched_paths = []
+
+    async def mock_search(self, *args, **kwargs):
+        searched_paths.append(kwargs.get("filter").split("sourcefile eq ")[1].split(")")[0])
+        return MockAsyncPageIterator(data=[])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+
+    user_x = {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    user_z = {"oid": "OID_Z", "groups": []}
+    helper.preauthorize_paths(user_x, ["Benefit_Options.pdf#page=2", "Benefit_Options-2.png"])
+
+    for path in ["Benefit_Options.pdf#page=3", "Benefit_Options-2.png", "Secret.pdf", "Secret.pdf#page=1"]:
+        allowed = await helper.check_path_auth(path, user_x, create_search_client())
+        assert allowed is not path.startswith("Secret")
+    # The decisions of a user are not reused for other users
+    assert await helper.check_path_auth("Benefit_Options.pdf", user_z, create_search_client()) is False
+    assert searched_paths == ["'Secret.pdf'", "'Benefit_Options.pdf'"]
@@ -0,0 +1,309 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from core.answercache import AnswerCache
+from core.cache import LRUCache
+from core.claimscache import ClaimsCache
+from core.embeddingcache import EmbeddingCache
+from core.groupcache import (
+    GroupCache,
+    SqliteGroupStore,
+    decode_groups,
+    encode_groups,
+)
+from core.imagecache import CachedImage, ImageCache
+from core.pathauthcache import PathAuthCache
+from core.semanticcache import SemanticAnswerCache
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache: LRUCache[int] = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+    assert cache.stats.hits == 3
+    assert cache.stats.misses == 1
+
+
+def test_lru_cache_ttl():
+    clock = MockClock()
+    cache: LRUCache[int] = LRUCache(max_entries=2, ttl=10, clock=clock)
+    cache.set("a", 1)
+    cache.set("b", 2, expires_at=5)
+
+    clock.now = 5
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    clock.now = 10
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert cache.stats.expirations == 2
+    assert len(cache) == 0
+
+
+def test_lru_cache_invalid_size():
+    with pytest.raises(ValueError):
+        LRUCache(max_entries=0)
+
+
+def test_embedding_cache_stores_float32():
+    cache = EmbeddingCache(max_entries=2)
+    key = EmbeddingCache.make_key("text-embedding-3-small", "deployment", 256, "What is  the\tdeductible?")
+    cache.set_vector(key, [0.1, 0.2, 0.3])
+
+    assert cache.get(key).dtype == np.float32
+    assert cache.get_vector(
+        EmbeddingCache.make_key("text-embedding-3-small", "deployment", 256, "what is the deductible?")
+    ) == pytest.approx([0.1, 0.2, 0.3])
+    assert (
+        cache.get_vector(
+            EmbeddingCache.make_key("text-embedding-3-small", "deployment", 512, "what is the deductible?")
+        )
+        is None
+    )
+
+
+class MockApproach:
+    current_model = "GPT 3.5 Turbo"
+    fallback_model = None
+
+    def build_filter(self, overrides, auth_claims):
+        return f"oids/any(g:search.in(g, '{auth_claims['oid']}'))" if auth_claims.get("oid") else None
+
+    def get_execution_context(self, overrides):
+        return SimpleNamespace(model_name=self.fallback_model or overrides.get("set_model") or self.current_model)
+
+
+def test_answer_cache_key_depends_on_security_filter():
+    cache = AnswerCache(max_entries=10)
+    messages = [{"content": "What is the deductible?", "role": "user"}]
+    overrides = {"retrieval_mode": "hybrid", "top": 3}
+    key = cache.make_key(MockApproach(), messages, {"overrides": overrides, "auth_claims": {"oid": "A"}})
+
+    assert key == cache.make_key(
+        MockApproach(),
+        [{"content": " what is the  deductible?", "role": "user"}],
+        {"overrides": overrides, "auth_claims": {"oid": "A"}},
+    )
+    assert key != cache.make_key(MockApproach(), messages, {"overrides": overrides, "auth_claims": {"oid": "B"}})
+    assert key != cache.make_key(
+        MockApproach(), messages, {"overrides": {**overrides, "top": 5}, "auth_claims": {"oid": "A"}}
+    )
+    assert key != cache.make_key(
+        MockApproach(),
+        messages,
+        {"overrides": {**overrides, "set_model": "Mistral AI 7B"}, "auth_claims": {"oid": "A"}},
+    )
+    assert cache.make_key(MockApproach(), messages * 2, {"overrides": overrides}) is None
+
+
+def test_answer_cache_key_depends_on_answering_model():
+    cache = AnswerCache(max_entries=10)
+    messages = [{"content": "What is the deductible?", "role": "user"}]
+    approach = MockApproach()
+    key = cache.make_key(approach, messages, {"overrides": {}})
+    # The answers of the fallback model, used while the circuit of the requested model is open, are not reused once
+    # the requested model recovered
+    approach.fallback_model = "Llama 3 8B Instruct"
+    assert cache.make_key(approach, messages, {"overrides": {}}) != key
+
+
+def test_semantic_cache_threshold_and_partitions():
+    cache = SemanticAnswerCache(threshold=0.9, max_entries=10)
+    key = SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {"top": 3}, "filter A")
+    cache.set(key, [1.0, 0.0, 0.0], "What is the deductible?", {"content": "500$"})
+
+    hit = cache.get(key, [2.0, 0.1, 0.0])
+    assert hit is not None
+    assert hit.entry.answer == {"content": "500$"}
+    assert hit.similarity == pytest.approx(0.9988, abs=1e-4)
+    assert cache.get(key, [1.0, 1.0, 0.0]) is None
+    assert (
+        cache.get(
+            SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {"top": 3}, "filter B"), [1.0, 0.0, 0.0]
+        )
+        is None
+    )
+    assert (
+        cache.get(
+            SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {"top": 5}, "filter A"), [1.0, 0.0, 0.0]
+        )
+        is None
+    )
+    assert cache.get(key, [1.0, 0.0]) is None
+
+    metrics = cache.metrics()
+    assert metrics["hits"] == 1
+    assert metrics["misses"] == 4
+    assert metrics["partitions"] == 1
+    assert metrics["similarity_histogram"] == {"0.95": 1, "0.70": 1}
+
+
+def test_semantic_cache_eviction_and_ttl():
+    clock = MockClock()
+    cache = SemanticAnswerCache(threshold=0.9, max_entries=2, ttl=10, clock=clock)
+    key_a = SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {}, "filter A")
+    key_b = SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {}, "filter B")
+    cache.set(key_a, [1.0, 0.0], "first", "1")
+    cache.set(key_a, [0.0, 1.0], "second", "2")
+    assert cache.get(key_a, [1.0, 0.0]).entry.answer == "1"
+    cache.set(key_b, [1.0, 0.0], "third", "3")
+
+    assert len(cache) == 2
+    assert cache.stats.evictions == 1
+    assert cache.get(key_a, [0.0, 1.0]) is None
+    assert cache.get(key_a, [1.0, 0.0]).entry.answer == "1"
+
+    clock.now = 10
+    assert cache.get(key_b, [1.0, 0.0]) is None
+    assert cache.stats.expirations == 1
+    assert len(cache) == 1
+
+    cache.invalidate()
+    assert len(cache) == 0
+    assert cache.get(key_a, [1.0, 0.0]) is None
+
+
+def test_semantic_cache_skips_expired_best_match():
+    clock = MockClock()
+    cache = SemanticAnswerCache(threshold=0.9, max_entries=10, ttl=10, clock=clock)
+    key = SemanticAnswerCache.make_partition_key("Chat", "GPT 3.5 Turbo", {}, None)
+    cache.set(key, [1.0, 0.0], "older", "1")
+    clock.now = 5
+    cache.set(key, [1.0, 0.1], "newer", "2")
+
+    clock.now = 10
+    # The most similar answer expired, the second most similar one is still valid and similar enough
+    hit = cache.get(key, [1.0, 0.0])
+    assert hit.entry.answer == "2"
+    assert cache.stats.expirations == 1
+    assert len(cache) == 1
+
+
+def test_image_cache_bounded_by_size():
+    cache = ImageCache(max_bytes=10)
+    cache.set("a.png", '"1"', "aaaa")
+    cache.set("b.png", '"1"', "bbbb")
+    assert cache.get("a.png").url == "aaaa"
+    cache.set("c.png", '"1"', "cccc")
+
+    assert cache.get("b.png") is None
+    assert cache.get("a.png") == CachedImage(etag='"1"', url="aaaa")
+    assert cache.size == 8
+    assert cache.stats.evictions == 1
+
+    cache.set("a.png", '"2"', "aaaaaa")
+    assert cache.get("a.png").etag == '"2"'
+    assert cache.size == 10
+    cache.set("d.png", '"1"', "d" * 11)
+    assert cache.get("d.png") is None
+    assert cache.size == 10
+
+
+def test_claims_cache_expires_with_token():
+    clock = MockClock()
+    cache = ClaimsCache(max_entries=10, ttl=300, clock=clock)
+    cache.set_claims("token_a", {"oid": "OID_X", "groups": ["GROUP_Y"]}, token_expires_at=60)
+    cache.set_claims("token_b", {"oid": "OID_X", "groups": ["GROUP_Y"]}, token_expires_at=3600)
+    cache.set_claims("token_c", {"oid": "OID_X", "groups": []}, token_expires_at=0)
+
+    claims = cache.get_claims("token_a")
+    assert claims == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    claims["groups"].append("GROUP_Z")
+    assert cache.get_claims("token_a") == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    assert cache.get_claims("token_c") is None
+    assert "token_a" not in cache
+
+    clock.now = 60
+    assert cache.get_claims("token_a") is None
+    assert cache.get_claims("token_b") is not None
+    # The TTL bounds how long group memberships are reused, even for long lived tokens
+    clock.now = 300
+    assert cache.get_claims("token_b") is None
+    assert cache.metrics()["hits"] == 3
+
+
+def test_encode_groups():
+    groups = frozenset(["5f0b8f0e-4c4d-4c3b-9d1a-2f7c1e0a9b01", "0a1b2c3d-0000-4000-8000-000000000001"])
+    assert len(encode_groups(groups)) == 1 + 2 * 16
+    assert decode_groups(encode_groups(groups)) == groups
+    assert decode_groups(encode_groups(frozenset(["GROUP_Y", "GROUP_Z"]))) == frozenset(["GROUP_Y", "GROUP_Z"])
+    assert decode_groups(encode_groups(frozenset())) == frozenset()
+
+
+@pytest.mark.asyncio
+async def test_group_cache_refreshes_in_background():
+    clock = MockClock()
+    cache = GroupCache(ttl=100, clock=clock)
+    calls = []
+
+    async def list_groups():
+        calls.append(clock())
+        await asyncio.sleep(0)
+        return ["GROUP_Z", "GROUP_Y"] if len(calls) == 1 else ["GROUP_X"]
+
+    results = await asyncio.gather(*(cache.get_groups("OID_X", list_groups) for _ in range(3)))
+    assert results == [["GROUP_Y", "GROUP_Z"]] * 3
+    assert calls == [0]
+
+    clock.now = 90
+    # The cached groups are used while they are listed again
+    assert await cache.get_groups("OID_X", list_groups) == ["GROUP_Y", "GROUP_Z"]
+    await asyncio.sleep(0.01)
+    assert await cache.get_groups("OID_X", list_groups) == ["GROUP_X"]
+    assert calls == [0, 90]
+    assert cache.metrics()["refreshes"] == 2
+
+
+@pytest.mark.asyncio
+async def test_group_cache_shared_store(tmp_path):
+    clock = MockClock()
+    store_path = str(tmp_path / "groups.sqlite")
+    worker_a = GroupCache(ttl=100, store=SqliteGroupStore(store_path), clock=clock)
+    worker_b = GroupCache(ttl=100, store=SqliteGroupStore(store_path), clock=clock)
+
+    async def list_groups():
+        return ["GROUP_Y"]
+
+    async def fail():
+        raise AssertionError("The groups should be read from the shared store")
+
+    assert await worker_a.get_groups("OID_X", list_groups) == ["GROUP_Y"]
+    assert await worker_b.get_groups("OID_X", fail) == ["GROUP_Y"]
+    assert worker_b.stats.shared_hits == 1
+
+    clock.now = 100
+    with pytest.raises(AssertionError):
+        await worker_b.get_groups("OID_X", fail)
+    assert worker_b.stats.refresh_failures == 1
+
+
+def test_path_auth_cache():
+    clock = MockClock()
+    cache = PathAuthCache(max_entries=10, ttl=60, clock=clock)
+    cache.preauthorize("filter_x", ["a.pdf#page=1", "a.pdf", "a-1.png"])
+    cache.set_decision("filter_x", "b.pdf", False)
+
+    assert len(cache) == 3
+    assert cache.get_decision("filter_x", "a.pdf#page=2") is True
+    assert cache.get_decision("filter_x", "b.pdf") is False
+    assert cache.get_decision("filter_y", "a.pdf") is None
+    clock.now = 60
+    assert cache.get_decision("filter_x", "a.pdf") is None
@@ -9,6 +9,8 @@ from openai.types.chat import ChatCompletion
 
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.embeddingcache import EmbeddingCache
+from error import CircuitOpenError
 
 from .mocks import MOCK_EMBEDDING_DIMENSIONS, MOCK_EMBEDDING_MODEL_NAME
 
@@ -54,13 +56,17 @@ def chat_approach(openai_client, mock_confidential_client_success):
         blob_container_client=None,
         vision_endpoint="endpoint",
         vision_token_provider=lambda: "token",
+        http_session=None,
+        image_cache=None,
         current_model=None,
         available_models=None,
+        prompt_templates=None,
         gpt4v_deployment="gpt-4v",
         gpt4v_model="gpt-4v",
         embedding_deployment="embeddings",
         embedding_model=MOCK_EMBEDDING_MODEL_NAME,
         embedding_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        embedding_cache=None,
         sourcepage_field="",
         content_field="",
         query_language="en-us",
@@ -150,3 +156,46 @@ async def test_compute_text_embedding(chat_approach, openai_client, mock_openai_
     assert result.vector == [0.0023064255, -0.009327292, -0.0028842222]
     assert result.k_nearest_neighbors == 50
     assert result.fields == "embedding"
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(chat_approach, openai_client, mock_openai_embedding):
+    mock_openai_embedding(openai_client)
+    chat_approach.embedding_cache = EmbeddingCache(max_entries=10, ttl=60)
+
+    result = await chat_approach.compute_text_embedding("test query")
+    chat_approach.emb_client = None  # Any further call to the embeddings API would fail
+    cached_result = await chat_approach.compute_text_embedding("  Test   QUERY ")
+
+    assert cached_result.vector == pytest.approx(result.vector)
+    assert chat_approach.embedding_cache.stats.hits == 1
+    assert chat_approach.embedding_cache.stats.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_isolates_field_errors(chat_approach, monkeypatch):
+    async def mock_compute_text_embedding(q):
+        return VectorizedQuery(vector=[0.1, 0.2], k_nearest_neighbors=50, fields="embedding")
+
+    async def mock_compute_image_embedding(q):
+        raise ValueError("Vision is unavailable")
+
+    monkeypatch.setattr(chat_approach, "compute_text_embedding", mock_compute_text_embedding)
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding)
+
+    vectors = await chat_approach.compute_vectors("question", ["embedding", "imageEmbedding"])
+    assert [vector.fields for vector in vectors] == ["embedding"]
+
+    with pytest.raises(ValueError, match="Vision is unavailable"):
+        await chat_approach.compute_vectors("question", ["imageEmbedding"])
+
+
+@pytest.mark.asyncio
+async def test_compute_vectors_text_only_when_circuit_open(chat_approach, monkeypatch):
+    async def mock_compute_image_embedding(q):
+        raise CircuitOpenError("vision")
+
+    monkeypatch.setattr(chat_approach, "compute_image_embedding", mock_compute_image_embedding)
+
+    # The documents are retrieved with the text of the query instead of failing the request
+    assert await chat_approach.compute_vectors("question", ["imageEmbedding"]) == []
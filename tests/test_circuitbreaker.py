@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+from httpx import Request, Response
+from openai import BadRequestError, InternalServerError
+
+from core.circuitbreaker import (
+    CircuitBreaker,
+    CircuitState,
+    call_protected,
+    is_upstream_failure,
+    protect,
+)
+from error import CircuitOpenError, UpstreamOverloadedError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_breaker(clock: FakeClock, **kwargs) -> CircuitBreaker:
+    settings = {"window_size": 4, "min_calls": 4, "open_duration": 30, "slow_call_duration": 5, **kwargs}
+    return CircuitBreaker("hf", clock=clock, **settings)
+
+
+async def fail():
+    raise ConnectionError("Service unavailable")
+
+
+async def succeed():
+    return "ok"
+
+
+@pytest.mark.asyncio
+async def test_opens_on_failure_rate():
+    breaker = make_breaker(FakeClock())
+    assert await call_protected(breaker, succeed) == "ok"
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await call_protected(breaker, fail)
+    # Not enough calls yet
+    assert breaker.state == CircuitState.CLOSED
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError) as exc_info:
+        await call_protected(breaker, succeed)
+    assert exc_info.value.upstream == "hf"
+    assert breaker.metrics() == {
+        "calls": 4,
+        "failures": 3,
+        "slow_calls": 0,
+        "rejected": 1,
+        "opened": 1,
+        "state_changes": 1,
+        "state": "open",
+        "failure_rate": 0.75,
+    }
+
+
+@pytest.mark.asyncio
+async def test_slow_calls_open_circuit():
+    clock = FakeClock()
+    breaker = make_breaker(clock, window_size=2, min_calls=2)
+
+    async def slow():
+        clock.now += 10
+        return "late"
+
+    assert await call_protected(breaker, slow) == "late"
+    assert await call_protected(breaker, slow) == "late"
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.stats.slow_calls == 2
+
+
+@pytest.mark.asyncio
+async def test_half_open_probe_closes_circuit():
+    clock = FakeClock()
+    breaker = make_breaker(clock, window_size=1, min_calls=1)
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    clock.now += 30
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert not breaker.is_open
+
+    probe_started = asyncio.Event()
+    probe_done = asyncio.Event()
+
+    async def probe():
+        probe_started.set()
+        await probe_done.wait()
+        return "ok"
+
+    probe_task = asyncio.create_task(call_protected(breaker, probe))
+    await probe_started.wait()
+    # Only a single probe is let through
+    with pytest.raises(CircuitOpenError):
+        await call_protected(breaker, succeed)
+    probe_done.set()
+    assert await probe_task == "ok"
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.failure_rate == 0
+    assert await call_protected(breaker, succeed) == "ok"
+
+
+@pytest.mark.asyncio
+async def test_half_open_probe_failure_opens_circuit():
+    clock = FakeClock()
+    breaker = make_breaker(clock, window_size=1, min_calls=1)
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    clock.now += 30
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.stats.opened == 2
+    clock.now += 29
+    assert breaker.is_open
+
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_lets_another_probe_through():
+    clock = FakeClock()
+    breaker = make_breaker(clock, window_size=1, min_calls=1)
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    clock.now += 30
+    probe_task = asyncio.create_task(call_protected(breaker, lambda: asyncio.sleep(10)))
+    await asyncio.sleep(0)
+    assert breaker.is_open
+    probe_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe_task
+    assert await call_protected(breaker, succeed) == "ok"
+    assert breaker.state == CircuitState.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_calls_made_before_half_open_do_not_end_the_probe():
+    clock = FakeClock()
+    breaker = make_breaker(clock, window_size=1, min_calls=1)
+    straggler_done = asyncio.Event()
+
+    async def straggler():
+        await straggler_done.wait()
+        return "late"
+
+    # A slow call made while the circuit is closed, which ends after the circuit opened and became half-open
+    straggler_task = asyncio.create_task(call_protected(breaker, straggler))
+    await asyncio.sleep(0)
+    with pytest.raises(ConnectionError):
+        await call_protected(breaker, fail)
+    clock.now += 30
+    probe_done = asyncio.Event()
+    probe_task = asyncio.create_task(call_protected(breaker, probe_done.wait))
+    await asyncio.sleep(0)
+    assert breaker.state == CircuitState.HALF_OPEN
+
+    straggler_done.set()
+    assert await straggler_task == "late"
+    assert breaker.state == CircuitState.HALF_OPEN
+    assert breaker.is_open
+    assert breaker.stats.calls == 2
+
+    probe_done.set()
+    await probe_task
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.stats.calls == 3
+
+
+def test_client_errors_are_not_failures():
+    request = Request("POST", "https://example.com")
+    assert not is_upstream_failure(BadRequestError("Bad request", response=Response(400, request=request), body=None))
+    assert is_upstream_failure(InternalServerError("Server error", response=Response(500, request=request), body=None))
+    assert is_upstream_failure(asyncio.TimeoutError())
+    assert not is_upstream_failure(UpstreamOverloadedError("hf"))
+
+
+@pytest.mark.asyncio
+async def test_protect_without_breaker():
+    async with protect(None):
+        pass
+    assert await call_protected(None, succeed) == "ok"
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        CircuitBreaker("hf", failure_rate_threshold=0)
+    with pytest.raises(ValueError):
+        CircuitBreaker("hf", window_size=5, min_calls=10)
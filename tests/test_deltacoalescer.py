@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from core.deltacoalescer import DeltaCoalescer
+
+
+def content_delta(content):
+    return {"delta": {"role": "assistant", "content": content}}
+
+
+async def stream(contents, delay=0.001):
+    # Models stream the tokens one by one, while the frames are sent
+    for content in contents:
+        if delay:
+            await asyncio.sleep(delay)
+        yield content_delta(content)
+
+
+async def collect(coalescer, completions):
+    return [completion async for completion in coalescer.coalesce(completions)]
+
+
+def test_delta_coalescer_requires_a_flush_condition():
+    with pytest.raises(ValueError):
+        DeltaCoalescer()
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_flushes_on_max_chars():
+    coalescer = DeltaCoalescer(max_chars=5)
+    frames = await collect(coalescer, stream(["", "a", "bc", "de", "f", "gh", "i"]))
+    assert frames == [content_delta("a"), content_delta("bcdef"), content_delta("ghi")]
+    assert coalescer.metrics() == {"responses": 1, "deltas": 7, "frames": 3, "frames_per_response": 3.0}
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_flushes_on_window():
+    coalescer = DeltaCoalescer(window=1)
+    frames = await collect(coalescer, stream(["a", "b", "c", "d"]))
+    # The first token is sent right away, then the others once the window elapsed or at the end of the stream
+    assert frames[0] == content_delta("a")
+    assert frames == [content_delta("a"), content_delta("bcd")]
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_flushes_on_window_and_max_chars():
+    coalescer = DeltaCoalescer(window=0.05, max_chars=10)
+
+    async def paused_stream():
+        async for completion in stream(["a", "bcdefgh"]):
+            yield completion
+        await asyncio.sleep(0.2)
+        async for completion in stream(["ij", "k", "lm"]):
+            yield completion
+
+    frames = await collect(coalescer, paused_stream())
+    # The characters flushed by the window do not count towards the max_chars of the next frame
+    assert frames == [content_delta("a"), content_delta("bcdefgh"), content_delta("ijklm")]
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_flushes_when_the_stream_stalls():
+    coalescer = DeltaCoalescer(window=0.01)
+    flushed = asyncio.Event()
+
+    async def stalled_stream():
+        async for completion in stream(["a", "b"]):
+            yield completion
+        await flushed.wait()
+        yield content_delta("c")
+
+    frames = []
+    async for frame in coalescer.coalesce(stalled_stream()):
+        frames.append(frame)
+        if frame == content_delta("b"):
+            flushed.set()
+    assert frames == [content_delta("a"), content_delta("b"), content_delta("c")]
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_forwards_other_deltas():
+    coalescer = DeltaCoalescer(max_chars=100)
+    tool_call = {"delta": {"role": "assistant", "content": None, "tool_calls": [{"index": 0}]}}
+
+    async def completions():
+        async for completion in stream(["a", "b"]):
+            yield completion
+        yield tool_call
+        yield content_delta("c")
+
+    frames = await collect(coalescer, completions())
+    assert frames == [content_delta("a"), content_delta("b"), tool_call, content_delta("c")]
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_merges_the_backlog():
+    coalescer = DeltaCoalescer(max_chars=100)
+    # Deltas received while the previous frames are sent are merged, even before the first token is sent
+    frames = await collect(coalescer, stream(["", "a", "b", "c"], delay=0))
+    assert frames == [content_delta("abc")]
+
+
+@pytest.mark.asyncio
+async def test_delta_coalescer_closes_the_stream():
+    coalescer = DeltaCoalescer(window=10)
+    closed = asyncio.Event()
+
+    async def completions():
+        try:
+            async for completion in stream(["a", "b"]):
+                yield completion
+            await asyncio.sleep(10)
+        finally:
+            closed.set()
+
+    frames = coalescer.coalesce(completions())
+    assert await frames.__anext__() == content_delta("a")
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(frames.__anext__(), 0.01)
+    await frames.aclose()
+    assert closed.is_set()
@@ -11,7 +11,8 @@ from azure.core.pipeline.transport import (
 from azure.storage.blob.aio import BlobServiceClient
 
 from approaches.approach import Document
-from core.imageshelper import fetch_image
+from core.imagecache import ImageCache
+from core.imageshelper import encode_data_url, fetch_image, fetch_images
 
 from .mocks import MockAzureCredential
 
@@ -99,3 +100,91 @@ async def test_content_file(monkeypatch, mock_env, mock_acs_search):
     test_document.sourcepage = ""
     image_url = await fetch_image(blob_container_client, test_document)
     assert image_url is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_images_revalidates_cached_images(mock_env):
+    class MockAiohttpClientResponse(aiohttp.ClientResponse):
+        def __init__(self, url, status, body_bytes, headers):
+            self._body = body_bytes
+            self._headers = headers
+            self._cache = {}
+            self.status = status
+            self.reason = "OK" if status == 200 else "Not Modified"
+            self._url = url
+
+    class MockTransport(AsyncHttpTransport):
+        def __init__(self):
+            self.requests = []
+
+        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+            self.requests.append(request)
+            etag = '"0x1"'
+            if request.headers.get("If-None-Match") == etag:
+                return AioHttpTransportResponse(
+                    request, MockAiohttpClientResponse(request.url, 304, b"", {"ETag": etag})
+                )
+            body = request.url.split("/")[-1].encode()
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    200,
+                    body,
+                    {
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"bytes 0-{len(body) - 1}/{len(body)}",
+                        "Content-Length": str(len(body)),
+                        "ETag": etag,
+                    },
+                ),
+            )
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def open(self):
+            pass
+
+        async def close(self):
+            pass
+
+    transport = MockTransport()
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+    documents = [
+        Document(
+            id=str(page),
+            content="test content",
+            embedding=None,
+            image_embedding=None,
+            oids=[],
+            groups=[],
+            captions=[],
+            category="",
+            sourcefile="test.pdf",
+            sourcepage=f"test-{page}.pdf",
+        )
+        for page in range(3)
+    ]
+    image_cache = ImageCache(max_bytes=1024)
+
+    image_urls = await fetch_images(blob_container_client, documents, image_cache, max_concurrency=2)
+    assert [image_url["url"] for image_url in image_urls] == [
+        encode_data_url(f"test-{page}.png".encode()) for page in range(3)
+    ]
+    assert len(image_cache) == 3
+
+    transport.requests.clear()
+    assert await fetch_images(blob_container_client, documents, image_cache) == image_urls
+    assert len(transport.requests) == 3
+    assert all(request.headers["If-None-Match"] == '"0x1"' for request in transport.requests)
+    assert image_cache.stats.hits == 3
@@ -0,0 +1,44 @@
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from core.httpsessions import HttpSessionPool, HttpSessionSettings
+
+
+@pytest_asyncio.fixture
+async def server_url():
+    async def handle(request):
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_get("/", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    yield f"http://127.0.0.1:{port}/"
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_http_session_pool_reuses_connections(server_url):
+    pool = HttpSessionPool(HttpSessionSettings(limit_per_host=1))
+    session = pool.get("vision")
+    assert pool.get("vision") is session
+    assert pool.get("auth") is not session
+
+    for _ in range(3):
+        async with session.get(server_url) as response:
+            assert await response.json() == {"status": "ok"}
+
+    metrics = pool.metrics()
+    assert metrics["vision"]["requests"] == 3
+    assert metrics["vision"]["connections_created"] == 1
+    assert metrics["vision"]["connections_reused"] == 2
+    assert metrics["auth"]["requests"] == 0
+
+    await pool.close()
+    assert session.closed
+    assert pool.get("vision") is not session
+    await pool.close()
@@ -0,0 +1,98 @@
+import dataclasses
+import json
+
+import pytest
+from azure.search.documents.models import QueryCaptionResult
+from huggingface_hub import ChatCompletionStreamOutputDelta
+from openai.types.chat.chat_completion_chunk import (
+    ChoiceDelta,
+    ChoiceDeltaToolCall,
+    ChoiceDeltaToolCallFunction,
+)
+
+from approaches.approach import Document, ThoughtStep
+from core.jsonserializer import JSONSerializer, to_jsonable
+
+DOCUMENT = Document(
+    id="file-Benefit_Options_pdf-42656E656669745F4F7074696F6E732E706466-page-2",
+    content="There is a whistleblower policy.",
+    embedding=[0.1, 0.2, 0.3],
+    image_embedding=None,
+    category=None,
+    sourcepage="Benefit_Options-2.pdf",
+    sourcefile="Benefit_Options.pdf",
+    oids=[],
+    groups=[],
+    captions=[QueryCaptionResult(text="Caption: A whistleblower policy.")],
+    score=0.03,
+    reranker_score=3.4,
+)
+
+
+@pytest.fixture(params=[True, False], ids=["orjson", "json"])
+def serializer(request):
+    return JSONSerializer(use_orjson=request.param)
+
+
+def test_serializer_backend():
+    pytest.importorskip("orjson")
+    assert JSONSerializer().backend == "orjson"
+    assert JSONSerializer(use_orjson=False).backend == "json"
+
+
+def test_dumps_thought_steps(serializer):
+    thought = ThoughtStep("Search results", [DOCUMENT], {"use_vector_search": False, "step": ThoughtStep("a", "b")})
+    expected = {
+        "title": "Search results",
+        "description": [DOCUMENT.serialize_for_results()],
+        "props": {"use_vector_search": False, "step": dataclasses.asdict(ThoughtStep("a", "b"))},
+    }
+    assert json.loads(serializer.dumps({"thoughts": [thought]})) == {"thoughts": [expected]}
+
+
+def test_dumps_openai_deltas(serializer):
+    delta = ChoiceDelta(
+        role="assistant",
+        tool_calls=[
+            ChoiceDeltaToolCall(index=0, id="call", function=ChoiceDeltaToolCallFunction(name="search", arguments="{"))
+        ],
+    )
+    assert to_jsonable(delta).keys() == delta.model_dump().keys()
+    assert json.loads(serializer.dumps({"delta": delta})) == {"delta": delta.model_dump()}
+
+
+def test_dumps_openai_deltas_extra_fields(serializer):
+    delta = ChoiceDelta.model_validate({"content": "Paris", "content_filter_results": {}})
+    assert json.loads(serializer.dumps(delta)) == delta.model_dump()
+
+
+def test_dumps_huggingface_deltas(serializer):
+    delta = ChatCompletionStreamOutputDelta(role="assistant", content="Paris")
+    assert json.loads(serializer.dumps({"delta": delta})) == {
+        "delta": {"role": "assistant", "content": "Paris", "tool_calls": None}
+    }
+
+
+def test_dumps_line(serializer):
+    line = serializer.dumps_line({"a": "I ❤️ 🐍", "b": "Newlines inside \n strings are fine"})
+    assert line == '{"a":"I ❤️ 🐍","b":"Newlines inside \\n strings are fine"}\n'.encode()
+
+
+def test_dumps_sort_keys():
+    assert JSONSerializer(sort_keys=True).dumps({"b": 1, "a": 2}) == b'{"a":2,"b":1}'
+    assert JSONSerializer(use_orjson=False, sort_keys=True).dumps({"b": 1, "a": 2}) == b'{"a":2,"b":1}'
+    assert JSONSerializer().dumps({"b": 1, "a": 2}) == b'{"b":1,"a":2}'
+
+
+def test_backends_have_the_same_output():
+    event = {
+        "delta": ChoiceDelta(role="assistant", content="Paris [Benefit_Options-2.pdf]"),
+        "context": {"thoughts": [ThoughtStep("Search results", [DOCUMENT], {"top": 3})], "followup_questions": []},
+        "session_state": None,
+    }
+    assert JSONSerializer().dumps_line(event) == JSONSerializer(use_orjson=False).dumps_line(event)
+
+
+def test_dumps_unsupported_type(serializer):
+    with pytest.raises(TypeError):
+        serializer.dumps({"a": object()})
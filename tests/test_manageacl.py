@@ -171,6 +171,38 @@ async def test_add_acl(monkeypatch, caplog):
         assert "Adding acl OID_ADD to 2 search documents" in caplog.text
 
 
+@pytest.mark.asyncio
+async def test_add_group_acl_registers_group(monkeypatch):
+    async def mock_search(self, *args, **kwargs):
+        return AsyncSearchResultsIterator([{"id": 1, "groups": []}])
+
+    async def mock_merge_documents(self, *args, **kwargs):
+        pass
+
+    registered = []
+
+    async def mock_merge_or_upload_documents(self, *args, **kwargs):
+        assert self._index_name == "INDEX-aclgroups"
+        registered.extend(kwargs.get("documents"))
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_merge_or_upload_documents)
+
+    command = ManageAcl(
+        service_name="SERVICE",
+        index_name="INDEX",
+        url="https://test.blob.core.windows.net/content/a.txt",
+        acl_action="add",
+        acl_type="groups",
+        acl="GROUP_ADD",
+        credentials=MockAzureCredential(),
+        acl_groups_index="INDEX-aclgroups",
+    )
+    await command.run()
+    assert registered == [{"id": "R1JPVVBfQURE", "group": "GROUP_ADD"}]
+
+
 @pytest.mark.asyncio
 async def test_update_storage_urls(monkeypatch, caplog):
     async def mock_search(self, *args, **kwargs):
@@ -0,0 +1,87 @@
+import pytest
+
+from core.messageshelper import build_past_messages, count_tokens_for_message
+from core.tokencountcache import TokenCountCache
+from core.tokenizers import TokenizerRegistry
+
+HISTORY = [
+    {"role": "user", "content": "What is the capital of France?"},
+    {"role": "assistant", "content": "The capital of France is Paris."},
+    {"role": "user", "content": "And the capital of Spain?"},
+    {"role": "assistant", "content": "The capital of Spain is Madrid."},
+]
+
+
+class WordTokenizer:
+    def encode(self, text):
+        return text.split()
+
+
+def build(tokenizer, past_messages, max_tokens=1000, token_counts=None):
+    return build_past_messages(
+        "mistralai/Mistral-7B-Instruct-v0.3",
+        tokenizer,
+        "You are a helpful assistant.",
+        max_tokens,
+        new_user_content="And the capital of Italy?",
+        few_shots=[{"role": "user", "content": "How did crypto do last year?"}],
+        past_messages=past_messages,
+        token_counts=token_counts,
+    )
+
+
+@pytest.mark.parametrize("kept", [0, 1, 2, 3])
+def test_build_past_messages_truncates_to_most_recent_messages(kept):
+    tokenizer = WordTokenizer()
+    fixed_tokens = sum(
+        count_tokens_for_message("", tokenizer, message)
+        for message in [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "How did crypto do last year?"},
+            {"role": "user", "content": "And the capital of Italy?"},
+        ]
+    )
+    kept_tokens = sum(count_tokens_for_message("", tokenizer, message) for message in HISTORY[len(HISTORY) - kept :])
+    assert build(tokenizer, HISTORY, max_tokens=fixed_tokens + kept_tokens) == HISTORY[len(HISTORY) - kept :]
+
+
+@pytest.mark.parametrize("model_type", ["openai", "hf"])
+def test_build_past_messages_counts_new_messages_only(model_type, monkeypatch):
+    monkeypatch.setattr("core.tokenizers.AutoTokenizer.from_pretrained", lambda model: WordTokenizer())
+    model = "gpt-35-turbo" if model_type == "openai" else "mistralai/Mistral-7B-Instruct-v0.3"
+    tokenizer = TokenizerRegistry().get(model, model_type)
+    token_counts = TokenCountCache(max_entries=100)
+
+    def build_turn(past_messages, max_tokens):
+        return build_past_messages(
+            model,
+            tokenizer,
+            "You are a helpful assistant.",
+            max_tokens,
+            new_user_content="And the capital of Italy?",
+            past_messages=past_messages,
+            token_counts=token_counts,
+        )
+
+    for max_tokens in [1000, 60]:
+        assert build_turn(HISTORY[:2], max_tokens) == build_past_messages(
+            model,
+            tokenizer,
+            "You are a helpful assistant.",
+            max_tokens,
+            new_user_content="And the capital of Italy?",
+            past_messages=HISTORY[:2],
+        )
+    assert token_counts.stats.misses == 4
+    # The next turn only counts its new messages
+    assert build_turn(HISTORY, 1000) == HISTORY
+    assert token_counts.stats.misses == 6
+    assert len(token_counts) == 6
+
+
+def test_token_count_keys():
+    message = {"role": "user", "content": "What is the capital of France?"}
+    key = TokenCountCache.make_key("gpt-35-turbo", message)
+    assert key == TokenCountCache.make_key("gpt-35-turbo", dict(reversed(message.items())))
+    assert key != TokenCountCache.make_key("mistralai/Mistral-7B-Instruct-v0.3", message)
+    assert key != TokenCountCache.make_key("gpt-35-turbo", {**message, "role": "assistant"})
@@ -204,6 +204,38 @@ async def test_update_content(monkeypatch, search_info):
     )
 
 
+@pytest.mark.asyncio
+async def test_update_content_registers_acl_groups(monkeypatch, search_info):
+    registered = []
+
+    async def mock_upload_documents(self, documents):
+        assert self._index_name == "test"
+
+    async def mock_merge_or_upload_documents(self, documents):
+        assert self._index_name == "test-aclgroups"
+        registered.extend(documents)
+
+    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_merge_or_upload_documents)
+
+    manager = SearchManager(search_info, use_acls=True, acl_groups_index_name="test-aclgroups")
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io, acls={"oids": ["OID_X"], "groups": ["GROUP_Z", "GROUP_Y"]})
+
+    await manager.update_content(
+        [
+            Section(split_page=SplitPage(page_num=0, text="test content"), content=file),
+            Section(split_page=SplitPage(page_num=1, text="more content"), content=file),
+        ]
+    )
+    assert registered == [
+        {"id": "R1JPVVBfWQ==", "group": "GROUP_Y"},
+        {"id": "R1JPVVBfWg==", "group": "GROUP_Z"},
+    ]
+
+
 @pytest.mark.asyncio
 async def test_update_content_many(monkeypatch, search_info):
     ids = []
@@ -0,0 +1,53 @@
+import pytest
+
+from core.streamtracker import StreamTracker, close_stream
+
+
+def test_tokens_saved_estimated_with_completed_answers():
+    tracker = StreamTracker()
+    # Without completed answers, the length of the cancelled answers is unknown
+    assert tracker.record_cancelled(3) == 0
+    tracker.record_completed(100)
+    tracker.record_completed(200)
+    assert tracker.record_cancelled(20) == 130
+    # Answers cancelled after the mean length did not save tokens
+    assert tracker.record_cancelled(400) == 0
+    assert tracker.metrics() == {
+        "completed": 2,
+        "cancelled": 3,
+        "completed_tokens": 300,
+        "cancelled_tokens": 423,
+        "tokens_saved": 130,
+        "mean_answer_tokens": 150,
+    }
+
+
+@pytest.mark.asyncio
+async def test_close_stream_async_generator():
+    closed = False
+
+    async def stream():
+        nonlocal closed
+        try:
+            yield {"choices": []}
+            yield {"choices": []}
+        finally:
+            closed = True
+
+    events = stream()
+    await events.__anext__()
+    await close_stream(events)
+    assert closed
+
+
+@pytest.mark.asyncio
+async def test_close_stream_openai_stream():
+    class AsyncStream:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    stream = AsyncStream()
+    await close_stream(stream)
+    assert stream.closed
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+import tiktoken
+from openai_messages_token_helper import model_helper
+
+from core.messageshelper import (
+    build_past_messages,
+    count_tokens_for_message,
+    count_tokens_for_system_and_tools,
+)
+from core.tokenizers import TokenizerRegistry
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search_sources",
+            "description": "Retrieve sources from the Azure AI Search index",
+            "parameters": {
+                "type": "object",
+                "properties": {"search_query": {"type": "string", "description": "Query string to retrieve documents"}},
+                "required": ["search_query"],
+            },
+        },
+    }
+]
+
+
+class MockHFTokenizer:
+    def encode(self, text):
+        return text.split()
+
+
+@pytest.fixture
+def mock_from_pretrained(monkeypatch):
+    loaded = []
+
+    def from_pretrained(model):
+        loaded.append(model)
+        return MockHFTokenizer()
+
+    monkeypatch.setattr("core.tokenizers.AutoTokenizer.from_pretrained", from_pretrained)
+    return loaded
+
+
+def test_registry_loads_tokenizers_once(mock_from_pretrained):
+    registry = TokenizerRegistry()
+    tokenizer = registry.get("mistralai/Mistral-7B-Instruct-v0.3", "hf")
+    assert registry.get("mistralai/Mistral-7B-Instruct-v0.3", "hf") is tokenizer
+    assert isinstance(registry.get("gpt-35-turbo", "openai"), tiktoken.Encoding)
+    assert mock_from_pretrained == ["mistralai/Mistral-7B-Instruct-v0.3"]
+    assert registry.metrics() == {"tokenizers": 2, "loads": 2}
+
+
+def test_registry_loads_tokenizers_once_with_threads(mock_from_pretrained):
+    registry = TokenizerRegistry()
+    threads = [threading.Thread(target=registry.get, args=("microsoft/Phi-3-mini-4k-instruct", "hf")) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_from_pretrained == ["microsoft/Phi-3-mini-4k-instruct"]
+
+
+def test_registry_unsupported_model(monkeypatch):
+    def from_pretrained(model):
+        raise ValueError("Unrecognized model")
+
+    monkeypatch.setattr("core.tokenizers.AutoTokenizer.from_pretrained", from_pretrained)
+    with pytest.raises(ValueError, match="Could not load the tokenizer for model unknown/model"):
+        TokenizerRegistry().get("unknown/model", "hf")
+    with pytest.raises(ValueError):
+        TokenizerRegistry().get("unknown-model", "openai")
+    assert TokenizerRegistry().get("unknown-model", "openai", fallback_to_default=True).name == "cl100k_base"
+
+
+def test_token_counts_match_openai_messages_token_helper():
+    tokenizer = TokenizerRegistry().get("gpt-35-turbo", "openai")
+    system_message = {"role": "system", "content": "You are a helpful assistant."}
+    message = {"role": "user", "name": "user1", "content": [{"type": "text", "text": "What is the capital of France?"}]}
+    assert count_tokens_for_message("gpt-35-turbo", tokenizer, message) == model_helper.count_tokens_for_message(
+        "gpt-35-turbo", message
+    )
+    tool_choice = {"type": "function", "function": {"name": "search_sources"}}
+    assert count_tokens_for_system_and_tools(
+        "gpt-35-turbo", tokenizer, system_message, TOOLS, tool_choice
+    ) == model_helper.count_tokens_for_system_and_tools("gpt-35-turbo", system_message, TOOLS, tool_choice)
+
+
+def test_build_past_messages_hf_does_not_patch_modules(mock_from_pretrained):
+    encoding_for_model = model_helper.encoding_for_model
+    tiktoken_encoding_for_model = tiktoken.encoding_for_model
+    tokenizer = TokenizerRegistry().get("meta-llama/Meta-Llama-3-8B-Instruct", "hf")
+    past_messages = [
+        {"role": "user", "content": "What is the capital of France?"},
+        {"role": "assistant", "content": "The capital of France is Paris."},
+    ]
+    result = build_past_messages(
+        "meta-llama/Meta-Llama-3-8B-Instruct",
+        tokenizer,
+        "You are a helpful assistant.",
+        1000,
+        tools=TOOLS,
+        new_user_content="And the capital of Spain?",
+        past_messages=past_messages,
+    )
+    assert result == past_messages
+    assert model_helper.encoding_for_model is encoding_for_model
+    assert tiktoken.encoding_for_model is tiktoken_encoding_for_model
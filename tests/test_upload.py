@@ -223,6 +223,9 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
+    index_changes = []
+    auth_client.config["ingester"].add_index_change_listener(lambda: index_changes.append("removed"))
+
     response = await auth_client.post(
         "/delete_uploaded", headers={"Authorization": "Bearer test"}, json={"filename": "a's doc.txt"}
     )
@@ -231,3 +234,4 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
     assert searched_filters[0] == "sourcefile eq 'a''s doc.txt'"
     assert len(deleted_documents) == 1, "It should have only deleted the document solely owned by OID_X"
     assert deleted_documents[0]["id"] == "file-a_txt-7465737420646F63756D656E742E706466"
+    assert index_changes == ["removed"], "It should notify the listeners that the index changed"